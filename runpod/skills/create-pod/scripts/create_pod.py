@@ -9,25 +9,52 @@ RunPod Pod Creation Script
 Reads config from runpod.toml and runs runpodctl create pod.
 With --ssh, automatically waits and connects via SSH after creation.
 
+SSH readiness is checked in phases (pod running, SSH port published,
+sshd answering) through the RunPod GraphQL API and a TCP probe, using the
+API key from RUNPOD_API_KEY or ~/.runpod/config.toml.
+
 Usage:
   uv run --script create_pod.py                # Create a pod
   uv run --script create_pod.py --ssh           # Create and SSH connect
   uv run --script create_pod.py --dry-run       # Show command only
   uv run --script create_pod.py -c other.toml   # Use a different config
+  uv run --script create_pod.py --count 16 --wait  # Fleet: 16 pods, wait for SSH
+  uv run --script create_pod.py -c a.toml -c b.toml --count 4 --ndjson
+  uv run --script create_pod.py --race 2      # Try the 2 best candidates at once
+
+pod.gpu_type and pod.datacenter_id may be lists of candidates. They are
+ranked by live stock and tried best-first when creation fails for lack
+of capacity.
+
+The init script is uploaded once under its content hash (to the network
+volume if there is one) and run by reference; a per-pod marker skips it
+on reconnect until the script changes (--reinit forces a re-run).
 """
 
 from __future__ import annotations
 
 import argparse
+import copy
+import hashlib
+import json
 import os
 import re
 import shlex
 import shutil
+import socket
 import subprocess
 import sys
 import time
 import tomllib
+import urllib.request
+from collections.abc import Callable
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
+from typing import TypeVar
+
+T = TypeVar("T")
+
+RUNPOD_CONFIG_PATH = Path.home() / ".runpod" / "config.toml"
 
 DEFAULTS = {
     "pod": {
@@ -41,6 +68,36 @@ DEFAULTS = {
     },
 }
 
+# Default number of pods created (and waited for) at the same time in fleet mode
+DEFAULT_PARALLEL = 8
+
+# stockStatus in dataCenters.gpuAvailability, best first (missing = 0)
+STOCK_LEVELS = {"High": 3, "Medium": 2, "Low": 1}
+
+# Reuse one SSH connection for the init script upload and the session
+SSH_CONTROL_OPTIONS = [
+    "-o",
+    "ControlMaster=auto",
+    "-o",
+    "ControlPath=~/.ssh/create-pod-%C",
+    "-o",
+    "ControlPersist=10m",
+]
+
+# Remote locations for uploaded init scripts and their "already ran" markers.
+# Markers stay on the container disk: a new pod on the same volume still runs init.
+REMOTE_INIT_DIR = '"$HOME/.cache/create-pod"'
+VOLUME_INIT_DIR = ".create-pod"
+
+# runpodctl errors that mean "try another GPU type / datacenter"
+CAPACITY_ERROR = re.compile(
+    r"no longer any instances available|no instances (currently )?available"
+    r"|does not have the resources|not enough (free )?gpus?"
+    r"|insufficient (gpu |instance )?capacity"
+    r"|(gpus?|instances?) (is |are )?out of stock",
+    re.IGNORECASE,
+)
+
 
 def find_config(config_path: str | None) -> Path:
     if config_path:
@@ -84,6 +141,26 @@ def load_config(config_path: Path) -> dict:
     return config
 
 
+def validate_config(config: dict, config_path: Path) -> None:
+    """Check settings that CLI overrides can change (run after applying them)."""
+    if (
+        config["volume"].get("network_volume_id")
+        and len(as_list(config["pod"].get("datacenter_id"))) > 1
+    ):
+        print(
+            f"Error: {config_path}: a network volume lives in one datacenter; "
+            "pod.datacenter_id cannot be a list with volume.network_volume_id",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+
+def as_list(value: str | list[str] | None) -> list[str]:
+    if isinstance(value, list):
+        return value
+    return [value] if value else []
+
+
 def build_env_vars(config: dict) -> list[str]:
     env = dict(config.get("env", {}))
 
@@ -147,13 +224,13 @@ def build_create_command(config: dict, env_vars: list[str]) -> list[str]:
     return cmd
 
 
-def create_pod(cmd: list[str]) -> str | None:
+def create_pod(cmd: list[str]) -> tuple[str | None, str]:
+    """Run runpodctl create pod and return (pod id, output)."""
     result = subprocess.run(cmd, capture_output=True, text=True)
     output = result.stdout + result.stderr
-    print(output.rstrip())
 
     match = re.search(r'pod "([a-z0-9]+)"', output)
-    return match.group(1) if match else None
+    return (match.group(1) if match else None), output
 
 
 def print_pod_summary(config: dict) -> None:
@@ -162,9 +239,9 @@ def print_pod_summary(config: dict) -> None:
 
     print("Creating RunPod instance...")
     print(f"  Name: {pod['name']}")
-    print(f"  GPU: {pod['gpu_type']}")
+    print(f"  GPU: {', '.join(as_list(pod['gpu_type']))}")
     if pod.get("datacenter_id"):
-        print(f"  Datacenter: {pod['datacenter_id']}")
+        print(f"  Datacenter: {', '.join(as_list(pod['datacenter_id']))}")
     print(f"  Image: {pod['image']}")
     if volume.get("network_volume_id"):
         print(
@@ -173,7 +250,162 @@ def print_pod_summary(config: dict) -> None:
     print()
 
 
-def wait_for_ssh(pod_id: str, timeout: int = 300, interval: int = 5) -> str | None:
+def get_api_key() -> str | None:
+    """RUNPOD_API_KEY, or the key runpodctl stores in ~/.runpod/config.toml."""
+    api_key = os.environ.get("RUNPOD_API_KEY")
+    if api_key:
+        return api_key
+    try:
+        with open(RUNPOD_CONFIG_PATH, "rb") as f:
+            return tomllib.load(f).get("apikey") or None
+    except (OSError, tomllib.TOMLDecodeError):
+        return None
+
+
+def graphql(query: str, api_key: str, timeout: float = 10) -> dict:
+    base_url = os.environ.get("RUNPOD_API_BASE_URL", "https://api.runpod.io")
+    request = urllib.request.Request(
+        f"{base_url}/graphql",
+        data=json.dumps({"query": query}).encode(),
+        headers={
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {api_key}",
+        },
+    )
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        body = json.load(response)
+    if body.get("errors"):
+        raise RuntimeError(body["errors"][0].get("message", body["errors"]))
+    return body.get("data") or {}
+
+
+POD_STATUS_QUERY = """
+query {
+  pod(input: {podId: "%s"}) {
+    id
+    desiredStatus
+    runtime {
+      uptimeInSeconds
+      ports { ip isIpPublic privatePort publicPort }
+    }
+  }
+}
+"""
+
+
+def get_pod_status(pod_id: str, api_key: str) -> dict | None:
+    try:
+        return graphql(POD_STATUS_QUERY % pod_id, api_key).get("pod")
+    except (OSError, ValueError, RuntimeError) as e:
+        print(f"  Warning: Failed to get pod status: {e}", file=sys.stderr)
+        return None
+
+
+def ssh_endpoint(pod: dict | None) -> tuple[str, int] | None:
+    """Public (ip, port) mapped to the pod's port 22, once published."""
+    runtime = (pod or {}).get("runtime") or {}
+    for port in runtime.get("ports") or []:
+        if port.get("privatePort") == 22 and port.get("isIpPublic"):
+            return port["ip"], port["publicPort"]
+    return None
+
+
+def probe_ssh(host: str, port: int, timeout: float = 3) -> bool:
+    """True once the port accepts a connection and sends an SSH banner."""
+    try:
+        with socket.create_connection((host, port), timeout=timeout) as sock:
+            sock.settimeout(timeout)
+            return sock.recv(64).startswith(b"SSH-")
+    except OSError:
+        return False
+
+
+def poll(
+    probe: Callable[[], T | None],
+    deadline: float,
+    initial: float,
+    maximum: float,
+) -> T | None:
+    """Call probe with exponential backoff until it returns a value or deadline passes."""
+    delay = initial
+    while True:
+        result = probe()
+        if result is not None:
+            return result
+        if time.monotonic() + delay > deadline:
+            return None
+        time.sleep(delay)
+        delay = min(delay * 1.5, maximum)
+
+
+def wait_for_ssh(
+    pod_id: str, api_key: str, timeout: int = 300, label: str | None = None
+) -> tuple[str, int] | None:
+    """Wait until the pod is running, its SSH port is published, and sshd answers.
+
+    The status query backs off from 1s to 5s. The TCP probe starts as soon as
+    the endpoint is known and retries every 0.25s-2s. Prints the time spent
+    in each phase and returns the (host, port) endpoint. With label (fleet
+    mode), progress lines are prefixed with it and all go to stderr.
+    """
+    prefix = f"[{label}] " if label else ""
+    start = time.monotonic()
+    deadline = start + timeout
+    phases: list[tuple[str, float]] = []
+    pod: dict | None = None
+
+    def mark(phase: str, message: str) -> None:
+        elapsed = time.monotonic() - start - sum(t for _, t in phases)
+        phases.append((phase, elapsed))
+        print(f"  {prefix}{message} (+{elapsed:.1f}s)", file=sys.stderr)
+
+    def running() -> dict | None:
+        nonlocal pod
+        pod = get_pod_status(pod_id, api_key)
+        return pod if pod and pod.get("runtime") else None
+
+    if poll(running, deadline, initial=1, maximum=5) is None:
+        return None
+    mark("running", "Pod running")
+
+    endpoint = ssh_endpoint(pod) or poll(
+        lambda: ssh_endpoint(get_pod_status(pod_id, api_key)),
+        deadline,
+        initial=1,
+        maximum=5,
+    )
+    if endpoint is None:
+        return None
+    mark("endpoint", f"SSH endpoint {endpoint[0]}:{endpoint[1]}")
+
+    if poll(lambda: probe_ssh(*endpoint) or None, deadline, 0.25, 2) is None:
+        return None
+    mark("sshd", "sshd answering")
+
+    breakdown = ", ".join(f"{phase} {t:.1f}s" for phase, t in phases)
+    print(
+        f"{prefix}Ready in {time.monotonic() - start:.1f}s ({breakdown})",
+        file=sys.stderr if label else sys.stdout,
+    )
+    return endpoint
+
+
+def get_ssh_command(pod_id: str, endpoint: tuple[str, int]) -> list[str]:
+    """Ask runpodctl once for the ssh command (it knows the key), else build one."""
+    result = subprocess.run(
+        ["runpodctl", "ssh", "connect", pod_id], capture_output=True, text=True
+    )
+    ssh_cmd = parse_ssh_command(result.stdout + result.stderr)
+    if ssh_cmd:
+        return ssh_cmd
+    host, port = endpoint
+    return ["ssh", f"root@{host}", "-p", str(port)]
+
+
+def poll_runpodctl_ssh(
+    pod_id: str, timeout: int = 300, interval: int = 5
+) -> str | None:
+    """Fallback when no API key is available: poll `runpodctl ssh connect`."""
     start = time.time()
     while time.time() - start < timeout:
         result = subprocess.run(
@@ -193,26 +425,79 @@ def wait_for_ssh(pod_id: str, timeout: int = 300, interval: int = 5) -> str | No
     return None
 
 
-def parse_ssh_command(ssh_info: str) -> list[str]:
+def parse_ssh_command(ssh_info: str) -> list[str] | None:
     for line in ssh_info.splitlines():
         line = line.strip()
         if line.startswith("ssh "):
             return shlex.split(line)
+    return None
 
-    print(
-        f"Error: Could not parse SSH command from output:\n{ssh_info}", file=sys.stderr
+
+def init_script(config: dict, config_dir: Path) -> tuple[bytes, str, str] | None:
+    """(content, remote script path, remote marker path) for init.script.
+
+    Both remote paths are named by the script's content hash, so a changed
+    script is uploaded and run again while an unchanged one is not. The
+    paths are shell expressions ready to embed in a remote command.
+    """
+    script_path = config.get("init", {}).get("script")
+    if not script_path:
+        return None
+    full_path = config_dir / script_path
+    if not full_path.exists():
+        print(f"Error: Init script not found: {full_path}", file=sys.stderr)
+        sys.exit(1)
+    content = full_path.read_bytes()
+    digest = hashlib.sha256(content).hexdigest()[:16]
+
+    volume = config.get("volume", {})
+    script_dir = REMOTE_INIT_DIR
+    if volume.get("network_volume_id"):
+        volume_path = volume.get("volume_path", "/workspace")
+        script_dir = shlex.quote(f"{volume_path}/{VOLUME_INIT_DIR}")
+    return (
+        content,
+        f"{script_dir}/init-{digest}.sh",
+        f"{REMOTE_INIT_DIR}/init-{digest}.done",
     )
-    sys.exit(1)
 
 
-def build_remote_command(config: dict, config_dir: Path) -> str | None:
-    """Build a remote command string from init config."""
+def upload_init_script(ssh_cmd: list[str], content: bytes, remote_path: str) -> bool:
+    """Copy the script over ssh stdin unless the pod already has this version."""
+    remote_dir = remote_path.rsplit("/", 1)[0]
+    command = (
+        f"mkdir -p {REMOTE_INIT_DIR} {remote_dir} && {{ test -f {remote_path} || "
+        f"{{ cat > {remote_path}.$$ && mv {remote_path}.$$ {remote_path}; }}; }}"
+    )
+    result = subprocess.run([*ssh_cmd, command], input=content, capture_output=True)
+    if result.returncode != 0:
+        print(
+            f"Error: Failed to upload init script: {result.stderr.decode().strip()}",
+            file=sys.stderr,
+        )
+        return False
+    return True
+
+
+def with_control_master(ssh_cmd: list[str]) -> list[str]:
+    """Insert SSH_CONTROL_OPTIONS so later ssh calls skip the handshake."""
+    return [ssh_cmd[0], *SSH_CONTROL_OPTIONS, *ssh_cmd[1:]]
+
+
+def build_remote_command(
+    config: dict, config_dir: Path, reinit: bool = False
+) -> str | None:
+    """Build a remote command string from init config.
+
+    The init script itself is not inlined: it is run from the path that
+    upload_init_script copies it to, and skipped when its marker exists.
+    """
     init_config = config.get("init", {})
-    script_path = init_config.get("script")
+    script = init_script(config, config_dir)
     commands = init_config.get("commands", [])
     path_append = config.get("env", {}).get("PATH_APPEND")
 
-    has_init = script_path or commands or path_append
+    has_init = script or commands or path_append
     if not has_init:
         return None
 
@@ -224,13 +509,13 @@ def build_remote_command(config: dict, config_dir: Path) -> str | None:
     if path_append:
         parts.append(f'export PATH="$PATH:{path_append}"')
 
-    if script_path:
-        full_path = config_dir / script_path
-        if not full_path.exists():
-            print(f"Error: Init script not found: {full_path}", file=sys.stderr)
-            sys.exit(1)
-        escaped = shlex.quote(full_path.read_text())
-        parts.append(f"bash -c {escaped}")
+    if script:
+        _, remote_path, marker = script
+        if reinit:
+            parts.append(f"rm -f {marker}")
+        parts.append(
+            f"{{ test -f {marker} || {{ bash {remote_path} && touch {marker}; }}; }}"
+        )
 
     for cmd in commands:
         parts.append(cmd)
@@ -261,13 +546,331 @@ def ssh_in_tmux_window(ssh_cmd: list[str], remote_command: str | None) -> None:
     print("Opened new tmux window with SSH connection.")
 
 
+AVAILABILITY_QUERY = """
+query {
+  dataCenters {
+    id
+    gpuAvailability { gpuTypeId stockStatus }
+  }
+}
+"""
+
+
+def get_availability(api_key: str | None) -> dict[tuple[str, str], int] | None:
+    """(datacenter id, GPU type id) -> stock level, or None if unavailable."""
+    if not api_key:
+        return None
+    try:
+        data = graphql(AVAILABILITY_QUERY, api_key)
+    except (OSError, ValueError, RuntimeError) as e:
+        print(f"Warning: Failed to get GPU availability: {e}", file=sys.stderr)
+        return None
+    return {
+        (dc["id"], avail["gpuTypeId"]): STOCK_LEVELS.get(avail.get("stockStatus"), 0)
+        for dc in data.get("dataCenters") or []
+        for avail in dc.get("gpuAvailability") or []
+    }
+
+
+def stock_level(
+    availability: dict[tuple[str, str], int], gpu_type: str, datacenter: str | None
+) -> int:
+    """Best stock level for a configured GPU type id."""
+    return max(
+        (
+            level
+            for (dc, gpu_id), level in availability.items()
+            if (datacenter is None or dc == datacenter) and gpu_id == gpu_type
+        ),
+        default=0,
+    )
+
+
+def rank_candidates(
+    config: dict, availability: dict[tuple[str, str], int] | None
+) -> list[tuple[str, str | None, int | None]]:
+    """(gpu_type, datacenter_id, stock level) candidates, best stock first.
+
+    Candidates with the same level keep their order in runpod.toml. Without
+    availability data the config order is used as is.
+    """
+    pod = config["pod"]
+    candidates = [
+        (gpu_type, datacenter, None)
+        for gpu_type in as_list(pod["gpu_type"])
+        for datacenter in as_list(pod.get("datacenter_id")) or [None]
+    ]
+    if availability is None or len(candidates) == 1:
+        return candidates
+    ranked = [(g, dc, stock_level(availability, g, dc)) for g, dc, _ in candidates]
+    return sorted(ranked, key=lambda c: -c[2])
+
+
+def candidate_config(config: dict, gpu_type: str, datacenter: str | None) -> dict:
+    resolved = copy.deepcopy(config)
+    resolved["pod"]["gpu_type"] = gpu_type
+    if datacenter:
+        resolved["pod"]["datacenter_id"] = datacenter
+    else:
+        resolved["pod"].pop("datacenter_id", None)
+    return resolved
+
+
+def describe_candidate(gpu_type: str, datacenter: str | None, level: int | None) -> str:
+    text = f"{gpu_type} @ {datacenter or 'any datacenter'}"
+    if level is not None:
+        stock = {v: k for k, v in STOCK_LEVELS.items()}.get(level, "none")
+        text += f" (stock: {stock})"
+    return text
+
+
+def try_candidate(
+    config: dict, candidate: tuple[str, str | None, int | None]
+) -> tuple[dict, str | None, str]:
+    resolved = candidate_config(config, candidate[0], candidate[1])
+    pod_id, output = create_pod(
+        build_create_command(resolved, build_env_vars(resolved))
+    )
+    return resolved, pod_id, output
+
+
+def remove_pod(pod_id: str, prefix: str = "") -> None:
+    result = subprocess.run(
+        ["runpodctl", "remove", "pod", pod_id], capture_output=True, text=True
+    )
+    if result.returncode == 0:
+        print(f"{prefix}Removed extra pod {pod_id}", file=sys.stderr)
+    else:
+        print(
+            f"{prefix}Warning: Failed to remove extra pod {pod_id}; "
+            f"stop it with: runpodctl remove pod {pod_id}",
+            file=sys.stderr,
+        )
+
+
+def create_on_candidates(
+    config: dict,
+    candidates: list[tuple[str, str | None, int | None]],
+    race: int = 1,
+    label: str | None = None,
+) -> tuple[dict, str | None, str]:
+    """Create the pod on the first candidate that has capacity.
+
+    Up to race candidates are tried at the same time, best first. Once one
+    succeeds no more are started, and pods created by attempts that were
+    already in flight are removed. An error that is not about capacity
+    (e.g. a bad image name) stops the fallback. Returns (resolved config,
+    pod id, output of the winning or last failed attempt).
+    """
+    prefix = f"[{label}] " if label else ""
+    pending = list(candidates)
+    winner: tuple[dict, str] | None = None
+    extra_pods: list[str] = []
+    last_output = ""
+
+    try:
+        with ThreadPoolExecutor(max_workers=race) as executor:
+            in_flight = {}
+            while in_flight or (pending and winner is None):
+                while pending and winner is None and len(in_flight) < race:
+                    candidate = pending.pop(0)
+                    print(
+                        f"{prefix}Trying {describe_candidate(*candidate)}...",
+                        file=sys.stderr,
+                    )
+                    future = executor.submit(try_candidate, config, candidate)
+                    in_flight[future] = candidate
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    del in_flight[future]
+                    try:
+                        resolved, pod_id, output = future.result()
+                    except Exception as e:
+                        # e.g. runpodctl missing: not a capacity error, so stop
+                        resolved, pod_id, output = config, None, str(e)
+                    if pod_id and winner is None:
+                        winner = (resolved, pod_id)
+                        last_output = output
+                    elif pod_id:
+                        extra_pods.append(pod_id)
+                    else:
+                        if winner is None:
+                            last_output = output
+                        lines = output.strip().splitlines() or ["(no output)"]
+                        print(f"{prefix}  Failed: {lines[-1]}", file=sys.stderr)
+                        if not CAPACITY_ERROR.search(output):
+                            pending.clear()
+    finally:
+        for pod_id in extra_pods:
+            remove_pod(pod_id, prefix)
+    if winner is None:
+        return config, None, last_output
+    return winner[0], winner[1], last_output
+
+
+def fleet_configs(configs: list[dict], count: int) -> list[dict]:
+    """Expand each config into count pod configs with unique names.
+
+    Names become {pod.name}-01, -02, ... numbered across all configs that
+    share the same name. A single pod keeps its name unchanged.
+    """
+    totals: dict[str, int] = {}
+    for config in configs:
+        name = config["pod"]["name"]
+        totals[name] = totals.get(name, 0) + count
+
+    numbers: dict[str, int] = {}
+    expanded = []
+    for config in configs:
+        name = config["pod"]["name"]
+        for _ in range(count):
+            pod_config = copy.deepcopy(config)
+            if totals[name] > 1:
+                numbers[name] = numbers.get(name, 0) + 1
+                width = max(2, len(str(totals[name])))
+                pod_config["pod"]["name"] = f"{name}-{numbers[name]:0{width}d}"
+            expanded.append(pod_config)
+    return expanded
+
+
+def launch_pod(
+    config: dict,
+    candidates: list[tuple[str, str | None, int | None]],
+    race: int = 1,
+) -> dict:
+    """Create one pod and return its record."""
+    start = time.monotonic()
+    name = config["pod"]["name"]
+    config, pod_id, output = create_on_candidates(config, candidates, race, name)
+    pod = config["pod"]
+    record = {
+        "name": name,
+        "pod_id": pod_id,
+        "gpu_type": ", ".join(as_list(pod["gpu_type"])),
+        "datacenter_id": ", ".join(as_list(pod.get("datacenter_id"))) or None,
+        "status": "failed",
+        "ssh": None,
+        "seconds": None,
+    }
+    if not pod_id:
+        lines = output.strip().splitlines()
+        record["error"] = lines[-1] if lines else None
+    if record["pod_id"]:
+        record["status"] = "created"
+    record["seconds"] = round(time.monotonic() - start, 1)
+    return record
+
+
+def await_pod(record: dict, api_key: str) -> dict:
+    """Wait for a created pod to accept SSH and update its record."""
+    start = time.monotonic()
+    endpoint = wait_for_ssh(record["pod_id"], api_key, label=record["name"])
+    if endpoint:
+        record["status"] = "ready"
+        record["ssh"] = f"{endpoint[0]}:{endpoint[1]}"
+    else:
+        record["status"] = "timeout"
+    record["seconds"] = round(record["seconds"] + time.monotonic() - start, 1)
+    return record
+
+
+def print_fleet_table(records: list[dict]) -> None:
+    print(
+        f"{'Name':<24} {'Pod ID':<16} {'GPU':<24} {'Datacenter':<12} {'Status':<8} "
+        f"{'SSH':<22} {'Time':>7}"
+    )
+    print("-" * 119)
+    for r in records:
+        print(
+            f"{r['name'][:24]:<24} {r['pod_id'] or '-':<16} {r['gpu_type'][:24]:<24} "
+            f"{r['datacenter_id'] or '-':<12} {r['status']:<8} {r['ssh'] or '-':<22} "
+            f"{r['seconds']:>6.1f}s"
+        )
+
+
+def run_fleet(
+    configs: list[dict], parallel: int, wait_ssh: bool, ndjson: bool, race: int = 1
+) -> list[dict]:
+    """Create pods concurrently with a bounded worker pool.
+
+    With wait_ssh, each created pod is handed to a second pool that waits
+    for SSH, so creation slots are freed at once and readiness checks
+    overlap with the remaining creations. With ndjson,
+    each record is printed as soon as its pod finishes; otherwise a table
+    is printed at the end. GPU type / datacenter candidates are ranked once
+    from a single availability query shared by all pods.
+    """
+    api_key = get_api_key()
+    availability = (
+        get_availability(api_key)
+        if any(len(rank_candidates(c, None)) > 1 for c in configs)
+        else None
+    )
+    if wait_ssh and not api_key:
+        print(
+            "Warning: No API key found (RUNPOD_API_KEY or ~/.runpod/config.toml); "
+            "not waiting for SSH",
+            file=sys.stderr,
+        )
+
+    print(f"Creating {len(configs)} pods ({parallel} at a time)...", file=sys.stderr)
+    records = []
+    # Waiting for SSH is mostly sleeping, so every created pod gets a waiter
+    with (
+        ThreadPoolExecutor(max_workers=parallel) as creators,
+        ThreadPoolExecutor(max_workers=len(configs)) as waiters,
+    ):
+        creating = {
+            creators.submit(
+                launch_pod, config, rank_candidates(config, availability), race
+            )
+            for config in configs
+        }
+        waiting = set()
+        while creating or waiting:
+            done, _ = wait(creating | waiting, return_when=FIRST_COMPLETED)
+            for future in done:
+                record = future.result()
+                if future in creating:
+                    creating.remove(future)
+                    if record["pod_id"] and wait_ssh and api_key:
+                        waiting.add(waiters.submit(await_pod, record, api_key))
+                        continue
+                else:
+                    waiting.remove(future)
+                records.append(record)
+                if ndjson:
+                    print(json.dumps(record), flush=True)
+                else:
+                    print(
+                        f"  {record['name']}: {record['status']} "
+                        f"{record['pod_id'] or ''} ({record['seconds']:.1f}s)",
+                        file=sys.stderr,
+                    )
+
+    order = {config["pod"]["name"]: i for i, config in enumerate(configs)}
+    records.sort(key=lambda r: order[r["name"]])
+    if not ndjson:
+        print_fleet_table(records)
+    return records
+
+
+def print_dry_run(config: dict) -> None:
+    """Print the create command for each candidate, in runpod.toml order."""
+    for gpu_type, datacenter, _ in rank_candidates(config, None):
+        resolved = candidate_config(config, gpu_type, datacenter)
+        print(shlex.join(build_create_command(resolved, build_env_vars(resolved))))
+
+
 def main() -> None:
     parser = argparse.ArgumentParser(description="Create a RunPod pod from runpod.toml")
     parser.add_argument(
         "--config",
         "-c",
         metavar="PATH",
-        help="Path to runpod.toml (default: ./runpod.toml)",
+        action="append",
+        help="Path to runpod.toml (default: ./runpod.toml). Repeat for a fleet",
     )
     parser.add_argument(
         "--ssh", action="store_true", help="Wait for pod and connect via SSH"
@@ -275,11 +878,53 @@ def main() -> None:
     parser.add_argument("--name", help="Override pod name")
     parser.add_argument("--gpu", help="Override GPU type")
     parser.add_argument("--datacenter", help="Override datacenter ID")
+    parser.add_argument(
+        "--reinit",
+        action="store_true",
+        help="Run init.script again even if this version already ran on the pod",
+    )
     parser.add_argument(
         "--dry-run", action="store_true", help="Print command without executing"
     )
+    parser.add_argument(
+        "--count",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Create N pods per config, named {name}-01, {name}-02, ...",
+    )
+    parser.add_argument(
+        "--parallel",
+        type=int,
+        default=DEFAULT_PARALLEL,
+        metavar="N",
+        help=f"Fleet mode: pods created at the same time (default: {DEFAULT_PARALLEL})",
+    )
+    parser.add_argument(
+        "--wait",
+        action="store_true",
+        help="Fleet mode: wait until every pod accepts SSH",
+    )
+    parser.add_argument(
+        "--race",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Try the N best GPU type / datacenter candidates at once; extra pods are removed",
+    )
+    parser.add_argument(
+        "--ndjson",
+        action="store_true",
+        help="Fleet mode: print one JSON object per pod instead of a table",
+    )
     args = parser.parse_args()
 
+    if args.count < 1 or args.parallel < 1 or args.race < 1:
+        parser.error("--count, --parallel and --race must be at least 1")
+    fleet = args.count > 1 or len(args.config or []) > 1
+    if fleet and args.ssh:
+        parser.error("--ssh connects to a single pod; use --wait with a fleet")
+
     if not shutil.which("runpodctl"):
         print(
             "Error: runpodctl not found. Install: https://github.com/runpod/runpodctl",
@@ -287,26 +932,54 @@ def main() -> None:
         )
         sys.exit(1)
 
-    config_path = find_config(args.config)
-    config = load_config(config_path)
-    config_dir = config_path.parent
-
-    if args.name:
-        config["pod"]["name"] = args.name
-    if args.gpu:
-        config["pod"]["gpu_type"] = args.gpu
-    if args.datacenter:
-        config["pod"]["datacenter_id"] = args.datacenter
+    config_paths = [find_config(path) for path in args.config or [None]]
+    configs = [load_config(path) for path in config_paths]
+    for config in configs:
+        if args.name:
+            config["pod"]["name"] = args.name
+        if args.gpu:
+            config["pod"]["gpu_type"] = args.gpu.split(",")
+        if args.datacenter:
+            config["pod"]["datacenter_id"] = args.datacenter.split(",")
+    for path, config in zip(config_paths, configs):
+        validate_config(config, path)
+
+    if fleet:
+        pod_configs = fleet_configs(configs, args.count)
+        if args.dry_run:
+            for pod_config in pod_configs:
+                print_dry_run(pod_config)
+            return
+        records = run_fleet(
+            pod_configs, args.parallel, args.wait, args.ndjson, args.race
+        )
+        failed = [r for r in records if r["status"] not in ("created", "ready")]
+        if failed:
+            print(f"\n{len(failed)} of {len(records)} pods failed.", file=sys.stderr)
+            started = [r["pod_id"] for r in failed if r["pod_id"]]
+            if started:
+                print(
+                    f"Pods still running: {' '.join(started)} "
+                    "(remove with runpodctl remove pod <pod_id>)",
+                    file=sys.stderr,
+                )
+            sys.exit(1)
+        return
 
-    env_vars = build_env_vars(config)
-    cmd = build_create_command(config, env_vars)
+    config, config_dir = configs[0], config_paths[0].parent
 
     if args.dry_run:
-        print(shlex.join(cmd))
+        print_dry_run(config)
         return
 
+    api_key = get_api_key()
+    candidates = rank_candidates(config, None)
+    if len(candidates) > 1:
+        candidates = rank_candidates(config, get_availability(api_key))
+
     print_pod_summary(config)
-    pod_id = create_pod(cmd)
+    config, pod_id, output = create_on_candidates(config, candidates, args.race)
+    print(output.rstrip())
 
     if not pod_id:
         print("Failed to create pod or parse pod ID.", file=sys.stderr)
@@ -321,14 +994,30 @@ def main() -> None:
 
     print()
     print("Waiting for SSH to become available...")
-    ssh_info = wait_for_ssh(pod_id)
+    if api_key:
+        endpoint = wait_for_ssh(pod_id, api_key)
+        ssh_cmd = get_ssh_command(pod_id, endpoint) if endpoint else None
+    else:
+        ssh_info = poll_runpodctl_ssh(pod_id)
+        ssh_cmd = parse_ssh_command(ssh_info) if ssh_info else None
+        if ssh_info and not ssh_cmd:
+            print(
+                f"Error: Could not parse SSH command from output:\n{ssh_info}",
+                file=sys.stderr,
+            )
+            sys.exit(1)
 
-    if not ssh_info:
+    if not ssh_cmd:
         print(f"Timed out. Try: runpodctl ssh connect {pod_id}", file=sys.stderr)
         sys.exit(1)
 
-    ssh_cmd = parse_ssh_command(ssh_info)
-    remote_command = build_remote_command(config, config_dir)
+    ssh_cmd = with_control_master(ssh_cmd)
+    script = init_script(config, config_dir)
+    if script and not upload_init_script(ssh_cmd, script[0], script[1]):
+        print(f"Pod {pod_id} is still running.", file=sys.stderr)
+        sys.exit(1)
+
+    remote_command = build_remote_command(config, config_dir, args.reinit)
     use_tmux = config.get("init", {}).get("tmux_window", False)
 
     if use_tmux:
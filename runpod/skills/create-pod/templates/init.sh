@@ -5,6 +5,10 @@
 # This script runs interactively (output is visible).
 # The pod's default startup command is NOT affected.
 #
+# create_pod.py already skips this script when the same version has run
+# on the pod (--reinit forces it). The flag below also covers new pods on
+# the same network volume.
+#
 # Initialization flag: skips re-init on subsequent SSH connections.
 # To re-initialize: rm /workspace/.initialized
 set -euo pipefail
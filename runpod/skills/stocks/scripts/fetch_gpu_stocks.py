@@ -1,7 +1,7 @@
 #!/usr/bin/env -S uv run --script
 # /// script
 # requires-python = ">=3.11"
-# dependencies = ["runpod"]
+# dependencies = ["runpod", "requests"]
 # ///
 """
 RunPod GPU 在庫・データセンター情報を取得するスクリプト
@@ -33,20 +33,100 @@ RunPod GPU 在庫・データセンター情報を取得するスクリプト
 
   # JSON 出力
   uv run --script fetch_gpu_stocks.py --json
+
+  # 必要な列だけを NDJSON / CSV で 1 行ずつ出力 (jq / duckdb などに渡す)
+  uv run --script fetch_gpu_stocks.py --format ndjson --fields datacenter_id,gpu_id,stock_status
+  uv run --script fetch_gpu_stocks.py --format csv --stock high > stocks.csv
+
+  # 在庫をメモリに保持して常に最新に保つ常駐サービスを起動 (127.0.0.1:8790)
+  uv run --script fetch_gpu_stocks.py --serve
+
+  # キャッシュを使わずに取得 / 30 秒より古いキャッシュは使わない
+  uv run --script fetch_gpu_stocks.py --refresh
+  uv run --script fetch_gpu_stocks.py --max-age 30
+
+  # H100 の在庫の変化を 30 秒ごとに監視し、NDJSON で出力
+  uv run --script fetch_gpu_stocks.py --gpu h100 --watch --interval 30
+
+  # Medium 以上になったらコマンドを実行 (イベントの JSON を標準入力に渡す)
+  uv run --script fetch_gpu_stocks.py --gpu b200 --stock medium --watch \
+      --on-available 'notify-send "$RUNPOD_GPU_ID in $RUNPOD_DATACENTER_ID"'
+
+  # 在庫のスナップショットを履歴に追記 (cron などで定期的に実行)
+  uv run --script fetch_gpu_stocks.py --record
+  uv run --script fetch_gpu_stocks.py --watch --interval 300 --record
+
+  # 過去 14 日間に High / Medium だった時間の割合と時間帯ごとの傾向
+  uv run --script fetch_gpu_stocks.py --history --since 14d --gpu h100 --stock medium
+
+キャッシュ:
+  取得結果を $XDG_CACHE_HOME/runpod-stocks/ (default: ~/.cache/runpod-stocks/) に保存する。
+  GPU タイプ (スペック・価格) は 24 時間、在庫は 60 秒有効。
+  期限切れでも一定時間内 (GPU タイプ 7 日, 在庫 15 分) ならキャッシュをすぐに返し、
+  バックグラウンドのプロセスで更新する (stale-while-revalidate)。
+
+履歴:
+  --record で在庫のスナップショットを $XDG_CACHE_HOME/runpod-stocks/history.sqlite に追記する。
+  データセンター・GPU は ID を辞書化し、在庫は 0 (なし) 〜 3 (High) の整数で保存する。
+
+常駐サービス:
+  --serve で起動したサービスが動いていれば、在庫の表示はサービスに問い合わせる
+  (API の取得も runpod SDK の import も行わない)。動いていなければ直接取得する。
+  問い合わせ先は RUNPOD_STOCKS_SERVER (default: http://127.0.0.1:8790)。
+  GET /rows?gpu_keywords=h100&stock_status=high のように compile_filter の引数名で絞り込める。
 """
 
 import argparse
+import csv
 import json
 import os
+import re
+import sqlite3
+import subprocess
 import sys
+import time
 import tomllib
+import urllib.error
+import urllib.request
+from collections.abc import Callable, Iterable, Iterator, Sequence
+from dataclasses import dataclass, fields, replace
+from datetime import datetime, timezone
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from operator import attrgetter, itemgetter
 from pathlib import Path
-
-import runpod
+from urllib.parse import parse_qs, urlencode, urlsplit
 
 
 RUNPOD_CONFIG_PATH = Path.home() / ".runpod" / "config.toml"
 
+# データセットごとの (有効期間, 期限切れ後もキャッシュを返しつつ裏で更新する期間) 秒
+CACHE_POLICIES = {
+    "gpu_types": (24 * 3600, 7 * 24 * 3600),
+    "datacenters": (60, 15 * 60),
+}
+# 更新中のプロセスが異常終了した場合に、ロックを無視するまでの秒数
+REVALIDATE_LOCK_TIMEOUT = 120
+
+# --stock の各レベルで対象になる stockStatus
+STOCK_THRESHOLDS = {
+    "high": {"High"},
+    "medium": {"High", "Medium"},
+    "low": {"High", "Medium", "Low"},
+}
+
+# 履歴に保存する在庫レベル (stockStatus が null または一覧にない場合は 0)
+STOCK_LEVELS = {"Low": 1, "Medium": 2, "High": 3}
+# 履歴の集計で 1 つのスナップショットが代表する最大の秒数 (記録が途切れた期間を数えない)
+MAX_SNAPSHOT_WEIGHT = 3600
+
+# --serve のデフォルトのポートと、クライアントが問い合わせる URL
+DEFAULT_SERVER_PORT = 8790
+DEFAULT_SERVER_URL = f"http://127.0.0.1:{DEFAULT_SERVER_PORT}"
+
+# 出力形式 (ndjson と csv は 1 行ずつ書き出す)
+OUTPUT_FORMATS = ["table", "json", "ndjson", "csv"]
+
 # GPU 世代の分類
 GPU_GENERATIONS = {
     "blackwell": ["B200", "B300", "RTX PRO 6000", "RTX 5090", "RTX 5080"],
@@ -98,41 +178,182 @@ def get_api_key() -> str:
     return ""
 
 
-def fetch_datacenters() -> list[dict]:
-    """データセンター情報を取得 (GPU 在庫含む)"""
-    query = """
-    query {
-      dataCenters {
-        id
-        name
-        location
-        storageSupport
-        gpuAvailability {
-          gpuTypeId
-          stockStatus
-        }
-      }
+DATACENTERS_QUERY = """
+  dataCenters {
+    id
+    name
+    location
+    storageSupport
+    gpuAvailability {
+      gpuTypeId
+      stockStatus
     }
-    """
+  }
+"""
+
+# runpod.get_gpu() が返すフィールドのうち、テーブルで使うもの
+GPU_TYPES_QUERY = """
+  gpuTypes {
+    id
+    displayName
+    memoryInGb
+    secureCloud
+    communityCloud
+    securePrice
+    communityPrice
+    secureSpotPrice
+    communitySpotPrice
+  }
+"""
+
+
+def run_query(*fields: str) -> dict:
+    """複数のトップレベルフィールドを 1 つの GraphQL クエリで取得"""
+    # runpod SDK の import は 1 秒以上かかるため、API を呼ぶときだけ読み込む
+    import runpod
+
+    query = "query {" + "".join(fields) + "}"
     result = runpod.api.graphql.run_graphql_query(query)
-    return result.get("data", {}).get("dataCenters", [])
+    return result.get("data") or {}
+
 
+def index_gpu_types(gpu_types: list[dict]) -> dict[str, dict]:
+    return {gpu["id"]: gpu for gpu in gpu_types}
 
-def fetch_gpu_types() -> dict[str, dict]:
-    """GPU タイプ情報を取得 (価格など)"""
-    gpus = runpod.get_gpus()
-    gpu_details = {}
-    for gpu in gpus:
+
+def setup_api_key() -> None:
+    """API キーを runpod SDK に設定 (見つからなければ終了)"""
+    import runpod
+
+    api_key = get_api_key()
+    if not api_key:
+        print("Error: RUNPOD_API_KEY not found", file=sys.stderr)
+        print(
+            "Set RUNPOD_API_KEY environment variable or configure ~/.runpod/config.toml",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+    runpod.api_key = api_key
+
+
+def fetch_datasets(names: list[str]) -> dict:
+    """指定したデータセット (datacenters / gpu_types) を 1 回のリクエストで取得
+
+    runpod.get_gpu() を GPU ごとに呼ぶと N+1 回の往復になるため、
+    gpuTypes も 1 回のクエリで全件取得する。
+    """
+    queries = {"datacenters": DATACENTERS_QUERY, "gpu_types": GPU_TYPES_QUERY}
+    data = run_query(*(queries[name] for name in names))
+    result = {}
+    if "datacenters" in names:
+        result["datacenters"] = data.get("dataCenters", [])
+    if "gpu_types" in names:
+        result["gpu_types"] = index_gpu_types(data.get("gpuTypes", []))
+    return result
+
+
+def cache_dir() -> Path:
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "runpod-stocks"
+
+
+def read_cache(name: str) -> tuple[object, float] | None:
+    """(データ, 取得時刻) を返す"""
+    path = cache_dir() / f"{name}.json"
+    try:
+        entry = json.loads(path.read_text())
+    except (OSError, ValueError):
+        return None
+    return entry["data"], entry["fetched_at"]
+
+
+def write_cache(name: str, data: object) -> None:
+    """一時ファイルに書いてから rename する (読み込み中のプロセスに壊れたファイルを見せない)"""
+    path = cache_dir() / f"{name}.json"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{name}.{os.getpid()}.tmp")
+    tmp.write_text(json.dumps({"fetched_at": time.time(), "data": data}))
+    os.replace(tmp, path)
+
+
+def spawn_revalidate(names: list[str]) -> None:
+    """期限切れのデータセットを別プロセスで更新する (同じデータセットの更新は 1 つだけ)"""
+    locked = []
+    for name in names:
+        lock = cache_dir() / f"{name}.refreshing"
         try:
-            detail = runpod.get_gpu(gpu["id"])
-            gpu_details[gpu["id"]] = detail
-        except ValueError:
+            if time.time() - lock.stat().st_mtime < REVALIDATE_LOCK_TIMEOUT:
+                continue
+            lock.unlink()
+        except FileNotFoundError:
             pass
-    return gpu_details
+        try:
+            os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            continue
+        locked.append(name)
 
+    if locked:
+        subprocess.Popen(
+            [sys.executable, str(Path(__file__).resolve()), "--revalidate", *locked],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
 
+
+def revalidate(names: list[str]) -> None:
+    """spawn_revalidate から起動され、データセットを取得してキャッシュを更新"""
+    try:
+        setup_api_key()
+        for name, data in fetch_datasets(names).items():
+            write_cache(name, data)
+    finally:
+        for name in names:
+            (cache_dir() / f"{name}.refreshing").unlink(missing_ok=True)
+
+
+def load_stock_data(
+    max_age: float | None = None, refresh: bool = False
+) -> tuple[list[dict], dict[str, dict], float]:
+    """キャッシュを優先してデータセンターと GPU タイプを取得
+
+    有効期間内のキャッシュはそのまま使い、期限切れでも stale-while-revalidate の
+    期間内ならキャッシュを返して裏で更新する。それ以外は取得してキャッシュに保存する。
+    max_age を指定すると、それより古いキャッシュは使わない。
+    3 つ目の値は在庫 (datacenters) を取得した時刻。
+    """
+    now = time.time()
+    data, fetched_at = {}, {}
+    missing, stale = [], []
+    for name, (ttl, stale_ttl) in CACHE_POLICIES.items():
+        if max_age is not None:
+            ttl, stale_ttl = min(ttl, max_age), 0
+        cached = None if refresh else read_cache(name)
+        if cached is None or now - cached[1] >= ttl + stale_ttl:
+            missing.append(name)
+            continue
+        data[name], fetched_at[name] = cached
+        if now - cached[1] >= ttl:
+            stale.append(name)
+
+    if missing:
+        setup_api_key()
+        print("Fetching data...", file=sys.stderr)
+        for name, fetched in fetch_datasets(missing).items():
+            write_cache(name, fetched)
+            data[name], fetched_at[name] = fetched, time.time()
+    if stale:
+        spawn_revalidate(stale)
+
+    return data["datacenters"], data["gpu_types"], fetched_at["datacenters"]
+
+
+@lru_cache(maxsize=None)
 def get_gpu_generation(gpu_id: str) -> str | None:
-    """GPU ID から世代を判定"""
+    """GPU ID から世代を判定 (GPU ID ごとに 1 回だけ判定する)"""
     for gen, keywords in GPU_GENERATIONS.items():
         for keyword in keywords:
             if keyword.lower() in gpu_id.lower():
@@ -140,41 +361,77 @@ def get_gpu_generation(gpu_id: str) -> str | None:
     return None
 
 
+@dataclass(slots=True)
+class StockRow:
+    """データセンター × GPU の 1 行 (履歴など大量の行も扱えるよう __slots__ で保持)"""
+
+    datacenter_id: str
+    datacenter_name: str
+    location: str
+    storage_support: bool
+    gpu_id: str
+    gpu_name: str
+    memory_gb: int | None
+    generation: str | None
+    stock_status: str | None
+    secure_cloud: bool
+    community_cloud: bool
+    secure_price: float | None
+    community_price: float | None
+    secure_spot_price: float | None
+    community_spot_price: float | None
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in ROW_FIELDS}
+
+
+ROW_FIELDS = tuple(f.name for f in fields(StockRow))
+
+
 def build_availability_table(
     datacenters: list[dict],
     gpu_details: dict[str, dict],
-) -> list[dict]:
+) -> list[StockRow]:
     """データセンター × GPU の在庫テーブルを構築"""
-    rows = []
+    return list(iter_availability(datacenters, gpu_details))
+
+
+def iter_availability(
+    datacenters: list[dict],
+    gpu_details: dict[str, dict],
+) -> Iterator[StockRow]:
+    """データセンター × GPU の行を 1 行ずつ生成"""
     for dc in datacenters:
         for avail in dc.get("gpuAvailability", []):
             gpu_id = avail.get("gpuTypeId", "")
-            gpu_info = gpu_details.get(gpu_id, {})
+            yield build_row(dc, gpu_id, avail.get("stockStatus"), gpu_details)
 
-            rows.append(
-                {
-                    "datacenter_id": dc["id"],
-                    "datacenter_name": dc["name"],
-                    "location": dc.get("location", ""),
-                    "storage_support": dc.get("storageSupport", False),
-                    "gpu_id": gpu_id,
-                    "gpu_name": gpu_info.get("displayName", gpu_id),
-                    "memory_gb": gpu_info.get("memoryInGb"),
-                    "generation": get_gpu_generation(gpu_id),
-                    "stock_status": avail.get("stockStatus"),
-                    "secure_cloud": gpu_info.get("secureCloud", False),
-                    "community_cloud": gpu_info.get("communityCloud", False),
-                    "secure_price": gpu_info.get("securePrice"),
-                    "community_price": gpu_info.get("communityPrice"),
-                    "secure_spot_price": gpu_info.get("secureSpotPrice"),
-                    "community_spot_price": gpu_info.get("communitySpotPrice"),
-                }
-            )
-    return rows
+
+def build_row(
+    dc: dict, gpu_id: str, stock_status: str | None, gpu_details: dict[str, dict]
+) -> StockRow:
+    """データセンター × GPU の 1 行を構築"""
+    gpu_info = gpu_details.get(gpu_id, {})
+    return StockRow(
+        dc["id"],
+        dc.get("name", dc["id"]),
+        dc.get("location", ""),
+        dc.get("storageSupport", False),
+        gpu_id,
+        gpu_info.get("displayName", gpu_id),
+        gpu_info.get("memoryInGb"),
+        get_gpu_generation(gpu_id),
+        stock_status,
+        gpu_info.get("secureCloud", False),
+        gpu_info.get("communityCloud", False),
+        gpu_info.get("securePrice"),
+        gpu_info.get("communityPrice"),
+        gpu_info.get("secureSpotPrice"),
+        gpu_info.get("communitySpotPrice"),
+    )
 
 
-def filter_rows(
-    rows: list[dict],
+def compile_filter(
     min_memory: int | None = None,
     gpu_keywords: list[str] | None = None,
     storage_only: bool = False,
@@ -182,50 +439,645 @@ def filter_rows(
     generation: str | None = None,
     secure_cloud: bool = False,
     community_cloud: bool = False,
-) -> list[dict]:
-    """条件に基づいてフィルタ"""
-    result = rows
+) -> Callable[[StockRow], bool]:
+    """条件を 1 つの述語にまとめる
+
+    キーワードの小文字化などの前処理は 1 回だけ行い、GPU 名の部分一致は
+    GPU ID ごとに結果をキャッシュする。指定された条件だけを順に評価する。
+    """
+    checks: list[Callable[[StockRow], bool]] = []
 
     if min_memory is not None:
-        result = [
-            r for r in result if r.get("memory_gb") and r["memory_gb"] >= min_memory
-        ]
+        checks.append(lambda r: bool(r.memory_gb) and r.memory_gb >= min_memory)
 
     if gpu_keywords:
         keywords_lower = [k.lower() for k in gpu_keywords]
-        result = [
-            r
-            for r in result
-            if any(
-                kw in r.get("gpu_id", "").lower() or kw in r.get("gpu_name", "").lower()
-                for kw in keywords_lower
+
+        @lru_cache(maxsize=None)
+        def match_gpu(gpu_id: str, gpu_name: str) -> bool:
+            return any(
+                kw in gpu_id.lower() or kw in gpu_name.lower() for kw in keywords_lower
             )
-        ]
+
+        checks.append(lambda r: match_gpu(r.gpu_id, r.gpu_name))
 
     if storage_only:
-        result = [r for r in result if r.get("storage_support")]
-
-    if stock_status:
-        status_lower = stock_status.lower()
-        if status_lower == "high":
-            result = [r for r in result if r.get("stock_status") == "High"]
-        elif status_lower == "medium":
-            result = [r for r in result if r.get("stock_status") in ["High", "Medium"]]
-        elif status_lower == "low":
-            result = [
-                r for r in result if r.get("stock_status") in ["High", "Medium", "Low"]
-            ]
+        checks.append(lambda r: r.storage_support)
+
+    accepted = STOCK_THRESHOLDS.get(stock_status.lower()) if stock_status else None
+    if accepted:
+        checks.append(lambda r: r.stock_status in accepted)
 
     if generation:
-        result = [r for r in result if r.get("generation") == generation.lower()]
+        generation = generation.lower()
+        checks.append(lambda r: r.generation == generation)
 
     if secure_cloud:
-        result = [r for r in result if r.get("secure_cloud")]
+        checks.append(lambda r: r.secure_cloud)
 
     if community_cloud:
-        result = [r for r in result if r.get("community_cloud")]
+        checks.append(lambda r: r.community_cloud)
+
+    def predicate(row: StockRow) -> bool:
+        for check in checks:
+            if not check(row):
+                return False
+        return True
+
+    return predicate
+
+
+def parse_since(value: str) -> float:
+    """ISO 形式の日時、または 30m / 12h / 7d のような現在からの相対時間を UNIX 時刻に変換"""
+    m = re.fullmatch(r"(\d+)([smhd])", value)
+    if m:
+        unit = {"s": 1, "m": 60, "h": 3600, "d": 86400}[m.group(2)]
+        return time.time() - int(m.group(1)) * unit
+    parsed = datetime.fromisoformat(value)
+    return (parsed if parsed.tzinfo else parsed.astimezone()).timestamp()
+
+
+class StockHistory:
+    """在庫スナップショットの時系列 (SQLite)
+
+    データセンター・GPU の ID は別テーブルで整数に辞書化し、在庫は STOCK_LEVELS の
+    整数で (datacenter, gpu, time) を主キーに保存する。スナップショットの時刻は
+    snapshots に記録し、一覧に現れなかった組み合わせは在庫なしとして扱う。
+    """
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS datacenters (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL UNIQUE
+            );
+            CREATE TABLE IF NOT EXISTS gpus (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL UNIQUE
+            );
+            CREATE TABLE IF NOT EXISTS snapshots (
+                time INTEGER PRIMARY KEY
+            );
+            CREATE TABLE IF NOT EXISTS stock (
+                datacenter INTEGER NOT NULL,
+                gpu INTEGER NOT NULL,
+                time INTEGER NOT NULL,
+                level INTEGER NOT NULL,
+                PRIMARY KEY (datacenter, gpu, time)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS stock_time ON stock (time);
+            """
+        )
+
+    def intern(self, table: str, names: set[str]) -> dict[str, int]:
+        """名前 -> 整数 ID (未登録なら追加)"""
+        self.conn.executemany(
+            f"INSERT OR IGNORE INTO {table} (name) VALUES (?)",
+            [(name,) for name in names],
+        )
+        return {name: id for id, name in self.conn.execute(f"SELECT * FROM {table}")}
+
+    def record(
+        self, availability: dict[tuple[str, str], str | None], fetched_at: float
+    ) -> bool:
+        """スナップショットを追記する。同じ時刻のスナップショットが記録済みなら何もしない"""
+        snapshot = int(fetched_at)
+        with self.conn:
+            inserted = self.conn.execute(
+                "INSERT OR IGNORE INTO snapshots VALUES (?)", (snapshot,)
+            ).rowcount
+            if not inserted:
+                return False
+            dc_ids = self.intern("datacenters", {dc for dc, _ in availability})
+            gpu_ids = self.intern("gpus", {gpu for _, gpu in availability})
+            self.conn.executemany(
+                "INSERT INTO stock VALUES (?, ?, ?, ?)",
+                [
+                    (dc_ids[dc], gpu_ids[gpu], snapshot, STOCK_LEVELS.get(status, 0))
+                    for (dc, gpu), status in availability.items()
+                ],
+            )
+        return True
+
+    def summarize(self, since: float, min_level: int) -> tuple[int, list[dict]]:
+        """(スナップショット数, データセンター × GPU ごとの集計) を返す
+
+        各スナップショットは次のスナップショットまでの時間 (最大 MAX_SNAPSHOT_WEIGHT 秒) を
+        代表するものとして重み付けし、在庫レベルごとの時間の割合と、ローカル時刻の
+        時間帯 (0-23 時) ごとに min_level 以上だった時間の割合を求める。
+        """
+        self.conn.execute("DROP TABLE IF EXISTS temp.weights")
+        self.conn.execute(
+            """
+            CREATE TEMP TABLE weights AS
+            SELECT
+                time,
+                CAST(strftime('%H', time, 'unixepoch', 'localtime') AS INTEGER) AS hour,
+                MAX(MIN(COALESCE(LEAD(time) OVER (ORDER BY time), :now) - time, :cap), 1)
+                    AS weight
+            FROM snapshots WHERE time >= :since
+            """,
+            {"now": int(time.time()), "cap": MAX_SNAPSHOT_WEIGHT, "since": int(since)},
+        )
+        count, total = self.conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(weight), 0) FROM weights"
+        ).fetchone()
+        hour_totals = dict(
+            self.conn.execute("SELECT hour, SUM(weight) FROM weights GROUP BY hour")
+        )
+
+        summaries: dict[tuple[str, str], dict] = {}
+        rows = self.conn.execute(
+            """
+            SELECT d.name, g.name, s.level, w.hour, SUM(w.weight)
+            FROM stock AS s
+            JOIN weights AS w USING (time)
+            JOIN datacenters AS d ON d.id = s.datacenter
+            JOIN gpus AS g ON g.id = s.gpu
+            GROUP BY s.datacenter, s.gpu, s.level, w.hour
+            """
+        )
+        for dc, gpu, level, hour, weight in rows:
+            summary = summaries.setdefault(
+                (dc, gpu), {"levels": [0] * 4, "hours": [0] * 24}
+            )
+            summary["levels"][level] += weight
+            if level >= min_level:
+                summary["hours"][hour] += weight
+
+        results = []
+        for (dc, gpu), summary in summaries.items():
+            levels = summary["levels"]
+            levels[0] += total - sum(levels)
+            results.append(
+                {
+                    "datacenter_id": dc,
+                    "gpu_id": gpu,
+                    **{
+                        name: round(levels[level] / total, 4)
+                        for name, level in (("high", 3), ("medium", 2), ("low", 1))
+                    },
+                    "none": round(levels[0] / total, 4),
+                    "available": round(sum(levels[min_level:]) / total, 4),
+                    "by_hour": [
+                        round(summary["hours"][hour] / hour_totals[hour], 4)
+                        if hour in hour_totals
+                        else None
+                        for hour in range(24)
+                    ],
+                }
+            )
+        return count, results
+
+
+# --history の行の列 (stock_status の代わりに在庫レベルごとの割合が入る)
+HISTORY_FIELDS = tuple(f for f in ROW_FIELDS if f != "stock_status") + (
+    "high",
+    "medium",
+    "low",
+    "none",
+    "available",
+    "by_hour",
+)
+
+
+def history_path() -> Path:
+    return cache_dir() / "history.sqlite"
+
+
+def history_rows(
+    summaries: list[dict],
+    datacenters: list[dict],
+    gpu_details: dict[str, dict],
+    filters: dict,
+) -> list[dict]:
+    """集計結果に GPU・データセンター情報を付け、在庫以外の条件でフィルタ"""
+    dc_by_id = {dc["id"]: dc for dc in datacenters}
+    predicate = compile_filter(**{**filters, "stock_status": None})
+    rows = []
+    for summary in summaries:
+        dc = dc_by_id.get(summary["datacenter_id"], {"id": summary["datacenter_id"]})
+        row = build_row(dc, summary["gpu_id"], None, gpu_details)
+        if predicate(row):
+            row = row.to_dict()
+            del row["stock_status"]
+            rows.append({**row, **summary})
+    return sorted(
+        rows,
+        key=lambda r: (-r["available"], -(r["memory_gb"] or 0), r["datacenter_id"]),
+    )
+
+
+def format_hours(by_hour: list[float | None]) -> str:
+    """時間帯ごとの割合を 0-23 時の 24 文字のグラフにする (記録のない時間帯は ·)"""
+    bars = " ▁▂▃▄▅▆▇█"
+    return "".join(
+        "·" if value is None else bars[round(value * (len(bars) - 1))]
+        for value in by_hour
+    )
+
+
+def print_history(rows: list[dict], snapshots: int, stock: str) -> None:
+    """履歴の集計をテーブル形式で出力"""
+    if not rows:
+        print("No matching history. Record snapshots with --record first.")
+        return
+
+    levels = "+".join(
+        sorted(STOCK_THRESHOLDS[stock], key=STOCK_LEVELS.get, reverse=True)
+    )
+    print(
+        f"{'Datacenter':<12} {'GPU':<25} {'Mem':>6} {'High':>5} {'Med':>5} {'Low':>5} "
+        f"{'None':>5}  {levels + ' by hour (0-23)'}"
+    )
+    print("-" * 105)
+    for r in rows:
+        gpu = (r.get("gpu_name") or r["gpu_id"])[:25]
+        mem = f"{r['memory_gb']}GB" if r.get("memory_gb") else "N/A"
+        shares = " ".join(
+            f"{r[name] * 100:>4.0f}%" for name in ("high", "medium", "low", "none")
+        )
+        print(
+            f"{r['datacenter_id']:<12} {gpu:<25} {mem:>6} {shares}  "
+            f"{format_hours(r['by_hour'])}"
+        )
+    print(f"\n{snapshots} snapshots, {len(rows)} datacenter × GPU combinations")
+
+
+AVAILABILITY_QUERY = """
+query {
+  dataCenters {
+    id
+    gpuAvailability {
+      gpuTypeId
+      stockStatus
+    }
+  }
+}
+"""
+
+
+class AvailabilityClient:
+    """在庫フィールドだけを 1 本の接続 (keep-alive) で繰り返し取得する"""
+
+    def __init__(self, api_key: str):
+        import requests
+
+        base_url = os.environ.get("RUNPOD_API_BASE_URL", "https://api.runpod.io")
+        self.url = f"{base_url}/graphql"
+        self.session = requests.Session()
+        self.session.headers["Authorization"] = f"Bearer {api_key}"
+
+    def fetch(self) -> dict[tuple[str, str], str | None]:
+        """(datacenter_id, gpu_id) -> stockStatus"""
+        response = self.session.post(
+            self.url, json={"query": AVAILABILITY_QUERY}, timeout=30
+        )
+        response.raise_for_status()
+        body = response.json()
+        if "errors" in body:
+            raise RuntimeError(body["errors"][0].get("message", body["errors"]))
+        return {
+            (dc["id"], avail["gpuTypeId"]): avail.get("stockStatus")
+            for dc in body["data"]["dataCenters"]
+            for avail in dc.get("gpuAvailability") or []
+        }
+
+
+def stock_event(event: str, row: StockRow, previous: str | None) -> dict:
+    return {
+        "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "event": event,
+        "datacenter_id": row.datacenter_id,
+        "location": row.location,
+        "gpu_id": row.gpu_id,
+        "gpu_name": row.gpu_name,
+        "memory_gb": row.memory_gb,
+        "previous": previous,
+        "stock_status": row.stock_status,
+    }
+
+
+def run_hook(command: str, event: dict) -> subprocess.Popen:
+    """イベントを環境変数と標準入力 (JSON) で渡してコマンドを実行 (終了は待たない)"""
+    env = {
+        **os.environ,
+        "RUNPOD_DATACENTER_ID": event["datacenter_id"],
+        "RUNPOD_GPU_ID": event["gpu_id"],
+        "RUNPOD_STOCK_STATUS": event["stock_status"] or "",
+    }
+    process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, env=env)
+    # 標準入力を読まずに終了するフックでも監視は続ける
+    try:
+        process.stdin.write(json.dumps(event).encode() + b"\n")
+        process.stdin.close()
+    except OSError as e:
+        print(f"Warning: Failed to write event to hook: {e}", file=sys.stderr)
+    return process
+
+
+def watch_stock(
+    datacenters: list[dict],
+    gpu_details: dict[str, dict],
+    filters: dict,
+    interval: float,
+    on_available: str | None = None,
+    history: StockHistory | None = None,
+) -> None:
+    """在庫を定期的に取得し、フィルタに合う行の stock_status の変化を NDJSON で出力
+
+    最初の取得では対象の行を initial イベントとして出力し、以降は変化した行だけを
+    change イベントとして出力する。--stock を指定した場合は、変化の前後どちらかが
+    その在庫レベルを満たす行だけが対象になる。history を渡すと毎回の取得結果を追記する。
+    """
+    stock = filters.pop("stock_status", None)
+    accepted = STOCK_THRESHOLDS[stock or "low"]
+    dc_by_id = {dc["id"]: dc for dc in datacenters}
+    predicate = compile_filter(**filters)
+    client = AvailabilityClient(get_api_key())
+    previous: dict[tuple[str, str], StockRow] | None = None
+    hooks: list[subprocess.Popen] = []
+    import requests
+
+    while True:
+        started = time.monotonic()
+        try:
+            availability = client.fetch()
+        except (requests.RequestException, RuntimeError, KeyError) as e:
+            print(f"Warning: Failed to fetch availability: {e}", file=sys.stderr)
+            time.sleep(interval)
+            continue
+        if history:
+            history.record(availability, time.time())
+
+        rows = (
+            build_row(dc_by_id.get(dc_id, {"id": dc_id}), gpu_id, status, gpu_details)
+            for (dc_id, gpu_id), status in availability.items()
+        )
+        current = {(r.datacenter_id, r.gpu_id): r for r in rows if predicate(r)}
+
+        events = []
+        if previous is None:
+            events = [
+                stock_event("initial", row, None)
+                for row in current.values()
+                if not stock or row.stock_status in accepted
+            ]
+        else:
+            for key in current.keys() | previous.keys():
+                old = previous[key].stock_status if key in previous else None
+                row = current.get(key) or replace(previous[key], stock_status=None)
+                new = row.stock_status
+                if old != new and (old in accepted or new in accepted):
+                    events.append(stock_event("change", row, old))
+
+        for event in events:
+            print(json.dumps(event, ensure_ascii=False), flush=True)
+            became_available = event["stock_status"] in accepted and (
+                event["previous"] not in accepted
+            )
+            if on_available and became_available and event["event"] == "change":
+                hooks.append(run_hook(on_available, event))
+
+        hooks = [p for p in hooks if p.poll() is None]
+        previous = current
+        time.sleep(max(0, interval - (time.monotonic() - started)))
 
-    return result
+
+def write_records(
+    records: Iterable, fmt: str, columns: Sequence[str], getter=attrgetter
+) -> None:
+    """json / ndjson / csv で columns の列だけを出力
+
+    ndjson と csv は行を受け取るたびに書き出すため、全行をメモリに溜めない。
+    getter は行から列の値を取り出す関数 (StockRow は attrgetter, dict は itemgetter)。
+    """
+    get_values = getter(*columns)
+    get = get_values if len(columns) > 1 else (lambda r: (get_values(r),))
+
+    out = sys.stdout
+    try:
+        if fmt == "json":
+            out.write(
+                json.dumps([dict(zip(columns, get(r))) for r in records], indent=2)
+                + "\n"
+            )
+        elif fmt == "ndjson":
+            for r in records:
+                out.write(json.dumps(dict(zip(columns, get(r))), ensure_ascii=False))
+                out.write("\n")
+        elif fmt == "csv":
+            writer = csv.writer(out, lineterminator="\n")
+            writer.writerow(columns)
+            for r in records:
+                writer.writerow(
+                    json.dumps(v) if isinstance(v, list) else v for v in get(r)
+                )
+        out.flush()
+    except BrokenPipeError:
+        # head などが途中で読むのをやめた場合は静かに終了する
+        os.dup2(os.open(os.devnull, os.O_WRONLY), out.fileno())
+
+
+class StockService:
+    """在庫テーブルをメモリに保持し、バックグラウンドで更新し続ける
+
+    在庫は interval 秒ごと、GPU タイプは CACHE_POLICIES の有効期間ごとに取得し、
+    取得結果はキャッシュにも書き込む (サービスを止めても CLI がすぐに使える)。
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.rows: list[StockRow] = []
+        self.fetched_at: float | None = None
+        self.gpu_details: dict[str, dict] = {}
+        self.gpu_fetched_at = 0.0
+        self.last_error: str | None = None
+
+    def refresh(self) -> None:
+        names = ["datacenters"]
+        if time.time() - self.gpu_fetched_at >= CACHE_POLICIES["gpu_types"][0]:
+            names.append("gpu_types")
+        data = fetch_datasets(names)
+        for name, fetched in data.items():
+            write_cache(name, fetched)
+        if "gpu_types" in data:
+            self.gpu_details = data["gpu_types"]
+            self.gpu_fetched_at = time.time()
+        # 参照を差し替えるだけなので、問い合わせ中のスレッドは古い表を最後まで使える
+        self.rows = build_availability_table(data["datacenters"], self.gpu_details)
+        self.fetched_at = time.time()
+
+    def run(self) -> None:
+        while True:
+            started = time.monotonic()
+            try:
+                self.refresh()
+                self.last_error = None
+            except Exception as e:
+                self.last_error = str(e)
+                print(f"Warning: Failed to refresh stock: {e}", file=sys.stderr)
+            time.sleep(max(0, self.interval - (time.monotonic() - started)))
+
+    def query(self, filters: dict) -> list[StockRow]:
+        predicate = compile_filter(**filters)
+        return [r for r in self.rows if predicate(r)]
+
+    def status(self) -> dict:
+        """応答に含める取得時刻・更新間隔・直近の更新エラー"""
+        return {
+            "fetched_at": self.fetched_at,
+            "interval": self.interval,
+            "last_error": self.last_error,
+        }
+
+
+def filters_from_query(params: dict[str, list[str]]) -> dict:
+    """クエリ文字列を compile_filter の引数に変換 (値が不正なら ValueError)"""
+
+    def last(name: str) -> str | None:
+        return params[name][-1] if name in params else None
+
+    def flag(name: str) -> bool:
+        return (last(name) or "").lower() in ("1", "true", "yes")
+
+    min_memory = last("min_memory")
+    stock_status = last("stock_status")
+    generation = last("generation")
+    if stock_status and stock_status.lower() not in STOCK_THRESHOLDS:
+        raise ValueError(f"unknown stock_status: {stock_status}")
+    if generation and generation.lower() not in GPU_GENERATIONS:
+        raise ValueError(f"unknown generation: {generation}")
+    return {
+        "min_memory": int(min_memory) if min_memory else None,
+        "gpu_keywords": [
+            k for v in params.get("gpu_keywords", []) for k in v.split(",") if k
+        ]
+        or None,
+        "storage_only": flag("storage_only"),
+        "stock_status": stock_status,
+        "generation": generation,
+        "secure_cloud": flag("secure_cloud"),
+        "community_cloud": flag("community_cloud"),
+    }
+
+
+class StockRequestHandler(BaseHTTPRequestHandler):
+    """GET /rows?<compile_filter の引数> と GET /health に答える"""
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        service: StockService = self.server.service
+        if url.path == "/health":
+            self.send_json({**service.status(), "rows": len(service.rows)})
+            return
+        if url.path != "/rows":
+            self.send_error(404)
+            return
+        try:
+            filters = filters_from_query(parse_qs(url.query))
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        if service.fetched_at is None:
+            self.send_error(503, "Stock data is not loaded yet")
+            return
+        rows = service.query(filters)
+        self.send_json({**service.status(), "rows": [r.to_dict() for r in rows]})
+
+    def send_json(self, data: dict) -> None:
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port: int, interval: float) -> None:
+    """127.0.0.1 で在庫サービスを起動 (Ctrl-C で終了)"""
+    import threading
+
+    service = StockService(interval)
+    server = ThreadingHTTPServer(("127.0.0.1", port), StockRequestHandler)
+    server.service = service
+    threading.Thread(target=service.run, daemon=True).start()
+    print(f"Serving stock on http://127.0.0.1:{port}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def query_server(filters: dict, max_age: float | None = None) -> list[StockRow] | None:
+    """常駐サービスにフィルタ済みの行を問い合わせる
+
+    サービスが起動していない・応答しない、応答がサービスの形式でない (同じポートで
+    別のプロセスが応答した場合など)、または max_age より古いデータしか持っていない
+    場合は None を返す (呼び出し側で直接取得する)。
+    max_age を指定しなくても、在庫の有効期間 (更新間隔がそれより長ければその 2 倍)
+    を過ぎたデータは、サービスの更新が失敗し続けているとみなして警告し、使わない。
+    """
+    params = {
+        name: value
+        if isinstance(value, list)
+        else str(int(value) if value is True else value)
+        for name, value in filters.items()
+        if value is not None and value is not False
+    }
+    base_url = os.environ.get("RUNPOD_STOCKS_SERVER", DEFAULT_SERVER_URL)
+    # localhost への問い合わせに HTTP(S)_PROXY を使わない
+    opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+    try:
+        with opener.open(
+            f"{base_url}/rows?{urlencode(params, doseq=True)}", timeout=2
+        ) as response:
+            body = json.load(response)
+    except (OSError, ValueError):
+        return None
+    if not (
+        isinstance(body, dict)
+        and isinstance(body.get("fetched_at"), (int, float))
+        and isinstance(body.get("interval", 0), (int, float))
+        and isinstance(body.get("rows"), list)
+    ):
+        return None
+    try:
+        rows = [StockRow(**row) for row in body["rows"]]
+    except TypeError:
+        return None
+    age = time.time() - body["fetched_at"]
+    if max_age is not None and age > max_age:
+        return None
+    ttl = max(CACHE_POLICIES["datacenters"][0], 2 * body.get("interval", 0))
+    if age > ttl:
+        error = body.get("last_error")
+        print(
+            f"Warning: Stock service data is {age:.0f}s old"
+            + (f" (last refresh failed: {error})" if error else "")
+            + "; fetching directly",
+            file=sys.stderr,
+        )
+        return None
+    return rows
+
+
+def output_rows(rows: Iterable[StockRow], fmt: str, columns: Sequence[str]) -> None:
+    if fmt == "table":
+        rows = list(rows)
+        print_table(rows)
+        print_summary(rows)
+    else:
+        write_records(rows, fmt, columns)
 
 
 def format_price(price: float | None) -> str:
@@ -234,7 +1086,7 @@ def format_price(price: float | None) -> str:
     return f"${price:.2f}"
 
 
-def print_table(rows: list[dict]) -> None:
+def print_table(rows: list[StockRow]) -> None:
     """テーブル形式で出力"""
     if not rows:
         print("No results found.")
@@ -247,33 +1099,31 @@ def print_table(rows: list[dict]) -> None:
     print("-" * 105)
 
     # メモリ降順、データセンター名でソート
-    sorted_rows = sorted(
-        rows, key=lambda r: (-(r.get("memory_gb") or 0), r["datacenter_id"])
-    )
+    sorted_rows = sorted(rows, key=lambda r: (-(r.memory_gb or 0), r.datacenter_id))
 
     for r in sorted_rows:
-        dc = r["datacenter_id"]
-        loc = r.get("location", "")[:15]
-        gpu = (r.get("gpu_name") or r.get("gpu_id", ""))[:25]
-        mem = f"{r['memory_gb']}GB" if r.get("memory_gb") else "N/A"
-        gen = (r.get("generation") or "-")[:9]
-        stock = (r.get("stock_status") or "-")[:6]
-        storage = "✓" if r.get("storage_support") else "-"
-        price = format_price(r.get("community_price") or r.get("secure_price"))
+        dc = r.datacenter_id
+        loc = (r.location or "")[:15]
+        gpu = (r.gpu_name or r.gpu_id)[:25]
+        mem = f"{r.memory_gb}GB" if r.memory_gb else "N/A"
+        gen = (r.generation or "-")[:9]
+        stock = (r.stock_status or "-")[:6]
+        storage = "✓" if r.storage_support else "-"
+        price = format_price(r.community_price or r.secure_price)
 
         print(
             f"{dc:<12} {loc:<15} {gpu:<25} {mem:>6} {gen:<9} {stock:>6} {storage:>7} {price:>8}"
         )
 
 
-def print_summary(rows: list[dict]) -> None:
+def print_summary(rows: list[StockRow]) -> None:
     """サマリーを出力"""
     if not rows:
         return
 
     # ユニークなデータセンターと GPU をカウント
-    datacenters = set(r["datacenter_id"] for r in rows)
-    gpus = set(r["gpu_id"] for r in rows)
+    datacenters = set(r.datacenter_id for r in rows)
+    gpus = set(r.gpu_id for r in rows)
 
     print(
         f"\nFound {len(rows)} options across {len(datacenters)} datacenters, {len(gpus)} GPU types"
@@ -304,31 +1154,105 @@ def main():
     parser.add_argument(
         "--community-cloud", action="store_true", help="Community Cloud 対応のみ"
     )
-    parser.add_argument("--json", action="store_true", help="JSON 形式で出力")
+    parser.add_argument(
+        "--format",
+        choices=OUTPUT_FORMATS,
+        default="table",
+        help="出力形式 (ndjson / csv は 1 行ずつ出力, default: table)",
+    )
+    parser.add_argument(
+        "--json", action="store_true", help="JSON 形式で出力 (--format json と同じ)"
+    )
+    parser.add_argument(
+        "--fields",
+        metavar="FIELD,...",
+        help="json / ndjson / csv で出力する列 (カンマ区切り, default: 全列)",
+    )
+    parser.add_argument(
+        "--max-age",
+        type=float,
+        metavar="SECONDS",
+        help="これより古いキャッシュは使わない (期限切れキャッシュの即時返却もしない)",
+    )
+    parser.add_argument(
+        "--refresh", action="store_true", help="キャッシュを使わずに取得"
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="在庫を定期的に取得し、stock_status の変化を NDJSON で出力し続ける",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=60,
+        metavar="SECONDS",
+        help="--watch の取得間隔 (default: 60)",
+    )
+    parser.add_argument(
+        "--on-available",
+        metavar="COMMAND",
+        help="--watch で在庫が --stock のレベル (default: low) を満たすようになったら実行するコマンド",
+    )
+    parser.add_argument(
+        "--record",
+        action="store_true",
+        help="在庫のスナップショットを履歴に追記 (--watch では取得のたびに追記)",
+    )
+    parser.add_argument(
+        "--history",
+        action="store_true",
+        help="履歴から在庫レベルごとの時間の割合と時間帯ごとの傾向を出力",
+    )
+    parser.add_argument(
+        "--since",
+        default="7d",
+        help="--history の集計期間の開始 (ISO 形式 or 30m / 12h / 7d, default: 7d)",
+    )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="在庫をメモリに保持し --interval ごとに更新する常駐サービスを起動",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=DEFAULT_SERVER_PORT,
+        help=f"--serve のポート (default: {DEFAULT_SERVER_PORT})",
+    )
+    parser.add_argument(
+        "--revalidate",
+        nargs="+",
+        choices=list(CACHE_POLICIES),
+        help=argparse.SUPPRESS,
+    )
     args = parser.parse_args()
 
-    api_key = get_api_key()
-    if not api_key:
-        print("Error: RUNPOD_API_KEY not found", file=sys.stderr)
-        print(
-            "Set RUNPOD_API_KEY environment variable or configure ~/.runpod/config.toml",
-            file=sys.stderr,
-        )
-        sys.exit(1)
-
-    runpod.api_key = api_key
+    if args.revalidate:
+        revalidate(args.revalidate)
+        return
 
-    # データ取得
-    print("Fetching data...", file=sys.stderr)
-    datacenters = fetch_datacenters()
-    gpu_details = fetch_gpu_types()
+    if args.json:
+        args.format = "json"
+    available_fields = HISTORY_FIELDS if args.history else ROW_FIELDS
+    columns = available_fields
+    if args.fields:
+        if args.format == "table":
+            parser.error("--fields requires --format json, ndjson or csv")
+        columns = [f.strip() for f in args.fields.split(",") if f.strip()]
+        unknown = [f for f in columns if f not in available_fields]
+        if unknown:
+            parser.error(
+                f"unknown fields: {', '.join(unknown)} "
+                f"(available: {', '.join(available_fields)})"
+            )
 
-    # テーブル構築
-    rows = build_availability_table(datacenters, gpu_details)
+    if args.serve:
+        setup_api_key()
+        serve(args.port, args.interval)
+        return
 
-    # フィルタ
-    filtered = filter_rows(
-        rows,
+    filters = dict(
         min_memory=args.min_memory,
         gpu_keywords=args.gpu,
         storage_only=args.storage,
@@ -338,11 +1262,59 @@ def main():
         community_cloud=args.community_cloud,
     )
 
-    if args.json:
-        print(json.dumps(filtered, indent=2))
-    else:
-        print_table(filtered)
-        print_summary(filtered)
+    # 常駐サービスが動いていれば問い合わせるだけで済ませる
+    if not (args.history or args.watch or args.record or args.refresh):
+        rows = query_server(filters, args.max_age)
+        if rows is not None:
+            output_rows(rows, args.format, columns)
+            return
+
+    # データ取得
+    datacenters, gpu_details, fetched_at = load_stock_data(args.max_age, args.refresh)
+
+    if args.history:
+        stock = args.stock or "medium"
+        min_level = min(STOCK_LEVELS[s] for s in STOCK_THRESHOLDS[stock])
+        snapshots, summaries = StockHistory(history_path()).summarize(
+            parse_since(args.since), min_level
+        )
+        rows = history_rows(summaries, datacenters, gpu_details, filters)
+        if args.format == "table":
+            print_history(rows, snapshots, stock)
+        else:
+            write_records(rows, args.format, columns, itemgetter)
+        return
+
+    history = StockHistory(history_path()) if args.record else None
+
+    if args.watch:
+        setup_api_key()
+        try:
+            watch_stock(
+                datacenters,
+                gpu_details,
+                filters,
+                args.interval,
+                args.on_available,
+                history,
+            )
+        except KeyboardInterrupt:
+            pass
+        return
+
+    if history:
+        availability = {
+            (dc["id"], avail.get("gpuTypeId", "")): avail.get("stockStatus")
+            for dc in datacenters
+            for avail in dc.get("gpuAvailability", [])
+        }
+        if not history.record(availability, fetched_at):
+            print("Snapshot already recorded (cached data)", file=sys.stderr)
+
+    # テーブル構築・フィルタ (table 以外は全行を溜めずに出力)
+    predicate = compile_filter(**filters)
+    filtered = (r for r in iter_availability(datacenters, gpu_details) if predicate(r))
+    output_rows(filtered, args.format, columns)
 
 
 if __name__ == "__main__":
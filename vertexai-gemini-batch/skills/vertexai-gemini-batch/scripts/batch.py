@@ -1,7 +1,12 @@
 #!/usr/bin/env -S uv run --script
 # /// script
+# requires-python = ">=3.11"
 # dependencies = [
+#     "google-cloud-storage",
 #     "google-genai",
+#     "numpy",
+#     "orjson",
+#     "pyarrow",
 # ]
 # ///
 """
@@ -9,14 +14,23 @@ Vertex AI Batch Prediction CLI (google-genai SDK)
 
 Subcommands:
     create  バッチジョブを作成
+    run     件数に応じてオンライン API かバッチで処理し、結果を入力順にまとめる
+    validate 入力 JSONL を投入前に検証
     status  ジョブの状態を確認
     list    ジョブ一覧を取得
     wait    ジョブの完了を待機
+    stats   過去のジョブのキュー待ち時間・実行時間の分布を表示
+    results ジョブの出力を key で並べ替えてダウンロード
+    retry   失敗した行を再投入し、全結果を 1 ファイルにまとめる
+    usage-report トークン使用量を集計
+    export  ジョブ出力を Parquet データセットに変換
+    cache   レスポンスキャッシュの状態表示・削除
     usage   詳細な使い方を表示
 
 Global Options:
     --project   GCP プロジェクト ID (必須)
     --region    リージョン (default: global)
+    --profile-startup  起動時間の内訳を表示 (BATCH_PROFILE_STARTUP=1 でも可)
 
 Examples:
     ./batch.py --project PROJECT_ID create \\
@@ -24,17 +38,53 @@ Examples:
         --output-uri gs://BUCKET/output/ \\
         --model gemini-2.5-flash
 
+    ./batch.py --project PROJECT_ID create \\
+        --input ./input.jsonl \\
+        --output-uri gs://BUCKET/output/ \\
+        --model gemini-2.5-flash
+
     ./batch.py --project PROJECT_ID status --job-name JOB_NAME
     ./batch.py --project PROJECT_ID list
     ./batch.py --project PROJECT_ID wait --job-name JOB_NAME
 """
 
+from __future__ import annotations
+
 import argparse
+import asyncio
+import hashlib
+import heapq
+import itertools
+import json
+import mmap
+import os
+import pickle
+import random
+import re
+import shutil
+import sqlite3
 import sys
+import tempfile
+import threading
 import time
+import zlib
+from array import array
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from functools import lru_cache, partial
+from operator import itemgetter
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Iterable, Iterator
+
+import orjson
 
-from google import genai
-from google.genai import types
+# google.genai の import には 1 秒近くかかるため、API を呼ぶコマンドでのみ遅延 import する
+if TYPE_CHECKING:
+    from google import genai
+    from google.genai import types
 
 USAGE_DOC = """
 Vertex AI Batch Prediction CLI
@@ -52,20 +102,164 @@ Subcommands
 -----------
 
 create: バッチジョブを作成
-    --input-uri     入力 JSONL の GCS URI (必須)
+    --input-uri     入力 JSONL の GCS URI (--input と排他)
+    --input         ローカルの入力 JSONL (--input-uri と排他)
+                    シャードに分割して並列アップロードし、シャードごとにジョブを作成する
     --output-uri    出力先の GCS URI プレフィックス (必須)
     --model         モデル名 (必須, 例: gemini-2.5-flash)
     --display-name  ジョブ表示名 (default: batch-job)
+    --staging-uri   シャードのアップロード先 (default: OUTPUT_URI/_inputs/)
+    --shard-max-lines  1 シャードの最大行数 (default: 200000)
+    --shard-max-mb     1 シャードの最大サイズ MB (default: 1024)
+    --upload-workers   並列アップロード数 (default: 8)
+    --cache         レスポンスキャッシュにあるリクエストを除外して投入 (--input 時のみ)
+    --cache-max-mb  キャッシュの上限サイズ MB。超えたら古いものから削除 (default: 1024)
+    --validate      アップロード前に validate を実行し、問題があれば中止 (--input 時のみ)
+    --manifest      進捗を記録する JSON ファイル (--input 時のみ)
+                    シャードごとの sha256・アップロード状況・ジョブ名・終了状態を記録する。
+                    同じ manifest で再実行すると、アップロード済みのシャードは再アップロードせず、
+                    作成済みのジョブは再作成しない。入力やオプションが記録と異なればエラー
+
+run: 件数に応じてオンライン API かバッチジョブで処理し、結果を入力順に 1 ファイルにまとめる
+    --input         入力 JSONL (必須)
+    --output        出力先のローカル JSONL (必須)
+    --model         モデル名 (必須)
+    --mode          auto / online / batch (default: auto)
+    --online-threshold  auto 時、この件数未満ならオンライン API で処理 (default: 1000)
+    --concurrency   オンライン時の同時リクエスト数 (default: 16)
+    --rpm           オンライン時の毎分リクエスト数の上限 (default: 600)
+    --max-retries   オンライン時の行ごとの再試行回数 (default: 5)
+                    429 / 5xx / 通信エラーは指数バックオフ (ジッター付き, 最大 60 秒) で再試行
+    --output-uri    バッチ時の出力先 GCS URI プレフィックス (バッチ時は必須)
+    --display-name  バッチ時のジョブ表示名 (default: batch-run)
+    --manifest      バッチ時の進捗を記録する JSON。再実行すると中断した箇所から再開 (create と同じ)
+    シャード分割・並列アップロード・ポーリング間隔のオプションは create / wait と同じ
+
+    オンライン時も出力はバッチ出力と同じ形式 ({"key", "status", "processed_time",
+    "request", "response"}) で、失敗した行は status にエラーメッセージが入る。
+    失敗した行があれば終了コード 1 を返す。
+
+validate: 入力 JSONL を投入前に検証 (--project 不要)
+    --input         入力 JSONL (必須)
+    --workers       並列プロセス数 (default: CPU コア数)
+    --shard-max-lines / --shard-max-mb  見積もりに使うシャード分割の上限 (create と同じ)
+    --input-price   入力 100 万トークンあたりの価格 (USD)。指定するとシャードごとのコストも表示
+
+    各行が有効な JSON で {"key", "request": {"contents": [...]}} の形式かを確認し、
+    key の重複を検出する。シャードごとの行数・サイズ・入力トークン数の概算を表示する。
+    トークン数は ASCII 4 文字で 1 トークン、それ以外は 1 文字 1 トークンとして概算する。
+    エラーまたは重複があれば終了コード 1 を返す。
 
 status: ジョブの状態を確認
     --job-name      ジョブ名 (必須)
 
-list: ジョブ一覧を取得
-    (オプションなし)
+list: ジョブ一覧を取得 (新しい順)
+    --state         状態で絞り込む (複数指定可, 例: RUNNING SUCCEEDED)
+    --model         モデル名で絞り込む
+    --display-name-prefix  表示名のプレフィックスで絞り込む
+    --since / --until  作成時刻の範囲 (ISO 形式 または 30m / 12h / 7d のような相対時間)
+    --limit         表示する最大件数
+    --json          1 行 1 ジョブの JSON で出力
+    --no-refresh    API を呼ばずにローカル索引だけを検索
 
-wait: ジョブの完了を待機
-    --job-name      ジョブ名 (必須)
-    --poll-interval ポーリング間隔 (秒, default: 30)
+    ジョブ一覧は $XDG_CACHE_HOME/vertexai-gemini-batch/jobs.sqlite に索引として保持する。
+    更新時は索引にある最新の作成時刻以降のジョブと、終了状態でないジョブだけを取得する。
+    初回はすべてのジョブを取得する。
+
+wait: ジョブの完了を待機 (複数ジョブを 1 プロセスでまとめて待機)
+    --job-name      ジョブ名 (複数指定可, --display-name-prefix と排他)
+    --display-name-prefix  表示名がこのプレフィックスで始まるジョブをすべて待機
+    --manifest      create --manifest で記録したジョブを待機し、終了状態を manifest に記録
+    --poll-interval 基本のポーリング間隔 (秒, default: 30)
+    --min-poll-interval  ポーリング間隔の下限 (秒, default: 5)
+    --max-poll-interval  ポーリング間隔の上限 (秒, default: 300)
+
+    ポーリング間隔はジョブごとに状態に応じて調整する:
+    - PENDING / QUEUED: 同じ状態が続くほど間隔を伸ばす (上限まで)
+    - RUNNING: completion_stats の進捗から残り時間を推定し、完了が近いほど短くする
+    すべてのジョブが終了状態になるとサマリを表示して終了する。
+    成功しなかったジョブがあれば終了コード 1 を返す。
+    --trace-dir     トレースファイルの出力先 (default: $XDG_CACHE_HOME/vertexai-gemini-batch/traces/)
+
+    待機のたびに、ジョブごとの状態遷移 (PENDING -> QUEUED -> RUNNING -> 終了) の時刻と
+    ポーリングにかかった時間を OTLP/JSON 形式のトレースファイルに書き出す。
+    作成・実行開始・終了の時刻は API の create_time / start_time / end_time を使い、
+    QUEUED への遷移はポーリングで観測した時刻 (ポーリング間隔の精度) になる。
+    retry / run の待機でも同様に記録する。
+
+stats: 過去に待機したジョブのキュー待ち時間・実行時間の分布を表示 (--project 不要)
+    --trace-dir     トレースファイルの場所 (default: wait と同じ)
+    --group-by      none / model / hour (作成時刻の時, UTC) / size (行数の桁)
+    --since         この時刻以降に作成されたジョブ (ISO 形式 または 7d / 12h)
+    --model / --display-name-prefix  絞り込み
+    --json          JSON 形式で出力
+
+    キュー待ち時間は作成から実行開始まで、実行時間は実行開始から終了まで。
+    p50 / p90 / max を表示する。シャードサイズや投入時間帯の判断に使う。
+
+results: ジョブの出力をダウンロードし、key で並べ替えて 1 ファイルにまとめる
+    --job-name      ジョブ名 (必須, 複数指定可)
+    --output        出力先のローカル JSONL (必須)
+    --input         元の入力 JSONL。指定すると入力と同じ順序で出力する
+                    (省略時は key 順)
+    --manifest      create --manifest で記録したジョブを --job-name に追加し、
+                    --input 省略時は manifest の入力を使う
+    --download-workers  並列ダウンロード数 (default: 8)
+    --spill-mb      メモリ上に保持する行の上限 MB。超えた分はディスクに退避 (default: 256)
+    --cache         成功した出力をレスポンスキャッシュに登録し、
+                    出力のない入力行をキャッシュから補完する (--input 必須)
+    --model         キャッシュ参照に使うモデル名 (default: ジョブのモデル)
+    --cache-max-mb  キャッシュの上限サイズ MB。超えたら古いものから削除 (default: 1024)
+
+retry: 失敗した行 (status が空でない行) だけを再投入し、収束するまで繰り返す
+    --job-name      元のジョブ名 (必須, 複数指定可)
+    --input         元の入力 JSONL (必須)
+    --output        最終結果のローカル JSONL (必須)
+    --output-uri    再投入ジョブの出力先プレフィックス (必須)
+                    試行ごとに OUTPUT_URI/retry-NN/ 以下に出力する
+    --model         モデル名 (default: 元のジョブのモデル)
+    --max-attempts  最大再投入回数 (default: 3)
+    (--shard-max-lines などのシャード分割、--poll-interval などの待機オプションも指定可)
+
+    status が空でない行に加え、出力に現れなかった入力行も再投入する。
+
+    元のジョブと全試行の出力を key で結合し、入力と同じ順序で --output に書き出す。
+    同じ key は成功行、次に新しい試行の行を優先する。
+    最大回数を超えても失敗が残った場合は終了コード 1 を返す。
+
+usage-report: ジョブ出力の usageMetadata をストリーミングで集計
+    --job-name      ジョブ名 (必須, 複数指定可)
+    --key-prefix-sep    key プレフィックスの区切り文字 (default: -)
+    --key-prefix-depth  key プレフィックスに使う要素数 (default: 1)
+                        例: key "summarize-001" -> プレフィックス "summarize"
+    --max-groups    次元ごとのグループ数の上限 (default: 1000)
+                    上限を超えて現れたグループは "(other)" にまとめる
+    --json          JSON 形式で出力
+
+    prompt / candidates / total のトークン数をジョブ・key プレフィックス・モデルごとに
+    合計し、p50 / p90 / p99 / max を表示する。パーセンタイルは対数ヒストグラムによる
+    近似値 (誤差 ~5%)。
+
+export: ジョブ出力を Parquet データセットに変換
+    --job-name      ジョブ名 (必須, 複数指定可)
+    --output-dir    出力先ディレクトリ (必須)。出力ファイルごとに part-NNNNN.parquet を作成
+    --row-group-size  行グループあたりの行数 (default: 122880)
+    --raw           元の JSON 行を raw 列として保持
+    --compression   圧縮方式 (default: zstd)
+
+    列: key, status, processed_time, text (1 つ目の候補のテキスト), finish_reason,
+        model_version, prompt_tokens, candidates_tokens, total_tokens,
+        thoughts_tokens, cached_tokens, error_message (, raw)
+
+cache: レスポンスキャッシュの状態を表示
+    --clear         キャッシュを削除
+
+Response Cache
+--------------
+モデル名と request の正規化 JSON のハッシュをキーに、成功レスポンスを
+$XDG_CACHE_HOME/vertexai-gemini-batch/responses.sqlite に保存する。
+create --cache はキャッシュ済みのリクエストを除外して投入し、
+results --cache はジョブ出力をキャッシュに登録しつつ、除外した行をキャッシュから補完する。
 
 Input JSONL Format
 ------------------
@@ -87,6 +281,7 @@ Output JSONL Format
 }
 
 注意: 出力順序は入力順序と異なる場合がある。key フィールドで対応付けること。
+results サブコマンドを使うと入力と同じ順序に並べ替えた 1 ファイルを取得できる。
 
 Job States
 ----------
@@ -100,6 +295,13 @@ JOB_STATE_EXPIRED    48 時間超過で期限切れ
 
 Examples
 --------
+# ローカルの入力ファイルをシャード分割してアップロードし、シャードごとにジョブ作成
+./batch.py --project PROJECT_ID create \\
+    --input ./input.jsonl \\
+    --output-uri gs://BUCKET/batch-output/ \\
+    --model gemini-2.5-flash \\
+    --shard-max-lines 50000
+
 # 入力ファイルを GCS にアップロード
 gcloud storage cp input.jsonl gs://BUCKET/batch-input/
 
@@ -120,152 +322,3558 @@ gcloud storage cp input.jsonl gs://BUCKET/batch-input/
 ./batch.py --project PROJECT_ID wait \\
     --job-name "projects/PROJECT_NUM/locations/global/batchPredictionJobs/JOB_ID"
 
-# 結果ダウンロード
+# シャード分割したジョブをまとめて待機
+./batch.py --project PROJECT_ID wait --display-name-prefix batch-job-shard-
+
+# manifest に進捗を記録 (中断しても同じコマンドで再開できる)
+./batch.py --project PROJECT_ID create --input ./input.jsonl \\
+    --output-uri gs://BUCKET/batch-output/ --model gemini-2.5-flash --manifest ./run.json
+./batch.py --project PROJECT_ID wait --manifest ./run.json
+./batch.py --project PROJECT_ID results --manifest ./run.json --output ./results.jsonl
+
+# 結果を入力と同じ順序でダウンロード
+./batch.py --project PROJECT_ID results \\
+    --job-name JOB_NAME_1 JOB_NAME_2 \\
+    --input ./input.jsonl \\
+    --output ./results.jsonl
+
+# 少量ならオンライン API、多ければバッチジョブで処理して結果を入力順にまとめる
+./batch.py --project PROJECT_ID run \\
+    --input ./input.jsonl --output ./results.jsonl \\
+    --model gemini-2.5-flash --output-uri gs://BUCKET/batch-output/
+
+# 投入前に入力を検証
+./batch.py validate --input ./input.jsonl --input-price 0.15
+
+# 失敗した行を再投入して結果をまとめる
+./batch.py --project PROJECT_ID retry \\
+    --job-name JOB_NAME \\
+    --input ./input.jsonl \\
+    --output-uri gs://BUCKET/batch-output/ \\
+    --output ./results.jsonl
+
+# トークン使用量を集計
+./batch.py --project PROJECT_ID usage-report --job-name JOB_NAME_1 JOB_NAME_2
+
+# Parquet に変換して DuckDB で集計
+./batch.py --project PROJECT_ID export \\
+    --job-name JOB_NAME --output-dir ./results-parquet/
+duckdb -c "SELECT status, count(*) FROM './results-parquet/*.parquet' GROUP BY 1"
+
+# 結果をそのままダウンロード
 gcloud storage cp -r gs://BUCKET/batch-output/ ./results/
+
+Local Storage
+-------------
+環境変数 BATCH_LOCAL_GCS_ROOT を設定すると、gs://BUCKET/PATH を
+$BATCH_LOCAL_GCS_ROOT/BUCKET/PATH に読み替えるローカル代替を使用する (テスト用)。
 """
 
+DEFAULT_SHARD_MAX_LINES = 200_000
+DEFAULT_SHARD_MAX_MB = 1024
+DEFAULT_SPILL_MB = 256
+DEFAULT_CACHE_MAX_MB = 1024
+# DuckDB の行グループ単位 (122880 行) に合わせる
+DEFAULT_ROW_GROUP_SIZE = 122_880
+# usage-report: 次元ごとのグループ数の上限 (1 グループのヒストグラムは約 6 KB)
+DEFAULT_MAX_GROUPS = 1000
+
+# validate: これより小さい入力は単一プロセスで検証する
+PARALLEL_VALIDATE_MIN_BYTES = 64 * 1024 * 1024
+# 画像・動画などテキスト以外のパーツ 1 つあたりの概算トークン数
+MEDIA_PART_TOKENS = 258
+
+TERMINAL_STATES = {
+    "JOB_STATE_SUCCEEDED",
+    "JOB_STATE_PARTIALLY_SUCCEEDED",
+    "JOB_STATE_FAILED",
+    "JOB_STATE_CANCELLED",
+    "JOB_STATE_EXPIRED",
+}
+WAITING_STATES = {"JOB_STATE_PENDING", "JOB_STATE_QUEUED"}
+MAX_CONCURRENT_POLLS = 16
+# ポーリングの一時的なエラー (5xx・タイムアウト・切断) を連続で再試行する回数
+MAX_POLL_RETRIES = 5
+DEFAULT_ONLINE_THRESHOLD = 1000
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+# バッチ出力と同じ形式にするため、SDK 固有のフィールドは書き出さない
+RESPONSE_EXCLUDE_FIELDS = {
+    "sdk_http_response",
+    "automatic_function_calling_history",
+    "parsed",
+}
+
+
+class StartupProfile:
+    """起動・import・最初の API 応答までの経過時間を記録 (--profile-startup)"""
+
+    def __init__(self):
+        self.enabled = bool(os.environ.get("BATCH_PROFILE_STARTUP"))
+        self.started = time.perf_counter()
+        self.marks: list[tuple[str, float]] = []
+
+    def mark(self, label: str) -> None:
+        if self.enabled:
+            self.marks.append((label, time.perf_counter()))
 
+    @contextmanager
+    def span(self, label: str) -> Iterator[None]:
+        started = time.perf_counter()
+        yield
+        if self.enabled:
+            self.marks.append(
+                (
+                    f"{label} ({(time.perf_counter() - started) * 1000:.0f}ms)",
+                    time.perf_counter(),
+                )
+            )
+
+    def on_first_response(self, *_) -> None:
+        if not any(label == "first API response" for label, _ in self.marks):
+            self.mark("first API response")
+
+    async def on_first_response_async(self, *_) -> None:
+        self.on_first_response()
+
+    def report(self) -> None:
+        if not self.enabled:
+            return
+        print("\nStartup profile (ms since module load):", file=sys.stderr)
+        for label, at in self.marks:
+            print(f"  {(at - self.started) * 1000:8.1f}  {label}", file=sys.stderr)
+
+
+PROFILE = StartupProfile()
+
+
+@lru_cache(maxsize=None)
 def create_client(project: str, region: str) -> genai.Client:
-    """Vertex AI を使用する Client を作成"""
-    return genai.Client(
-        vertexai=True,
-        project=project,
-        location=region,
-    )
+    """Vertex AI を使用する Client を作成 (同じ引数なら作成済みのものを返す)
 
+    client.aio を使うコルーチンは run_async で実行する。
+    """
+    with PROFILE.span("import google.genai"):
+        from google import genai
+        from google.genai import types
 
-def cmd_create(args):
-    """バッチジョブを作成"""
-    client = create_client(args.project, args.region)
+    http_options = None
+    if PROFILE.enabled:
+        http_options = types.HttpOptions(
+            client_args={"event_hooks": {"response": [PROFILE.on_first_response]}},
+            async_client_args={
+                "event_hooks": {"response": [PROFILE.on_first_response_async]}
+            },
+        )
+    with PROFILE.span("create client"):
+        return genai.Client(
+            vertexai=True,
+            project=project,
+            location=region,
+            http_options=http_options,
+        )
 
-    batch_job = client.batches.create(
-        model=args.model,
-        src=args.input_uri,
-        config=types.CreateBatchJobConfig(
-            display_name=args.display_name,
-            dest=args.output_uri,
-        ),
-    )
 
-    print(f"Created batch job: {batch_job.name}")
-    print(f"State: {batch_job.state.name}")
+@lru_cache(maxsize=None)
+def event_loop() -> asyncio.AbstractEventLoop:
+    """非同期 API 用のイベントループ (デーモンスレッドで回し続ける)
 
+    Client の非同期 HTTP クライアントは最初に使ったイベントループに紐づくため、
+    asyncio.run ごとに新しいループを作ると 2 回目以降が Event loop is closed で失敗する。
+    プロセス内の非同期処理はすべてこの 1 つのループで実行する。
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
 
-def cmd_status(args):
-    """ジョブの状態を確認"""
-    client = create_client(args.project, args.region)
-    job = client.batches.get(name=args.job_name)
 
-    print(f"Name: {job.name}")
-    print(f"State: {job.state.name}")
-    print(f"Model: {job.model}")
-    if job.dest:
-        print(f"Output: {job.dest.gcs_uri}")
-    if job.error:
-        print(f"Error: {job.error}")
+def run_async(coro: Awaitable[Any]) -> Any:
+    """coro を共有のイベントループで実行し、結果を待って返す"""
+    return asyncio.run_coroutine_threadsafe(coro, event_loop()).result()
 
 
-def cmd_list(args):
-    """ジョブ一覧を取得"""
-    client = create_client(args.project, args.region)
+def parse_gcs_uri(uri: str) -> tuple[str, str]:
+    """gs://BUCKET/PATH を (BUCKET, PATH) に分解"""
+    if not uri.startswith("gs://"):
+        raise ValueError(f"Not a GCS URI: {uri}")
+    bucket, _, path = uri[len("gs://") :].partition("/")
+    return bucket, path
 
-    for job in client.batches.list():
-        print(f"{job.state.name:25} {job.name}")
 
+def join_uri(prefix: str, *parts: str) -> str:
+    """GCS URI プレフィックスにパスを連結"""
+    return "/".join([prefix.rstrip("/"), *parts])
 
-def cmd_wait(args):
-    """ジョブの完了を待機"""
-    client = create_client(args.project, args.region)
-    wait_for_completion(client, args.job_name, args.poll_interval)
 
+class GCSStorage:
+    """google-cloud-storage による GCS アクセス"""
 
-def cmd_usage(args):
-    """詳細な使い方を表示"""
-    print(USAGE_DOC)
+    def __init__(self, project: str):
+        from google.cloud import storage
 
+        self.client = storage.Client(project=project)
 
-def wait_for_completion(client: genai.Client, job_name: str, poll_interval: int = 30):
-    """ジョブの完了を待機"""
-    completed_states = {
-        "JOB_STATE_SUCCEEDED",
-        "JOB_STATE_FAILED",
-        "JOB_STATE_CANCELLED",
-        "JOB_STATE_EXPIRED",
+    def upload(self, local_path: Path, uri: str) -> None:
+        bucket, path = parse_gcs_uri(uri)
+        self.client.bucket(bucket).blob(path).upload_from_filename(str(local_path))
+
+    def download(self, uri: str, local_path: Path) -> None:
+        bucket, path = parse_gcs_uri(uri)
+        self.client.bucket(bucket).blob(path).download_to_filename(str(local_path))
+
+    def list(self, prefix_uri: str) -> list[str]:
+        bucket, prefix = parse_gcs_uri(prefix_uri)
+        return [
+            f"gs://{bucket}/{blob.name}"
+            for blob in self.client.list_blobs(bucket, prefix=prefix)
+        ]
+
+
+class LocalStorage:
+    """gs://BUCKET/PATH を ROOT/BUCKET/PATH に対応付けるローカル代替"""
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+
+    def _path(self, uri: str) -> Path:
+        bucket, path = parse_gcs_uri(uri)
+        return self.root / bucket / path
+
+    def upload(self, local_path: Path, uri: str) -> None:
+        dest = self._path(uri)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(local_path, dest)
+
+    def download(self, uri: str, local_path: Path) -> None:
+        shutil.copyfile(self._path(uri), local_path)
+
+    def list(self, prefix_uri: str) -> list[str]:
+        bucket, prefix = parse_gcs_uri(prefix_uri)
+        base = self.root / bucket
+        if not base.exists():
+            return []
+        uris = []
+        for path in sorted(base.rglob("*")):
+            name = path.relative_to(base).as_posix()
+            if path.is_file() and name.startswith(prefix):
+                uris.append(f"gs://{bucket}/{name}")
+        return uris
+
+
+def create_storage(project: str) -> GCSStorage | LocalStorage:
+    """GCS クライアントを作成 (BATCH_LOCAL_GCS_ROOT があればローカル代替を使用)"""
+    local_root = os.environ.get("BATCH_LOCAL_GCS_ROOT")
+    if local_root:
+        return LocalStorage(Path(local_root))
+    return GCSStorage(project)
+
+
+@dataclass
+class Shard:
+    """入力 JSONL を分割した 1 ファイル"""
+
+    index: int
+    path: Path
+    lines: int = 0
+    bytes: int = 0
+    sha256: str = ""
+
+
+def iter_jsonl_lines(path: Path) -> Iterator[bytes]:
+    """JSONL の空でない行を改行付きで返す"""
+    with open(path, "rb", buffering=1024 * 1024) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            yield line if line.endswith(b"\n") else line + b"\n"
+
+
+def iter_shards(
+    lines: Iterable[bytes], work_dir: Path, max_lines: int, max_bytes: int
+) -> Iterator[Shard]:
+    """入力行をストリーミングで分割し、書き終えたシャードから順に返す"""
+    shard: Shard | None = None
+    out = None
+    digest = None
+    for line in lines:
+        if out is not None and (
+            shard.lines >= max_lines or shard.bytes + len(line) > max_bytes
+        ):
+            out.close()
+            out = None
+            shard.sha256 = digest.hexdigest()
+            yield shard
+
+        if out is None:
+            index = 0 if shard is None else shard.index + 1
+            shard = Shard(index, work_dir / f"shard-{index:05d}.jsonl")
+            out = open(shard.path, "wb", buffering=1024 * 1024)
+            digest = hashlib.sha256()
+
+        out.write(line)
+        digest.update(line)
+        shard.lines += 1
+        shard.bytes += len(line)
+
+    if out is not None:
+        out.close()
+        shard.sha256 = digest.hexdigest()
+        yield shard
+
+
+class RunManifest:
+    """シャードごとのハッシュ・アップロード状況・ジョブ名・終了状態を記録する JSON
+
+    更新のたびに一時ファイルへ書いてから rename するため、
+    途中で強制終了されても壊れた manifest は残らない。
+    """
+
+    VERSION = 1
+
+    def __init__(self, path: Path, data: dict):
+        self.path = path
+        self.data = data
+        self.lock = threading.Lock()
+
+    @classmethod
+    def open(cls, path: Path, params: dict) -> RunManifest:
+        """既存の manifest を読み込む (なければ作成)。params が異なれば ValueError"""
+        if path.exists():
+            data = json.loads(path.read_text())
+            for name, value in params.items():
+                if data["params"].get(name) != value:
+                    raise ValueError(
+                        f"{name} differs from manifest "
+                        f"({data['params'].get(name)!r} != {value!r})"
+                    )
+            return cls(path, data)
+
+        manifest = cls(
+            path,
+            {
+                "version": cls.VERSION,
+                "created_at": datetime.now(timezone.utc).isoformat(),
+                "params": params,
+                "shards": {},
+            },
+        )
+        manifest.save()
+        return manifest
+
+    @classmethod
+    def load(cls, path: Path) -> RunManifest:
+        return cls(path, json.loads(path.read_text()))
+
+    @property
+    def params(self) -> dict:
+        return self.data["params"]
+
+    def shard(self, index: int) -> dict:
+        return self.data["shards"].get(f"{index:05d}", {})
+
+    def update_shard(self, index: int, **fields) -> None:
+        with self.lock:
+            self.data["shards"].setdefault(f"{index:05d}", {}).update(fields)
+            self.save()
+
+    def job_names(self) -> list[str]:
+        shards = self.data["shards"]
+        return [
+            shards[i]["job_name"] for i in sorted(shards) if "job_name" in shards[i]
+        ]
+
+    def record_states(self, jobs: Iterable[types.BatchJob]) -> None:
+        """ジョブの状態を対応するシャードに記録"""
+        state_by_name = {job.name: job.state.name for job in jobs}
+        with self.lock:
+            for entry in self.data["shards"].values():
+                if entry.get("job_name") in state_by_name:
+                    entry["state"] = state_by_name[entry["job_name"]]
+            self.save()
+
+    def save(self) -> None:
+        self.data["updated_at"] = datetime.now(timezone.utc).isoformat()
+        tmp = self.path.with_name(f".{self.path.name}.tmp")
+        tmp.write_text(json.dumps(self.data, indent=2, ensure_ascii=False) + "\n")
+        os.replace(tmp, self.path)
+
+
+def open_manifest(
+    path: str,
+    input_path: Path,
+    output_uri: str,
+    model: str,
+    display_name: str,
+    staging_uri: str | None,
+    max_lines: int,
+    max_bytes: int,
+    cache: bool = False,
+) -> RunManifest:
+    """create / run 用の manifest を開く。パラメータが異なれば終了
+
+    --cache の有無でシャードに入る行が変わるため、cache も params に含める。
+    """
+    params = {
+        "input": str(input_path.resolve()),
+        "output_uri": output_uri,
+        "model": model,
+        "display_name": display_name,
+        "staging_uri": staging_uri or join_uri(output_uri, "_inputs"),
+        "shard_max_lines": max_lines,
+        "shard_max_bytes": max_bytes,
+        "cache": cache,
     }
+    try:
+        return RunManifest.open(Path(path), params)
+    except ValueError as e:
+        print(f"Error: {path}: {e}", file=sys.stderr)
+        sys.exit(1)
 
-    print(f"Waiting for job: {job_name}")
-    batch_job = client.batches.get(name=job_name)
 
-    while batch_job.state.name not in completed_states:
-        print(f"  Current state: {batch_job.state.name}")
-        time.sleep(poll_interval)
-        batch_job = client.batches.get(name=job_name)
+def find_submitted_job(
+    client: genai.Client, display_name: str, since: str
+) -> types.BatchJob | None:
+    """since 以降に作成された表示名 display_name のジョブを探す"""
+    since_time = datetime.fromisoformat(since)
+    for job in client.batches.list():
+        if (
+            job.display_name == display_name
+            and job.create_time
+            and job.create_time >= since_time
+        ):
+            return job
+    return None
 
-    print(f"Job finished with state: {batch_job.state.name}")
 
-    if batch_job.state.name == "JOB_STATE_SUCCEEDED":
-        print(f"Output: {batch_job.dest.gcs_uri}")
-    elif batch_job.error:
-        print(f"Error: {batch_job.error}")
+def submit_shard(
+    client: genai.Client,
+    storage: GCSStorage | LocalStorage,
+    shard: Shard,
+    staging_uri: str,
+    output_uri: str,
+    model: str,
+    display_name: str,
+    manifest: RunManifest | None = None,
+) -> types.BatchJob:
+    """シャードをアップロードしてバッチジョブを作成
 
-    return batch_job
+    manifest があれば、記録済みのアップロード・ジョブ作成は再実行しない。
+    """
+    name = f"shard-{shard.index:05d}"
+    src = join_uri(staging_uri, f"{name}.jsonl")
+    job_display_name = f"{display_name}-{name}"
+    entry = manifest.shard(shard.index) if manifest else {}
 
+    if entry.get("job_name"):
+        shard.path.unlink()
+        return client.batches.get(name=entry["job_name"])
 
-def main():
-    parser = argparse.ArgumentParser(
-        description="Vertex AI Batch Prediction CLI",
-        formatter_class=argparse.RawDescriptionHelpFormatter,
-        epilog="Run './batch.py usage' for detailed documentation.",
-    )
-    parser.add_argument("--project", type=str, help="GCP プロジェクト ID")
-    parser.add_argument(
-        "--region", type=str, default="global", help="リージョン (default: global)"
-    )
+    if not entry.get("uploaded"):
+        storage.upload(shard.path, src)
+        if manifest:
+            manifest.update_shard(shard.index, src=src, uploaded=True)
+    shard.path.unlink()
 
-    subparsers = parser.add_subparsers(dest="command", required=True)
+    # ジョブ作成の直後に中断された場合は、作成済みのジョブを引き継ぐ
+    if entry.get("submitted_at"):
+        job = find_submitted_job(client, job_display_name, entry["submitted_at"])
+        if job:
+            manifest.update_shard(shard.index, job_name=job.name, state=job.state.name)
+            return job
 
-    # create
-    p_create = subparsers.add_parser("create", help="バッチジョブを作成")
-    p_create.add_argument(
-        "--input-uri", type=str, required=True, help="入力 JSONL の GCS URI"
-    )
-    p_create.add_argument(
-        "--output-uri", type=str, required=True, help="出力先の GCS URI プレフィックス"
-    )
-    p_create.add_argument("--model", type=str, required=True, help="モデル名")
-    p_create.add_argument(
-        "--display-name", type=str, default="batch-job", help="ジョブ表示名"
+    from google.genai import types
+
+    if manifest:
+        manifest.update_shard(
+            shard.index, submitted_at=datetime.now(timezone.utc).isoformat()
+        )
+    job = client.batches.create(
+        model=model,
+        src=src,
+        config=types.CreateBatchJobConfig(
+            display_name=job_display_name,
+            dest=join_uri(output_uri, name) + "/",
+        ),
     )
-    p_create.set_defaults(func=cmd_create)
+    if manifest:
+        manifest.update_shard(shard.index, job_name=job.name, state=job.state.name)
+    return job
 
-    # status
-    p_status = subparsers.add_parser("status", help="ジョブの状態を確認")
-    p_status.add_argument("--job-name", type=str, required=True, help="ジョブ名")
-    p_status.set_defaults(func=cmd_status)
 
-    # list
-    p_list = subparsers.add_parser("list", help="ジョブ一覧を取得")
-    p_list.set_defaults(func=cmd_list)
+def create_sharded_jobs(
+    client: genai.Client,
+    storage: GCSStorage | LocalStorage,
+    lines: Iterable[bytes],
+    output_uri: str,
+    model: str,
+    display_name: str = "batch-job",
+    staging_uri: str | None = None,
+    max_lines: int = DEFAULT_SHARD_MAX_LINES,
+    max_bytes: int = DEFAULT_SHARD_MAX_MB * 1024 * 1024,
+    workers: int = 8,
+    manifest: RunManifest | None = None,
+) -> list[types.BatchJob]:
+    """入力行をシャードに分割し、並列にアップロード・ジョブ作成する
 
-    # wait
-    p_wait = subparsers.add_parser("wait", help="ジョブの完了を待機")
-    p_wait.add_argument("--job-name", type=str, required=True, help="ジョブ名")
-    p_wait.add_argument(
-        "--poll-interval", type=int, default=30, help="ポーリング間隔 (秒)"
+    分割と並行してアップロードを進める。ディスク上に残る未アップロードの
+    シャードは workers * 2 個までに抑える。
+    manifest を指定すると進捗を記録し、再実行時は完了済みの段階を飛ばす。
+    シャードの内容が記録と異なる場合は RuntimeError。
+    """
+    staging_uri = staging_uri or join_uri(output_uri, "_inputs")
+    pending = threading.BoundedSemaphore(workers * 2)
+    jobs: dict[int, types.BatchJob] = {}
+    errors: list[str] = []
+
+    def run(shard: Shard) -> types.BatchJob:
+        try:
+            return submit_shard(
+                client,
+                storage,
+                shard,
+                staging_uri,
+                output_uri,
+                model,
+                display_name,
+                manifest,
+            )
+        finally:
+            pending.release()
+
+    with (
+        tempfile.TemporaryDirectory(prefix="batch-shards-") as work_dir,
+        ThreadPoolExecutor(max_workers=workers) as pool,
+    ):
+        futures = {}
+        for shard in iter_shards(lines, Path(work_dir), max_lines, max_bytes):
+            if manifest:
+                recorded = manifest.shard(shard.index).get("sha256")
+                if recorded and recorded != shard.sha256:
+                    errors.append(
+                        f"shard {shard.index}: content changed since manifest"
+                    )
+                    shard.path.unlink()
+                    continue
+                if not recorded:
+                    manifest.update_shard(
+                        shard.index,
+                        sha256=shard.sha256,
+                        lines=shard.lines,
+                        bytes=shard.bytes,
+                    )
+            pending.acquire()
+            futures[pool.submit(run, shard)] = shard
+
+        for future in as_completed(futures):
+            shard = futures[future]
+            try:
+                job = future.result()
+            except Exception as e:
+                errors.append(f"shard {shard.index}: {e}")
+                print(f"Failed shard {shard.index}: {e}", file=sys.stderr)
+                continue
+            jobs[shard.index] = job
+            print(
+                f"Created batch job: {job.name} (shard {shard.index}, {shard.lines} lines)"
+            )
+
+    if errors:
+        raise RuntimeError(f"{len(errors)} shard(s) failed: {'; '.join(errors)}")
+
+    return [jobs[i] for i in sorted(jobs)]
+
+
+def cache_dir() -> Path:
+    """ローカルキャッシュの置き場所 ($XDG_CACHE_HOME/vertexai-gemini-batch)"""
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "vertexai-gemini-batch"
+
+
+def normalize_model(model: str) -> str:
+    """publishers/google/models/gemini-2.5-flash 形式をモデル ID に揃える"""
+    return model.rsplit("/", 1)[-1]
+
+
+def _camel_keys(value: Any) -> Any:
+    if isinstance(value, dict):
+        return {
+            re.sub(r"_([a-z])", lambda m: m.group(1).upper(), k): _camel_keys(v)
+            for k, v in value.items()
+        }
+    if isinstance(value, list):
+        return [_camel_keys(v) for v in value]
+    return value
+
+
+def request_hash(model: str, request: dict) -> bytes:
+    """モデルと request の正規化 JSON から内容アドレスを計算
+
+    キーの並び順と snake_case / camelCase の違いは同一視する。
+    """
+    canonical = json.dumps(
+        _camel_keys(request), sort_keys=True, separators=(",", ":"), ensure_ascii=False
     )
-    p_wait.set_defaults(func=cmd_wait)
+    return hashlib.sha256(f"{normalize_model(model)}\n{canonical}".encode()).digest()
+
+
+class ResponseCache:
+    """request のハッシュをキーに成功レスポンスを保持する SQLite キャッシュ
+
+    合計サイズが max_bytes を超えたら最終アクセスが古いものから削除する。
+    """
+
+    LOOKUP_CHUNK = 500
+
+    def __init__(self, path: Path, max_bytes: int = DEFAULT_CACHE_MAX_MB * 1024 * 1024):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.stored = 0
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                hash BLOB PRIMARY KEY,
+                response BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+            """
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)"
+        )
+
+    def contains_many(self, hashes: list[bytes]) -> set[bytes]:
+        """キャッシュに存在するハッシュを返し、最終アクセス時刻を更新"""
+        found: set[bytes] = set()
+        for i in range(0, len(hashes), self.LOOKUP_CHUNK):
+            chunk = hashes[i : i + self.LOOKUP_CHUNK]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.conn.execute(
+                f"SELECT hash FROM responses WHERE hash IN ({placeholders})", chunk
+            )
+            found.update(row[0] for row in rows)
+        now = time.time()
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE responses SET accessed_at = ? WHERE hash = ?",
+                [(now, h) for h in found],
+            )
+        return found
+
+    def get_many(self, hashes: list[bytes]) -> dict[bytes, tuple[dict, float]]:
+        """ハッシュごとの (response, 登録時刻) を返し、最終アクセス時刻をまとめて更新"""
+        found: dict[bytes, tuple[dict, float]] = {}
+        for i in range(0, len(hashes), self.LOOKUP_CHUNK):
+            chunk = hashes[i : i + self.LOOKUP_CHUNK]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.conn.execute(
+                "SELECT hash, response, created_at FROM responses "
+                f"WHERE hash IN ({placeholders})",
+                chunk,
+            )
+            for h, blob, created_at in rows:
+                found[h] = json.loads(zlib.decompress(blob)), created_at
+        now = time.time()
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE responses SET accessed_at = ? WHERE hash = ?",
+                [(now, h) for h in found],
+            )
+        return found
+
+    def put_many(self, items: Iterable[tuple[bytes, dict]]) -> int:
+        now = time.time()
+        rows = []
+        for h, response in items:
+            blob = zlib.compress(json.dumps(response, ensure_ascii=False).encode())
+            rows.append((h, blob, len(blob), now, now))
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)", rows
+            )
+        self.stored += len(rows)
+        return len(rows)
+
+    def stats(self) -> tuple[int, int]:
+        """(件数, 合計バイト数)"""
+        count, size = self.conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()
+        return count, size
+
+    def evict(self) -> int:
+        """合計サイズが max_bytes の 9 割以下になるまで最終アクセスが古いものを削除"""
+        self.stored = 0
+        _, size = self.stats()
+        if size <= self.max_bytes:
+            return 0
+
+        target = size - int(self.max_bytes * 0.9)
+        freed = 0
+        victims = []
+        for h, row_size in self.conn.execute(
+            "SELECT hash, size FROM responses ORDER BY accessed_at"
+        ):
+            if freed >= target:
+                break
+            victims.append((h,))
+            freed += row_size
+        with self.conn:
+            self.conn.executemany("DELETE FROM responses WHERE hash = ?", victims)
+        return len(victims)
+
+    def clear(self) -> None:
+        with self.conn:
+            self.conn.execute("DELETE FROM responses")
+        self.conn.execute("VACUUM")
+
+    def close(self) -> None:
+        """登録後に evict していなければ、上限を超えた分を削除してから閉じる"""
+        if self.stored:
+            self.evict()
+        self.conn.close()
+
+
+def open_response_cache(max_mb: int = DEFAULT_CACHE_MAX_MB) -> ResponseCache:
+    return ResponseCache(cache_dir() / "responses.sqlite", max_mb * 1024 * 1024)
+
+
+def filter_cache_misses(
+    lines: Iterable[bytes],
+    cache: ResponseCache,
+    model: str,
+    counter: Counter,
+    chunk_size: int = 1000,
+) -> Iterator[bytes]:
+    """キャッシュ済みのリクエストを除外し、未回答の行だけを返す"""
+
+    def flush(chunk: list[tuple[bytes, bytes]]) -> Iterator[bytes]:
+        hits = cache.contains_many([h for h, _ in chunk])
+        for h, line in chunk:
+            if h in hits:
+                counter["cached"] += 1
+            else:
+                counter["submitted"] += 1
+                yield line
+
+    chunk: list[tuple[bytes, bytes]] = []
+    for line in lines:
+        row = json.loads(line)
+        chunk.append((request_hash(model, row.get("request", {})), line))
+        if len(chunk) >= chunk_size:
+            yield from flush(chunk)
+            chunk = []
+    yield from flush(chunk)
+
+
+def fill_cache_from_outputs(
+    lines: Iterable[tuple[str, bytes]],
+    cache: ResponseCache,
+    model_by_uri: dict[str, str],
+    counter: Counter,
+    chunk_size: int = 1000,
+) -> Iterator[tuple[str, bytes]]:
+    """(URI, 出力行) を素通ししつつ、成功行のレスポンスをキャッシュに登録"""
+    chunk: list[tuple[bytes, dict]] = []
+    for uri, line in lines:
+        row = json.loads(line)
+        if not row.get("status") and "request" in row and "response" in row:
+            h = request_hash(model_by_uri[uri], row["request"])
+            chunk.append((h, row["response"]))
+            if len(chunk) >= chunk_size:
+                counter["cache_filled"] += cache.put_many(chunk)
+                chunk = []
+        yield uri, line
+    counter["cache_filled"] += cache.put_many(chunk)
+
+
+def cached_row_lookup(
+    cache: ResponseCache, model: str
+) -> Callable[[list[bytes]], list[bytes | None]]:
+    """出力のない入力行をまとめてキャッシュから出力形式の行に復元する関数を返す"""
+
+    def lookup(input_lines: list[bytes]) -> list[bytes | None]:
+        rows = [json.loads(line) for line in input_lines]
+        hashes = [request_hash(model, row.get("request", {})) for row in rows]
+        hits = cache.get_many(hashes)
+        outputs: list[bytes | None] = []
+        for row, h in zip(rows, hashes):
+            if h not in hits:
+                outputs.append(None)
+                continue
+            response, created_at = hits[h]
+            processed_time = datetime.fromtimestamp(created_at, timezone.utc)
+            output = {
+                "key": row.get("key"),
+                "status": "",
+                "processed_time": processed_time.isoformat().replace("+00:00", "Z"),
+                "request": row.get("request", {}),
+                "response": response,
+                "cached": True,
+            }
+            outputs.append(json.dumps(output, ensure_ascii=False).encode() + b"\n")
+        return outputs
+
+    return lookup
+
+
+class ExternalSorter:
+    """メモリ上限を超えた分をソート済みランとしてディスクに退避し、最後に k-way マージする
+
+    要素は (sort_key, value) のタプル。sort_key が等しい要素は追加順を保つ。
+    """
+
+    def __init__(self, work_dir: Path, max_bytes: int = DEFAULT_SPILL_MB * 1024 * 1024):
+        self.work_dir = work_dir
+        self.max_bytes = max_bytes
+        self.buffer: list[tuple[Any, bytes]] = []
+        self.buffer_bytes = 0
+        self.runs: list[Path] = []
+
+    def add(self, sort_key: Any, value: bytes) -> None:
+        self.buffer.append((sort_key, value))
+        self.buffer_bytes += len(value) + 64
+        if self.buffer_bytes >= self.max_bytes:
+            self._spill()
+
+    def _spill(self) -> None:
+        self.buffer.sort(key=itemgetter(0))
+        fd, name = tempfile.mkstemp(prefix="run-", suffix=".pkl", dir=self.work_dir)
+        with os.fdopen(fd, "wb", buffering=1024 * 1024) as f:
+            for item in self.buffer:
+                pickle.dump(item, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.runs.append(Path(name))
+        self.buffer = []
+        self.buffer_bytes = 0
+
+    @staticmethod
+    def _read_run(path: Path) -> Iterator[tuple[Any, bytes]]:
+        with open(path, "rb", buffering=1024 * 1024) as f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    break
+        path.unlink()
+
+    def __iter__(self) -> Iterator[tuple[Any, bytes]]:
+        if not self.runs:
+            self.buffer.sort(key=itemgetter(0))
+            items, self.buffer = self.buffer, []
+            yield from items
+            return
+
+        if self.buffer:
+            self._spill()
+        runs, self.runs = self.runs, []
+        yield from heapq.merge(*(self._read_run(p) for p in runs), key=itemgetter(0))
+
+
+def row_key(row: dict) -> str | None:
+    """入出力行の key を比較可能な文字列に正規化"""
+    key = row.get("key")
+    if key is None or isinstance(key, str):
+        return key
+    return json.dumps(key, sort_keys=True)
+
+
+def join_key(row: dict) -> tuple[bool, str] | None:
+    """結合・並べ替え用の key。str の "5" と int の 5 が一致しないよう型を残す"""
+    key = row_key(row)
+    if key is None:
+        return None
+    return not isinstance(row["key"], str), key
+
+
+def list_prediction_files(
+    storage: GCSStorage | LocalStorage, dest_uri: str
+) -> list[str]:
+    """ジョブ出力先から predictions*.jsonl を列挙"""
+    prefix = dest_uri.rstrip("/") + "/"
+    return [
+        uri
+        for uri in storage.list(prefix)
+        if uri.rsplit("/", 1)[-1].startswith("predictions") and uri.endswith(".jsonl")
+    ]
+
+
+def iter_output_lines(
+    storage: GCSStorage | LocalStorage,
+    uris: list[str],
+    work_dir: Path,
+    workers: int = 8,
+) -> Iterator[tuple[str, bytes]]:
+    """出力ファイルを並列にダウンロードし、ダウンロードが終わったものから (URI, 行) を返す"""
+
+    def download(i: int, uri: str) -> Path:
+        local_path = work_dir / f"predictions-{i:05d}.jsonl"
+        storage.download(uri, local_path)
+        return local_path
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(download, i, uri): uri for i, uri in enumerate(uris)}
+        for future in as_completed(futures):
+            local_path = future.result()
+            for line in iter_jsonl_lines(local_path):
+                yield futures[future], line
+            local_path.unlink()
+
+
+def pick_best_rows(
+    sorted_rows: Iterable[tuple[tuple[Any, int, int], bytes]],
+) -> Iterator[tuple[Any, bytes]]:
+    """key ごとに 1 行を選ぶ (status が空の成功行、次に優先度の値が小さい行を優先)"""
+    for key, group in itertools.groupby(sorted_rows, key=lambda item: item[0][0]):
+        yield key, next(group)[1]
+
+
+@dataclass
+class JoinStats:
+    """results の集計"""
+
+    written: int = 0
+    filled: int = 0
+    missing: int = 0
+    unmatched: int = 0
+    no_key: int = 0
+    input_no_key: int = 0
+
+
+def join_results(
+    output_rows: Iterable[tuple[int, bytes]],
+    out,
+    work_dir: Path,
+    input_path: Path | None = None,
+    spill_bytes: int = DEFAULT_SPILL_MB * 1024 * 1024,
+    fallback: Callable[[list[bytes]], list[bytes | None]] | None = None,
+    fallback_chunk: int = 1000,
+) -> JoinStats:
+    """出力行を key で並べ替えて書き出す
+
+    output_rows は (優先度, 行)。同じ key の行が複数あれば成功行、次に優先度の値が
+    小さい行を採用する。
+    input_path を指定した場合は入力の行順に並べる。
+    入力と出力をそれぞれ key で外部ソートしてマージ結合し、
+    結合結果を入力の行番号で再度外部ソートするため、メモリ使用量は spill_bytes 程度に収まる。
+    入力に存在しない key の出力行は末尾に key 順で追加する (これもディスクに退避する)。
+    key のない入力行は結合できないため、件数だけ input_no_key に数える。
+    出力のない入力行は fallback (入力行のリスト -> 出力行のリスト) があれば
+    fallback_chunk 行ずつまとめて補完する。
+    """
+    stats = JoinStats()
+    no_key_rows = ExternalSorter(work_dir, spill_bytes)
+
+    outputs = ExternalSorter(work_dir, spill_bytes)
+    for priority, line in output_rows:
+        row = json.loads(line)
+        key = join_key(row)
+        if key is None:
+            no_key_rows.add(stats.no_key, line)
+            stats.no_key += 1
+            continue
+        failed = 1 if row.get("status") else 0
+        outputs.add((key, failed, priority), line)
+
+    if input_path is None:
+        for _, line in pick_best_rows(outputs):
+            out.write(line)
+            stats.written += 1
+    else:
+        inputs = ExternalSorter(work_dir, spill_bytes)
+        for seq, line in enumerate(iter_jsonl_lines(input_path)):
+            key = join_key(json.loads(line))
+            if key is None:
+                stats.input_no_key += 1
+            else:
+                inputs.add((key, seq), line)
+
+        ordered = ExternalSorter(work_dir, spill_bytes)
+        unmatched = ExternalSorter(work_dir, spill_bytes)
+
+        pending: list[tuple[int, bytes]] = []
+
+        def flush_missing() -> None:
+            rows = fallback([line for _, line in pending]) if fallback else []
+            for (seq, _), row in itertools.zip_longest(pending, rows):
+                if row is None:
+                    stats.missing += 1
+                else:
+                    ordered.add(seq, row)
+                    stats.filled += 1
+            pending.clear()
+
+        def fill_missing(group: Iterable[tuple[tuple[Any, int], bytes]]) -> None:
+            for (_, seq), input_line in group:
+                pending.append((seq, input_line))
+                if len(pending) >= fallback_chunk:
+                    flush_missing()
+
+        input_groups = itertools.groupby(inputs, key=lambda item: item[0][0])
+        current = next(input_groups, None)
+        for key, line in pick_best_rows(outputs):
+            while current is not None and current[0] < key:
+                fill_missing(current[1])
+                current = next(input_groups, None)
+            if current is not None and current[0] == key:
+                for (_, seq), _ in current[1]:
+                    ordered.add(seq, line)
+                current = next(input_groups, None)
+            else:
+                unmatched.add(stats.unmatched, line)
+                stats.unmatched += 1
+        while current is not None:
+            fill_missing(current[1])
+            current = next(input_groups, None)
+        flush_missing()
+
+        for _, line in ordered:
+            out.write(line)
+            stats.written += 1
+        for _, line in unmatched:
+            out.write(line)
+
+    for _, line in no_key_rows:
+        out.write(line)
+    return stats
+
+
+def check_row(row: Any) -> str | None:
+    """入力行が {"key", "request": {"contents": [...]}} の形式か確認し、問題があれば理由を返す"""
+    if not isinstance(row, dict):
+        return "row is not an object"
+    key = row.get("key")
+    if key is not None and not isinstance(key, str):
+        return "key must be a string"
+    request = row.get("request")
+    if not isinstance(request, dict):
+        return "missing request object"
+    contents = request.get("contents")
+    if not isinstance(contents, list) or not contents:
+        return "request.contents must be a non-empty array"
+    for i, content in enumerate(contents):
+        if not isinstance(content, dict):
+            return f"request.contents[{i}] is not an object"
+        if content.get("role", "user") not in ("user", "model"):
+            return f"request.contents[{i}].role must be user or model"
+        parts = content.get("parts")
+        if not isinstance(parts, list) or not parts:
+            return f"request.contents[{i}].parts must be a non-empty array"
+    return None
+
+
+def estimate_tokens(request: dict) -> int:
+    """request のテキストからトークン数を概算 (ASCII は 4 文字 1 トークン、それ以外は 1 文字 1 トークン)"""
+    contents = list(request.get("contents") or [])
+    system = request.get("system_instruction") or request.get("systemInstruction")
+    if isinstance(system, dict):
+        contents.append(system)
+
+    ascii_chars = other_chars = media = 0
+    for content in contents:
+        for part in content.get("parts") or []:
+            if not isinstance(part, dict):
+                continue
+            text = part.get("text")
+            if isinstance(text, str):
+                n_ascii = len(text.encode("ascii", "ignore"))
+                ascii_chars += n_ascii
+                other_chars += len(text) - n_ascii
+            elif part:
+                media += 1
+    return (ascii_chars + 3) // 4 + other_chars + media * MEDIA_PART_TOKENS
+
+
+def key_hash(key: str) -> int:
+    """重複検出用の 64 bit ハッシュ"""
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+def split_chunks(path: Path, n_chunks: int) -> list[tuple[int, int]]:
+    """ファイルを行境界でおおよそ n_chunks 個のバイト範囲に分割"""
+    size = path.stat().st_size
+    if size == 0:
+        return []
+    if n_chunks <= 1:
+        return [(0, size)]
+
+    bounds = [0]
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        step = size // n_chunks
+        for i in range(1, n_chunks):
+            nl = mm.find(b"\n", max(bounds[-1], i * step))
+            if nl == -1:
+                break
+            if nl + 1 > bounds[-1]:
+                bounds.append(nl + 1)
+    if bounds[-1] < size:
+        bounds.append(size)
+    return list(zip(bounds, bounds[1:]))
+
+
+def _iter_mmap_lines(path: Path, start: int, end: int) -> Iterator[tuple[int, bytes]]:
+    """バイト範囲内の行を (範囲内の行番号, 行) で返す"""
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        pos = start
+        line_no = 0
+        while pos < end:
+            nl = mm.find(b"\n", pos, end)
+            if nl == -1:
+                nl = end
+            yield line_no, mm[pos:nl]
+            pos = nl + 1
+            line_no += 1
+
+
+def _validate_chunk(
+    path: Path, start: int, end: int, *, partitions: int, max_errors: int
+) -> dict:
+    """1 チャンクを検証 (ProcessPoolExecutor のワーカーで実行)"""
+    errors: list[tuple[int, str]] = []
+    n_errors = no_key = lines = 0
+    hashes = [array("Q") for _ in range(partitions)]
+    line_bytes = array("I")
+    line_tokens = array("I")
+
+    for line_no, line in _iter_mmap_lines(path, start, end):
+        lines = line_no + 1
+        if not line.strip():
+            continue
+        try:
+            row = orjson.loads(line)
+        except orjson.JSONDecodeError as e:
+            message = f"invalid JSON: {e}"
+        else:
+            message = check_row(row)
+        if message:
+            n_errors += 1
+            if len(errors) < max_errors:
+                errors.append((line_no, message))
+            continue
+
+        key = row.get("key")
+        if key is None:
+            no_key += 1
+        else:
+            h = key_hash(key if isinstance(key, str) else str(key))
+            hashes[h % partitions].append(h)
+        line_bytes.append(len(line) + 1)
+        line_tokens.append(estimate_tokens(row["request"]))
+
+    return {
+        "lines": lines,
+        "errors": errors,
+        "n_errors": n_errors,
+        "no_key": no_key,
+        "hashes": [h.tobytes() for h in hashes],
+        "line_bytes": line_bytes.tobytes(),
+        "line_tokens": line_tokens.tobytes(),
+    }
+
+
+def _find_duplicate_hashes(parts: list[bytes]) -> list[int]:
+    """同じパーティションのハッシュ列から重複を探す"""
+    seen: set[int] = set()
+    dups: set[int] = set()
+    for data in parts:
+        hashes = array("Q")
+        hashes.frombytes(data)
+        for h in hashes:
+            if h in seen:
+                dups.add(h)
+            else:
+                seen.add(h)
+    return list(dups)
+
+
+def _find_keys(
+    path: Path, start: int, end: int, *, targets: set[int]
+) -> list[tuple[int, str]]:
+    """ハッシュが targets に含まれる行の (範囲内の行番号, key) を返す"""
+    found = []
+    for line_no, line in _iter_mmap_lines(path, start, end):
+        if not line.strip():
+            continue
+        try:
+            key = orjson.loads(line).get("key")
+        except (orjson.JSONDecodeError, AttributeError):
+            continue
+        if key is None:
+            continue
+        key = key if isinstance(key, str) else str(key)
+        if key_hash(key) in targets:
+            found.append((line_no, key))
+    return found
+
+
+@dataclass
+class ShardEstimate:
+    """シャード分割後の 1 シャードの見積もり"""
+
+    index: int
+    lines: int = 0
+    bytes: int = 0
+    tokens: int = 0
+
+
+@dataclass
+class ValidationReport:
+    """validate の結果"""
+
+    lines: int = 0
+    rows: int = 0
+    no_key: int = 0
+    n_errors: int = 0
+    errors: list[tuple[int, str]] | None = None
+    duplicates: dict[str, list[int]] | None = None
+    shards: list[ShardEstimate] | None = None
+    elapsed: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return not self.n_errors and not self.duplicates
+
+
+def validate_jsonl(
+    path: Path,
+    workers: int | None = None,
+    max_lines: int = DEFAULT_SHARD_MAX_LINES,
+    max_bytes: int = DEFAULT_SHARD_MAX_MB * 1024 * 1024,
+    max_errors: int = 20,
+) -> ValidationReport:
+    """入力 JSONL を並列に検証し、シャードごとの行数・トークン数を見積もる
+
+    ファイルを行境界でチャンクに分け、各ワーカーが mmap で読んでスキーマを確認する。
+    key の重複はハッシュ値をパーティションに分けて検出し、重複があった場合のみ
+    該当行を再走査して key と行番号を特定する。
+    """
+    started = time.monotonic()
+    workers = workers or os.cpu_count() or 1
+    if path.stat().st_size < PARALLEL_VALIDATE_MIN_BYTES:
+        workers = 1
+    partitions = workers
+    chunks = split_chunks(path, workers * 4)
+
+    starts = [start for start, _ in chunks]
+    ends = [end for _, end in chunks]
+
+    report = ValidationReport(errors=[], duplicates={}, shards=[])
+    with (
+        ProcessPoolExecutor(max_workers=workers)
+        if workers > 1
+        else nullcontext() as pool
+    ):
+        run = pool.map if pool else map
+        results = list(
+            run(
+                partial(
+                    _validate_chunk, path, partitions=partitions, max_errors=max_errors
+                ),
+                starts,
+                ends,
+            )
+        )
+
+        offsets = []
+        for result in results:
+            offsets.append(report.lines)
+            for line_no, message in result["errors"]:
+                if len(report.errors) < max_errors:
+                    report.errors.append((report.lines + line_no + 1, message))
+            report.lines += result["lines"]
+            report.n_errors += result["n_errors"]
+            report.no_key += result["no_key"]
+
+        dup_hashes: set[int] = set()
+        for dups in run(
+            _find_duplicate_hashes,
+            [[r["hashes"][p] for r in results] for p in range(partitions)],
+        ):
+            dup_hashes.update(dups)
+
+        if dup_hashes:
+            found_keys = run(
+                partial(_find_keys, path, targets=dup_hashes), starts, ends
+            )
+            for offset, found in zip(offsets, found_keys):
+                for line_no, key in found:
+                    report.duplicates.setdefault(key, []).append(offset + line_no + 1)
+            report.duplicates = {
+                k: v for k, v in report.duplicates.items() if len(v) > 1
+            }
+
+    shard = None
+    for result in results:
+        sizes = array("I")
+        sizes.frombytes(result["line_bytes"])
+        tokens = array("I")
+        tokens.frombytes(result["line_tokens"])
+        for size, n_tokens in zip(sizes, tokens):
+            if (
+                shard is None
+                or shard.lines >= max_lines
+                or shard.bytes + size > max_bytes
+            ):
+                shard = ShardEstimate(len(report.shards))
+                report.shards.append(shard)
+            shard.lines += 1
+            shard.bytes += size
+            shard.tokens += n_tokens
+            report.rows += 1
+
+    report.elapsed = time.monotonic() - started
+    return report
+
+
+def print_validation_report(
+    report: ValidationReport, path: Path, price_per_mtok: float | None = None
+) -> None:
+    """validate の結果を表示"""
+    size_mb = path.stat().st_size / 1024 / 1024
+    rate = size_mb / report.elapsed if report.elapsed else 0
+    print(
+        f"Validated {report.lines} lines ({size_mb:.1f} MB) "
+        f"in {report.elapsed:.2f}s ({rate:.0f} MB/s)"
+    )
+
+    if report.n_errors:
+        print(f"\nErrors: {report.n_errors}")
+        for line_no, message in report.errors:
+            print(f"  line {line_no}: {message}")
+        if report.n_errors > len(report.errors):
+            print(f"  ... and {report.n_errors - len(report.errors)} more")
+
+    if report.duplicates:
+        print(f"\nDuplicate keys: {len(report.duplicates)}")
+        for key, line_nos in list(report.duplicates.items())[:20]:
+            print(f"  {key!r}: lines {', '.join(map(str, line_nos))}")
+
+    if report.no_key:
+        print(f"\nWarning: {report.no_key} rows have no key")
+
+    print(f"\n{'Shard':>6} {'Lines':>10} {'MB':>9} {'Tokens':>14} {'Cost':>10}")
+    total_tokens = 0
+    for shard in report.shards:
+        total_tokens += shard.tokens
+        cost = (
+            f"${shard.tokens / 1e6 * price_per_mtok:.2f}"
+            if price_per_mtok is not None
+            else "-"
+        )
+        print(
+            f"{shard.index:>6} {shard.lines:>10} {shard.bytes / 1024 / 1024:>9.1f} "
+            f"{shard.tokens:>14} {cost:>10}"
+        )
+    total_cost = (
+        f", ${total_tokens / 1e6 * price_per_mtok:.2f}"
+        if price_per_mtok is not None
+        else ""
+    )
+    print(
+        f"Total: {report.rows} rows in {len(report.shards)} shards, "
+        f"~{total_tokens} input tokens{total_cost}"
+    )
+
+
+def cmd_validate(args):
+    """入力 JSONL を投入前に検証"""
+    path = Path(args.input)
+    report = validate_jsonl(
+        path,
+        workers=args.workers,
+        max_lines=args.shard_max_lines,
+        max_bytes=args.shard_max_mb * 1024 * 1024,
+    )
+    print_validation_report(report, path, args.input_price)
+    if not report.ok:
+        sys.exit(1)
+
+
+def cmd_create(args):
+    """バッチジョブを作成"""
+    client = create_client(args.project, args.region)
+
+    if args.input:
+        if args.validate:
+            report = validate_jsonl(
+                Path(args.input),
+                max_lines=args.shard_max_lines,
+                max_bytes=args.shard_max_mb * 1024 * 1024,
+            )
+            print_validation_report(report, Path(args.input))
+            if not report.ok:
+                print("Error: Validation failed. No job created.", file=sys.stderr)
+                sys.exit(1)
+            print()
+
+        lines: Iterable[bytes] = iter_jsonl_lines(Path(args.input))
+        counter: Counter = Counter()
+        cache = open_response_cache(args.cache_max_mb) if args.cache else None
+        if cache:
+            lines = filter_cache_misses(lines, cache, args.model, counter)
+        manifest = None
+        if args.manifest:
+            manifest = open_manifest(
+                args.manifest,
+                Path(args.input),
+                args.output_uri,
+                args.model,
+                args.display_name,
+                args.staging_uri,
+                args.shard_max_lines,
+                args.shard_max_mb * 1024 * 1024,
+                cache=args.cache,
+            )
+
+        try:
+            jobs = create_sharded_jobs(
+                client,
+                create_storage(args.project),
+                lines,
+                args.output_uri,
+                args.model,
+                display_name=args.display_name,
+                staging_uri=args.staging_uri,
+                max_lines=args.shard_max_lines,
+                max_bytes=args.shard_max_mb * 1024 * 1024,
+                workers=args.upload_workers,
+                manifest=manifest,
+            )
+        except RuntimeError as e:
+            print(f"Error: {e}", file=sys.stderr)
+            sys.exit(1)
+        finally:
+            if cache:
+                cache.evict()
+                cache.close()
+
+        if cache:
+            print(
+                f"Cache: {counter['cached']} cached, {counter['submitted']} submitted"
+            )
+        if not jobs:
+            print("All requests are cached. No job created.")
+            return
+        print(f"Created {len(jobs)} batch jobs")
+        if manifest:
+            print(f"Wait: wait --manifest {args.manifest}")
+        else:
+            print(f"Wait: wait --display-name-prefix {args.display_name}-shard-")
+        return
+
+    from google.genai import types
+
+    batch_job = client.batches.create(
+        model=args.model,
+        src=args.input_uri,
+        config=types.CreateBatchJobConfig(
+            display_name=args.display_name,
+            dest=args.output_uri,
+        ),
+    )
+
+    print(f"Created batch job: {batch_job.name}")
+    print(f"State: {batch_job.state.name}")
+
+
+def cmd_status(args):
+    """ジョブの状態を確認"""
+    client = create_client(args.project, args.region)
+    job = client.batches.get(name=args.job_name)
+
+    print(f"Name: {job.name}")
+    print(f"State: {job.state.name}")
+    print(f"Model: {job.model}")
+    if job.dest:
+        print(f"Output: {job.dest.gcs_uri}")
+    if job.error:
+        print(f"Error: {job.error}")
+
+
+def format_time(value: datetime) -> str:
+    """UTC の固定幅 ISO 形式 (文字列の大小が時刻の前後と一致する)"""
+    return value.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def parse_time(value: str) -> datetime:
+    """ISO 形式の日時、または 30m / 12h / 7d のような現在からの相対時間"""
+    m = re.fullmatch(r"(\d+)([smhd])", value)
+    if m:
+        unit = {"s": 1, "m": 60, "h": 3600, "d": 86400}[m.group(2)]
+        return datetime.fromtimestamp(
+            time.time() - int(m.group(1)) * unit, timezone.utc
+        )
+    parsed = datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+class JobIndex:
+    """ジョブ一覧のローカル索引 (SQLite)
+
+    プロジェクト・リージョンごとに、索引にある最新の作成時刻以降のジョブと
+    終了状態でないジョブだけを API から取得して更新する。
+    """
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                name TEXT PRIMARY KEY,
+                scope TEXT NOT NULL,
+                display_name TEXT,
+                model TEXT,
+                state TEXT,
+                create_time TEXT,
+                end_time TEXT,
+                data TEXT NOT NULL
+            )
+            """
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_scope_created ON jobs (scope, create_time)"
+        )
+
+    def upsert(self, scope: str, jobs: Iterable[types.BatchJob]) -> int:
+        rows = [
+            (
+                job.name,
+                scope,
+                job.display_name,
+                normalize_model(job.model or ""),
+                job.state.name if job.state else None,
+                format_time(job.create_time) if job.create_time else None,
+                format_time(job.end_time) if job.end_time else None,
+                job.model_dump_json(exclude_none=True),
+            )
+            for job in jobs
+        ]
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows
+            )
+        return len(rows)
+
+    def delete(self, scope: str, names: Iterable[str]) -> None:
+        with self.conn:
+            self.conn.executemany(
+                "DELETE FROM jobs WHERE scope = ? AND name = ?",
+                [(scope, name) for name in names],
+            )
+
+    def latest_create_time(self, scope: str) -> str | None:
+        row = self.conn.execute(
+            "SELECT MAX(create_time) FROM jobs WHERE scope = ?", (scope,)
+        ).fetchone()
+        return row[0]
+
+    def active_job_names(self, scope: str) -> list[str]:
+        placeholders = ",".join("?" * len(TERMINAL_STATES))
+        rows = self.conn.execute(
+            f"SELECT name FROM jobs WHERE scope = ? AND state NOT IN ({placeholders})",
+            (scope, *TERMINAL_STATES),
+        )
+        return [row[0] for row in rows]
+
+    def refresh(self, client: genai.Client, scope: str) -> tuple[int, int]:
+        """新しいジョブと終了していないジョブを取得する。(新規, 更新) の件数を返す
+
+        サーバーで削除されたジョブ (404) は索引から消す。その他のエラーは警告して
+        そのジョブだけ次回に回し、残りの更新は続ける。
+        """
+        from google.genai import errors as genai_errors
+        from google.genai import types
+
+        latest = self.latest_create_time(scope)
+        config = types.ListBatchJobsConfig(page_size=100)
+        if latest:
+            # 同時刻のジョブを取りこぼさないよう境界を含め、重複は上書きで吸収する
+            config.filter = f'create_time>="{latest}"'
+        active = set(self.active_job_names(scope))
+
+        new_jobs = list(client.batches.list(config=config))
+        self.upsert(scope, new_jobs)
+        active -= {job.name for job in new_jobs}
+
+        deleted: list[str] = []
+
+        async def fetch_all() -> list[types.BatchJob | None]:
+            semaphore = asyncio.Semaphore(MAX_CONCURRENT_POLLS)
+
+            async def fetch(name: str) -> types.BatchJob | None:
+                try:
+                    async with semaphore:
+                        return await client.aio.batches.get(name=name)
+                except genai_errors.APIError as e:
+                    if e.code == 404:
+                        deleted.append(name)
+                    else:
+                        print(
+                            f"Warning: Failed to refresh {name}: {e}", file=sys.stderr
+                        )
+                except (OSError, asyncio.TimeoutError) as e:
+                    print(f"Warning: Failed to refresh {name}: {e}", file=sys.stderr)
+                return None
+
+            return await asyncio.gather(*(fetch(name) for name in active))
+
+        fetched = run_async(fetch_all()) if active else []
+        updated = [job for job in fetched if job is not None]
+        self.upsert(scope, updated)
+        self.delete(scope, deleted)
+        return len(new_jobs), len(updated)
+
+    def query(
+        self,
+        scope: str,
+        states: list[str] | None = None,
+        model: str | None = None,
+        display_name_prefix: str | None = None,
+        since: datetime | None = None,
+        until: datetime | None = None,
+        limit: int | None = None,
+    ) -> list[dict]:
+        """条件に合うジョブを作成時刻の新しい順に返す"""
+        where = ["scope = ?"]
+        params: list[Any] = [scope]
+        if states:
+            where.append(f"state IN ({','.join('?' * len(states))})")
+            params.extend(states)
+        if model:
+            where.append("model = ?")
+            params.append(normalize_model(model))
+        if display_name_prefix:
+            where.append("substr(display_name, 1, ?) = ?")
+            params.extend([len(display_name_prefix), display_name_prefix])
+        if since:
+            where.append("create_time >= ?")
+            params.append(format_time(since))
+        if until:
+            where.append("create_time < ?")
+            params.append(format_time(until))
+        sql = (
+            f"SELECT data FROM jobs WHERE {' AND '.join(where)} "
+            "ORDER BY create_time DESC"
+        )
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+        return [json.loads(row[0]) for row in self.conn.execute(sql, params)]
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+def cmd_list(args):
+    """ジョブ一覧を取得 (ローカル索引を差分更新して検索)"""
+    scope = f"{args.project}/{args.region}"
+    index = JobIndex(cache_dir() / "jobs.sqlite")
+    try:
+        if not args.no_refresh:
+            client = create_client(args.project, args.region)
+            new, updated = index.refresh(client, scope)
+            print(f"Refreshed: {new} new, {updated} updated", file=sys.stderr)
+
+        states = [
+            s if s.startswith("JOB_STATE_") else f"JOB_STATE_{s.upper()}"
+            for s in args.state or []
+        ]
+        jobs = index.query(
+            scope,
+            states=states,
+            model=args.model,
+            display_name_prefix=args.display_name_prefix,
+            since=parse_time(args.since) if args.since else None,
+            until=parse_time(args.until) if args.until else None,
+            limit=args.limit,
+        )
+    finally:
+        index.close()
+
+    if args.json:
+        for job in jobs:
+            print(json.dumps(job, ensure_ascii=False))
+        return
+    for job in jobs:
+        created = (job.get("create_time") or "")[:19]
+        print(
+            f"{job.get('state', ''):25} {created:19} {job['name']} "
+            f"{job.get('display_name', '')}"
+        )
+
+
+def cmd_wait(args):
+    """ジョブの完了を待機し、状態遷移の時刻をトレースとして記録"""
+    client = create_client(args.project, args.region)
+
+    manifest = RunManifest.load(Path(args.manifest)) if args.manifest else None
+    if manifest:
+        job_names = manifest.job_names()
+    elif args.display_name_prefix:
+        job_names = [
+            job.name
+            for job in client.batches.list()
+            if (job.display_name or "").startswith(args.display_name_prefix)
+        ]
+        if not job_names:
+            print(
+                f"Error: No jobs found with display name prefix: {args.display_name_prefix}",
+                file=sys.stderr,
+            )
+            sys.exit(1)
+    else:
+        job_names = args.job_name
+
+    jobs = wait_for_jobs(
+        client,
+        job_names,
+        poll_interval=args.poll_interval,
+        min_interval=args.min_poll_interval,
+        max_interval=args.max_poll_interval,
+        trace_dir=Path(args.trace_dir) if args.trace_dir else None,
+    )
+    if manifest:
+        manifest.record_states(jobs)
+    if any(job.state.name != "JOB_STATE_SUCCEEDED" for job in jobs):
+        sys.exit(1)
+
+
+def cmd_results(args):
+    """ジョブの出力をダウンロードし、key で並べ替えて 1 ファイルにまとめる"""
+    client = create_client(args.project, args.region)
+    storage = create_storage(args.project)
+
+    job_names = list(args.job_name)
+    input_path = Path(args.input) if args.input else None
+    if args.manifest:
+        manifest = RunManifest.load(Path(args.manifest))
+        job_names += manifest.job_names()
+        input_path = input_path or Path(manifest.params["input"])
+
+    model_by_uri: dict[str, str] = {}
+    for job_name in job_names:
+        job = client.batches.get(name=job_name)
+        if job.state.name != "JOB_STATE_SUCCEEDED":
+            print(f"Warning: {job.name} is {job.state.name}", file=sys.stderr)
+        if not job.dest or not job.dest.gcs_uri:
+            print(f"Warning: {job.name} has no GCS output", file=sys.stderr)
+            continue
+        for uri in list_prediction_files(storage, job.dest.gcs_uri):
+            model_by_uri[uri] = job.model
+
+    cache = open_response_cache(args.cache_max_mb) if args.cache else None
+    fallback = None
+    if cache:
+        model = args.model or next(iter(model_by_uri.values()), None)
+        if not model:
+            print("Error: --model is required when no job outputs", file=sys.stderr)
+            sys.exit(1)
+        fallback = cached_row_lookup(cache, model)
+
+    print(f"Downloading {len(model_by_uri)} output files...", file=sys.stderr)
+    counter: Counter = Counter()
+    with (
+        tempfile.TemporaryDirectory(prefix="batch-results-") as work_dir,
+        open(args.output, "wb", buffering=1024 * 1024) as out,
+    ):
+        tagged = iter_output_lines(
+            storage, list(model_by_uri), Path(work_dir), workers=args.download_workers
+        )
+        if cache:
+            tagged = fill_cache_from_outputs(tagged, cache, model_by_uri, counter)
+        stats = join_results(
+            ((0, line) for _, line in tagged),
+            out,
+            Path(work_dir),
+            input_path=input_path,
+            spill_bytes=args.spill_mb * 1024 * 1024,
+            fallback=fallback,
+        )
+
+    print(f"Wrote {stats.written} rows to {args.output}")
+    if cache:
+        evicted = cache.evict()
+        cache.close()
+        print(
+            f"Cache: {stats.filled} rows from cache, "
+            f"{counter['cache_filled']} responses stored, {evicted} evicted"
+        )
+    print_join_warnings(stats)
+
+
+def print_join_warnings(stats: JoinStats) -> None:
+    """結合できなかった行の件数を警告表示"""
+    if stats.missing:
+        print(f"Warning: {stats.missing} input rows have no output", file=sys.stderr)
+    if stats.unmatched:
+        print(
+            f"Warning: {stats.unmatched} output rows not found in input (appended)",
+            file=sys.stderr,
+        )
+    if stats.no_key:
+        print(
+            f"Warning: {stats.no_key} output rows have no key (appended)",
+            file=sys.stderr,
+        )
+    if stats.input_no_key:
+        print(
+            f"Warning: {stats.input_no_key} input rows have no key (not joined)",
+            file=sys.stderr,
+        )
+
+
+def collect_failed_keys(
+    storage: GCSStorage | LocalStorage,
+    jobs: list[types.BatchJob],
+    candidates: set[str],
+    work_dir: Path,
+    workers: int = 8,
+) -> set[str]:
+    """candidates (そのジョブに投入した key) のうち、成功行が出力にない key を返す
+
+    失敗行だけでなく、出力に現れなかった行も再投入の対象になる。
+    """
+    uris = [
+        uri
+        for job in jobs
+        if job.dest and job.dest.gcs_uri
+        for uri in list_prediction_files(storage, job.dest.gcs_uri)
+    ]
+    succeeded: set[str] = set()
+    for _, line in iter_output_lines(storage, uris, work_dir, workers=workers):
+        row = json.loads(line)
+        key = row_key(row)
+        if key in candidates and not row.get("status"):
+            succeeded.add(key)
+    return candidates - succeeded
+
+
+def cmd_retry(args):
+    """失敗した行だけを再投入し、収束したら全結果を 1 ファイルにまとめる"""
+    client = create_client(args.project, args.region)
+    storage = create_storage(args.project)
+    input_path = Path(args.input)
+    poll_options = dict(
+        poll_interval=args.poll_interval,
+        min_interval=args.min_poll_interval,
+        max_interval=args.max_poll_interval,
+    )
+
+    attempts = [wait_for_jobs(client, args.job_name, **poll_options)]
+    model = args.model or normalize_model(attempts[0][0].model)
+
+    input_keys = {row_key(json.loads(line)) for line in iter_jsonl_lines(input_path)}
+    input_keys.discard(None)
+
+    with tempfile.TemporaryDirectory(prefix="batch-retry-") as work_dir:
+        failed = collect_failed_keys(
+            storage, attempts[-1], input_keys, Path(work_dir), args.download_workers
+        )
+        for attempt in range(1, args.max_attempts + 1):
+            if not failed:
+                break
+            print(f"\nAttempt {attempt}: retrying {len(failed)} failed rows")
+
+            lines = (
+                line
+                for line in iter_jsonl_lines(input_path)
+                if row_key(json.loads(line)) in failed
+            )
+            name = f"retry-{attempt:02d}"
+            try:
+                jobs = create_sharded_jobs(
+                    client,
+                    storage,
+                    lines,
+                    join_uri(args.output_uri, name),
+                    model,
+                    display_name=f"{args.display_name}-{name}",
+                    max_lines=args.shard_max_lines,
+                    max_bytes=args.shard_max_mb * 1024 * 1024,
+                    workers=args.upload_workers,
+                )
+            except RuntimeError as e:
+                print(f"Error: {e}", file=sys.stderr)
+                sys.exit(1)
+
+            attempts.append(
+                wait_for_jobs(client, [job.name for job in jobs], **poll_options)
+            )
+            failed = collect_failed_keys(
+                storage, attempts[-1], failed, Path(work_dir), args.download_workers
+            )
+
+        # 後の試行の出力ほど優先する
+        uris_by_attempt = [
+            (len(attempts) - i, uri)
+            for i, jobs in enumerate(attempts)
+            for job in jobs
+            if job.dest and job.dest.gcs_uri
+            for uri in list_prediction_files(storage, job.dest.gcs_uri)
+        ]
+        priority_by_uri = {uri: priority for priority, uri in uris_by_attempt}
+        tagged = iter_output_lines(
+            storage,
+            list(priority_by_uri),
+            Path(work_dir),
+            workers=args.download_workers,
+        )
+        with open(args.output, "wb", buffering=1024 * 1024) as out:
+            stats = join_results(
+                ((priority_by_uri[uri], line) for uri, line in tagged),
+                out,
+                Path(work_dir),
+                input_path=input_path,
+                spill_bytes=args.spill_mb * 1024 * 1024,
+            )
+
+    print()
+    print(f"Wrote {stats.written} rows to {args.output} ({len(attempts) - 1} retries)")
+    print_join_warnings(stats)
+    if failed:
+        print(f"Warning: {len(failed)} rows still failed", file=sys.stderr)
+        sys.exit(1)
+
+
+class UsageAggregator:
+    """usageMetadata のトークン数をジョブ・key プレフィックス・モデルごとに集計
+
+    行ごとの値は一旦 array に溜め、batch_rows 行ごとに numpy でまとめて集計する。
+    パーセンタイルは対数スケールのヒストグラム (1 オクターブあたり 8 区間、誤差 ~5%) で
+    近似するため、メモリ使用量はグループ数にのみ比例する。
+    key がほぼ一意だとグループ数が行数に比例するため、次元ごとに max_groups 個を
+    超えて現れたグループは OTHER_GROUP にまとめる。
+    """
+
+    METRICS = ("promptTokenCount", "candidatesTokenCount", "totalTokenCount")
+    DIMENSIONS = ("job", "key_prefix", "model")
+    BUCKETS_PER_OCTAVE = 8
+    N_BUCKETS = 256
+    OTHER_GROUP = "(other)"
+
+    def __init__(self, batch_rows: int = 65536, max_groups: int = DEFAULT_MAX_GROUPS):
+        import numpy as np
+
+        self.np = np
+        self.batch_rows = batch_rows
+        self.max_groups = max_groups
+        self.codes: dict[str, dict[str, int]] = {d: {} for d in self.DIMENSIONS}
+        self.pending_ids = {d: array("i") for d in self.DIMENSIONS}
+        self.pending_values = array("q")
+        n_metrics = len(self.METRICS)
+        self.rows = {d: np.zeros(0, np.int64) for d in self.DIMENSIONS}
+        self.sums = {d: np.zeros((0, n_metrics), np.int64) for d in self.DIMENSIONS}
+        self.maxes = {d: np.zeros((0, n_metrics), np.int64) for d in self.DIMENSIONS}
+        self.hists = {
+            d: np.zeros((0, n_metrics, self.N_BUCKETS), np.int64)
+            for d in self.DIMENSIONS
+        }
+        self.errors = 0
+
+    def add(self, groups: tuple[str, str, str], values: Iterable[int]) -> None:
+        for dimension, group in zip(self.DIMENSIONS, groups):
+            codes = self.codes[dimension]
+            code = codes.get(group)
+            if code is None:
+                if len(codes) >= self.max_groups:
+                    group = self.OTHER_GROUP
+                    code = codes.get(group)
+                if code is None:
+                    code = codes[group] = len(codes)
+            self.pending_ids[dimension].append(code)
+        self.pending_values.extend(values)
+        if len(self.pending_values) >= self.batch_rows * len(self.METRICS):
+            self.flush()
+
+    def _grow(self, dimension: str) -> None:
+        np = self.np
+        n = len(self.codes[dimension])
+        extra = n - len(self.rows[dimension])
+        if extra <= 0:
+            return
+        self.rows[dimension] = np.concatenate(
+            [self.rows[dimension], np.zeros(extra, np.int64)]
+        )
+        for table in (self.sums, self.maxes, self.hists):
+            current = table[dimension]
+            table[dimension] = np.concatenate(
+                [current, np.zeros((extra, *current.shape[1:]), np.int64)]
+            )
+
+    def flush(self) -> None:
+        np = self.np
+        if not self.pending_values:
+            return
+
+        n_metrics = len(self.METRICS)
+        values = np.frombuffer(self.pending_values, dtype=np.int64).reshape(
+            -1, n_metrics
+        )
+        buckets = np.minimum(
+            np.floor(np.log2(values + 1) * self.BUCKETS_PER_OCTAVE).astype(np.int64),
+            self.N_BUCKETS - 1,
+        )
+        metric_index = np.arange(n_metrics)
+
+        for dimension in self.DIMENSIONS:
+            self._grow(dimension)
+            n_groups = len(self.codes[dimension])
+            ids = np.frombuffer(self.pending_ids[dimension], dtype=np.int32).astype(
+                np.int64
+            )
+            self.rows[dimension] += np.bincount(ids, minlength=n_groups)
+            np.add.at(self.sums[dimension], ids, values)
+            np.maximum.at(self.maxes[dimension], ids, values)
+            flat = (ids[:, None] * n_metrics + metric_index) * self.N_BUCKETS + buckets
+            self.hists[dimension] += np.bincount(
+                flat.ravel(), minlength=n_groups * n_metrics * self.N_BUCKETS
+            ).reshape(n_groups, n_metrics, self.N_BUCKETS)
+
+        self.pending_ids = {d: array("i") for d in self.DIMENSIONS}
+        self.pending_values = array("q")
+
+    def _percentile(self, hist, q: float, maximum: int) -> int:
+        np = self.np
+        cumulative = np.cumsum(hist)
+        if cumulative[-1] == 0:
+            return 0
+        bucket = int(np.searchsorted(cumulative, q * cumulative[-1]))
+        # 区間の幾何中央値で代表する
+        value = 2 ** ((bucket + 0.5) / self.BUCKETS_PER_OCTAVE) - 1
+        return int(min(round(value), maximum))
+
+    def summary(self) -> dict:
+        """{dimension: {group: {rows, metric: {sum, p50, p90, p99, max}}}}"""
+        self.flush()
+        result: dict = {}
+        for dimension in self.DIMENSIONS:
+            groups = {}
+            for group, code in self.codes[dimension].items():
+                entry: dict[str, Any] = {"rows": int(self.rows[dimension][code])}
+                for m, metric in enumerate(self.METRICS):
+                    hist = self.hists[dimension][code, m]
+                    maximum = int(self.maxes[dimension][code, m])
+                    entry[metric] = {
+                        "sum": int(self.sums[dimension][code, m]),
+                        "p50": self._percentile(hist, 0.5, maximum),
+                        "p90": self._percentile(hist, 0.9, maximum),
+                        "p99": self._percentile(hist, 0.99, maximum),
+                        "max": maximum,
+                    }
+                groups[group] = entry
+            result[dimension] = groups
+        return result
+
+
+def key_prefix(key: str | None, sep: str, depth: int) -> str:
+    """key の先頭 depth 要素をプレフィックスとして返す"""
+    if key is None:
+        return "(no key)"
+    return sep.join(key.split(sep)[:depth])
+
+
+def aggregate_usage(
+    rows: Iterable[tuple[str, bytes]],
+    job_by_uri: dict[str, types.BatchJob],
+    sep: str = "-",
+    depth: int = 1,
+    batch_rows: int = 65536,
+    max_groups: int = DEFAULT_MAX_GROUPS,
+) -> UsageAggregator:
+    """(URI, 出力行) から usageMetadata を集計"""
+    aggregator = UsageAggregator(batch_rows, max_groups)
+    metrics = UsageAggregator.METRICS
+    for uri, line in rows:
+        row = orjson.loads(line)
+        response = row.get("response") or {}
+        usage = response.get("usageMetadata")
+        if not usage:
+            aggregator.errors += 1
+            continue
+        job = job_by_uri[uri]
+        model = response.get("modelVersion") or normalize_model(job.model)
+        aggregator.add(
+            (job.name, key_prefix(row_key(row), sep, depth), model),
+            [usage.get(m, 0) for m in metrics],
+        )
+    aggregator.flush()
+    return aggregator
+
+
+def print_usage_summary(summary: dict, errors: int) -> None:
+    """usage-report の結果を表示"""
+    for dimension, groups in summary.items():
+        print(f"== By {dimension} ==")
+        print(
+            f"{'Group':<40} {'Rows':>10} {'Prompt':>14} {'Candidates':>14} "
+            f"{'Total':>14} {'p50':>8} {'p90':>8} {'p99':>8} {'Max':>8}"
+        )
+        for group, entry in sorted(groups.items()):
+            total = entry["totalTokenCount"]
+            label = group if len(group) <= 40 else "..." + group[-37:]
+            print(
+                f"{label:<40} {entry['rows']:>10} "
+                f"{entry['promptTokenCount']['sum']:>14} "
+                f"{entry['candidatesTokenCount']['sum']:>14} "
+                f"{total['sum']:>14} {total['p50']:>8} {total['p90']:>8} "
+                f"{total['p99']:>8} {total['max']:>8}"
+            )
+        print()
+    if errors:
+        print(f"Rows without usageMetadata: {errors}")
+
+
+def cmd_usage_report(args):
+    """ジョブ出力の usageMetadata をストリーミングで集計"""
+    client = create_client(args.project, args.region)
+    storage = create_storage(args.project)
+
+    job_by_uri: dict[str, types.BatchJob] = {}
+    for job_name in args.job_name:
+        job = client.batches.get(name=job_name)
+        if not job.dest or not job.dest.gcs_uri:
+            print(f"Warning: {job.name} has no GCS output", file=sys.stderr)
+            continue
+        for uri in list_prediction_files(storage, job.dest.gcs_uri):
+            job_by_uri[uri] = job
+
+    print(f"Reading {len(job_by_uri)} output files...", file=sys.stderr)
+    with tempfile.TemporaryDirectory(prefix="batch-usage-") as work_dir:
+        rows = iter_output_lines(
+            storage, list(job_by_uri), Path(work_dir), workers=args.download_workers
+        )
+        aggregator = aggregate_usage(
+            rows,
+            job_by_uri,
+            sep=args.key_prefix_sep,
+            depth=args.key_prefix_depth,
+            batch_rows=args.batch_rows,
+            max_groups=args.max_groups,
+        )
+
+    summary = aggregator.summary()
+    if args.json:
+        summary["errors"] = aggregator.errors
+        print(json.dumps(summary, indent=2, ensure_ascii=False))
+    else:
+        print_usage_summary(summary, aggregator.errors)
+
+
+EXPORT_COLUMNS = {
+    "key": "string",
+    "status": "string",
+    "processed_time": "timestamp",
+    "text": "string",
+    "finish_reason": "string",
+    "model_version": "string",
+    "prompt_tokens": "int64",
+    "candidates_tokens": "int64",
+    "total_tokens": "int64",
+    "thoughts_tokens": "int64",
+    "cached_tokens": "int64",
+    "error_message": "string",
+}
+
+
+def flatten_output_row(row: dict) -> dict:
+    """出力行を Parquet の列に平坦化"""
+    response = row.get("response") or {}
+    usage = response.get("usageMetadata") or {}
+    candidates = response.get("candidates") or []
+    candidate = candidates[0] if candidates else {}
+    parts = (candidate.get("content") or {}).get("parts") or []
+    text = "".join(
+        p.get("text", "") for p in parts if isinstance(p, dict) and not p.get("thought")
+    )
+    processed_time = row.get("processed_time")
+
+    return {
+        "key": row_key(row),
+        "status": row.get("status"),
+        "processed_time": datetime.fromisoformat(processed_time)
+        if processed_time
+        else None,
+        "text": text if candidates else None,
+        "finish_reason": candidate.get("finishReason"),
+        "model_version": response.get("modelVersion"),
+        "prompt_tokens": usage.get("promptTokenCount"),
+        "candidates_tokens": usage.get("candidatesTokenCount"),
+        "total_tokens": usage.get("totalTokenCount"),
+        "thoughts_tokens": usage.get("thoughtsTokenCount"),
+        "cached_tokens": usage.get("cachedContentTokenCount"),
+        # 出力行のエラーは status に入る (成功時は空文字列)
+        "error_message": row.get("status") or None,
+    }
+
+
+def export_parquet(
+    rows: Iterable[tuple[str, bytes]],
+    output_dir: Path,
+    row_group_size: int = DEFAULT_ROW_GROUP_SIZE,
+    keep_raw: bool = False,
+    compression: str = "zstd",
+) -> tuple[int, int]:
+    """(URI, 出力行) を出力ファイルごとに part-NNNNN.parquet へストリーミングで書き出す
+
+    row_group_size 行ごとに 1 つの行グループとして書き出すため、
+    メモリ上に保持するのは 1 行グループ分のみ。(ファイル数, 行数) を返す。
+    """
+    # pyarrow の import は遅いため export でのみ読み込む
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    types_by_name = {
+        "string": pa.string(),
+        "int64": pa.int64(),
+        "timestamp": pa.timestamp("us", tz="UTC"),
+    }
+    fields = [pa.field(name, types_by_name[t]) for name, t in EXPORT_COLUMNS.items()]
+    if keep_raw:
+        fields.append(pa.field("raw", pa.string()))
+    schema = pa.schema(fields)
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    columns: dict[str, list] = {f.name: [] for f in fields}
+    writer = None
+    current_uri = None
+    n_files = n_rows = 0
+
+    def flush() -> None:
+        if columns["key"]:
+            writer.write_batch(
+                pa.RecordBatch.from_pydict(columns, schema=schema),
+                row_group_size=row_group_size,
+            )
+            for values in columns.values():
+                values.clear()
+
+    for uri, line in rows:
+        if uri != current_uri:
+            if writer is not None:
+                flush()
+                writer.close()
+            writer = pq.ParquetWriter(
+                output_dir / f"part-{n_files:05d}.parquet",
+                schema,
+                compression=compression,
+            )
+            current_uri = uri
+            n_files += 1
+
+        for name, value in flatten_output_row(orjson.loads(line)).items():
+            columns[name].append(value)
+        if keep_raw:
+            columns["raw"].append(line.rstrip(b"\n").decode())
+        n_rows += 1
+        if len(columns["key"]) >= row_group_size:
+            flush()
+
+    if writer is not None:
+        flush()
+        writer.close()
+    return n_files, n_rows
+
+
+def cmd_export(args):
+    """ジョブ出力を Parquet データセットに変換"""
+    client = create_client(args.project, args.region)
+    storage = create_storage(args.project)
+
+    uris: list[str] = []
+    for job_name in args.job_name:
+        job = client.batches.get(name=job_name)
+        if not job.dest or not job.dest.gcs_uri:
+            print(f"Warning: {job.name} has no GCS output", file=sys.stderr)
+            continue
+        uris.extend(list_prediction_files(storage, job.dest.gcs_uri))
+
+    print(f"Converting {len(uris)} output files...", file=sys.stderr)
+    with tempfile.TemporaryDirectory(prefix="batch-export-") as work_dir:
+        rows = iter_output_lines(
+            storage, uris, Path(work_dir), workers=args.download_workers
+        )
+        n_files, n_rows = export_parquet(
+            rows,
+            Path(args.output_dir),
+            row_group_size=args.row_group_size,
+            keep_raw=args.raw,
+            compression=args.compression,
+        )
+
+    print(f"Wrote {n_rows} rows to {n_files} files in {args.output_dir}")
+
+
+class TokenBucket:
+    """毎秒 rate 個補充され、最大 capacity 個まで溜まるトークンバケット"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def request_to_config(request: dict) -> types.GenerateContentConfig:
+    """バッチ入力の request (GenerateContentRequest) を GenerateContentConfig に変換"""
+    from google.genai import types
+
+    camel = {
+        re.sub(r"_([a-z])", lambda m: m.group(1).upper(), k): v
+        for k, v in request.items()
+    }
+    config = dict(camel.get("generationConfig") or {})
+    for name in (
+        "systemInstruction",
+        "tools",
+        "toolConfig",
+        "safetySettings",
+        "cachedContent",
+        "labels",
+    ):
+        if name in camel:
+            config[name] = camel[name]
+    return types.GenerateContentConfig.model_validate(config)
+
+
+def is_retryable(error: Exception) -> bool:
+    import httpx
+    from google.genai import errors as genai_errors
+
+    if isinstance(error, genai_errors.APIError):
+        return error.code in RETRYABLE_STATUS_CODES
+    return isinstance(error, (OSError, asyncio.TimeoutError, httpx.TransportError))
+
+
+async def generate_online_row(
+    client: genai.Client,
+    model: str,
+    line: bytes,
+    bucket: TokenBucket,
+    max_retries: int,
+    counter: Counter,
+) -> bytes:
+    """1 行をオンライン API で処理し、バッチ出力と同じ形式の行を返す
+
+    JSON として読めない行や request が不正な行も、status にエラーを入れた行を返す。
+    """
+    output: dict[str, Any] = {"key": None}
+    try:
+        row = json.loads(line)
+        if not isinstance(row, dict):
+            raise ValueError("row is not an object")
+        request = row.get("request", {})
+        output.update(key=row.get("key"), request=request)
+        if not isinstance(request, dict):
+            raise ValueError("request is not an object")
+        config = request_to_config(request)
+    except ValueError as e:
+        counter["failed"] += 1
+        output["status"] = f"Invalid request: {e}"
+        return encode_online_row(output)
+
+    for attempt in range(max_retries + 1):
+        await bucket.acquire()
+        try:
+            response = await client.aio.models.generate_content(
+                model=model, contents=request.get("contents"), config=config
+            )
+        except Exception as e:
+            if attempt < max_retries and is_retryable(e):
+                counter["retries"] += 1
+                await asyncio.sleep(random.uniform(0, min(60, 2**attempt)))
+                continue
+            counter["failed"] += 1
+            output["status"] = str(e)
+            break
+        counter["succeeded"] += 1
+        output["status"] = ""
+        output["response"] = response.model_dump(
+            mode="json",
+            exclude_none=True,
+            by_alias=True,
+            exclude=RESPONSE_EXCLUDE_FIELDS,
+        )
+        break
+
+    return encode_online_row(output)
+
+
+def encode_online_row(output: dict[str, Any]) -> bytes:
+    """processed_time を付けてバッチ出力と同じ形式の 1 行にする"""
+    processed_time = datetime.now(timezone.utc).isoformat(timespec="milliseconds")
+    output["processed_time"] = processed_time.replace("+00:00", "Z")
+    return json.dumps(output, ensure_ascii=False).encode() + b"\n"
+
+
+async def run_online_async(
+    client: genai.Client,
+    model: str,
+    lines: Iterable[bytes],
+    out,
+    concurrency: int = 16,
+    rpm: float = 600,
+    max_retries: int = 5,
+    counter: Counter | None = None,
+) -> None:
+    """ワーカープールで行を並列に処理し、完了した順に out へ書き出す"""
+    counter = Counter() if counter is None else counter
+    bucket = TokenBucket(rpm / 60, capacity=max(1, min(concurrency, rpm / 60)))
+    queue: asyncio.Queue[bytes | None] = asyncio.Queue(maxsize=concurrency * 2)
+
+    async def worker() -> None:
+        while (line := await queue.get()) is not None:
+            # 1 行の想定外のエラーでワーカーが止まると、残りの行を誰も処理せず put が詰まる
+            try:
+                row = await generate_online_row(
+                    client, model, line, bucket, max_retries, counter
+                )
+            except Exception as e:
+                counter["failed"] += 1
+                row = encode_online_row({"key": None, "status": f"Internal error: {e}"})
+            out.write(row)
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    for line in lines:
+        await queue.put(line)
+    for _ in workers:
+        await queue.put(None)
+    await asyncio.gather(*workers)
+
+
+def cmd_run(args):
+    """件数に応じてオンライン API かバッチジョブで処理し、結果を入力順にまとめる"""
+    client = create_client(args.project, args.region)
+    input_path = Path(args.input)
+
+    mode = args.mode
+    if mode == "auto":
+        n_head = sum(
+            1
+            for _ in itertools.islice(
+                iter_jsonl_lines(input_path), args.online_threshold
+            )
+        )
+        mode = "online" if n_head < args.online_threshold else "batch"
+    if mode == "batch" and not args.output_uri:
+        print("Error: --output-uri is required for batch mode", file=sys.stderr)
+        sys.exit(1)
+
+    counter: Counter = Counter()
+    started = time.monotonic()
+    with tempfile.TemporaryDirectory(prefix="batch-run-") as work_dir:
+        if mode == "online":
+            print(f"Mode: online (concurrency={args.concurrency}, rpm={args.rpm})")
+            raw_path = Path(work_dir) / "online.jsonl"
+            with open(raw_path, "wb", buffering=1024 * 1024) as raw:
+                run_async(
+                    run_online_async(
+                        client,
+                        args.model,
+                        iter_jsonl_lines(input_path),
+                        raw,
+                        concurrency=args.concurrency,
+                        rpm=args.rpm,
+                        max_retries=args.max_retries,
+                        counter=counter,
+                    )
+                )
+            output_rows = ((0, line) for line in iter_jsonl_lines(raw_path))
+        else:
+            print("Mode: batch")
+            storage = create_storage(args.project)
+            manifest = None
+            if args.manifest:
+                manifest = open_manifest(
+                    args.manifest,
+                    input_path,
+                    args.output_uri,
+                    args.model,
+                    args.display_name,
+                    None,
+                    args.shard_max_lines,
+                    args.shard_max_mb * 1024 * 1024,
+                )
+            try:
+                jobs = create_sharded_jobs(
+                    client,
+                    storage,
+                    iter_jsonl_lines(input_path),
+                    args.output_uri,
+                    args.model,
+                    display_name=args.display_name,
+                    max_lines=args.shard_max_lines,
+                    max_bytes=args.shard_max_mb * 1024 * 1024,
+                    workers=args.upload_workers,
+                    manifest=manifest,
+                )
+            except RuntimeError as e:
+                print(f"Error: {e}", file=sys.stderr)
+                sys.exit(1)
+            jobs = wait_for_jobs(
+                client,
+                [job.name for job in jobs],
+                poll_interval=args.poll_interval,
+                min_interval=args.min_poll_interval,
+                max_interval=args.max_poll_interval,
+            )
+            if manifest:
+                manifest.record_states(jobs)
+            uris = [
+                uri
+                for job in jobs
+                if job.dest and job.dest.gcs_uri
+                for uri in list_prediction_files(storage, job.dest.gcs_uri)
+            ]
+            output_rows = (
+                (0, line)
+                for _, line in iter_output_lines(
+                    storage, uris, Path(work_dir), workers=args.download_workers
+                )
+            )
+
+        with open(args.output, "wb", buffering=1024 * 1024) as out:
+            stats = join_results(
+                output_rows,
+                out,
+                Path(work_dir),
+                input_path=input_path,
+                spill_bytes=args.spill_mb * 1024 * 1024,
+            )
+
+    elapsed = time.monotonic() - started
+    print()
+    print(f"Wrote {stats.written} rows to {args.output} in {elapsed:.1f}s")
+    if mode == "online":
+        print(
+            f"Online: {counter['succeeded']} succeeded, {counter['failed']} failed, "
+            f"{counter['retries']} retries"
+        )
+    print_join_warnings(stats)
+    if counter["failed"] or stats.missing:
+        sys.exit(1)
+
+
+def cmd_cache(args):
+    """レスポンスキャッシュの状態表示・削除"""
+    cache = open_response_cache()
+    if args.clear:
+        cache.clear()
+        print(f"Cleared {cache.path}")
+    count, size = cache.stats()
+    print(f"Path: {cache.path}")
+    print(f"Entries: {count}")
+    print(f"Size: {size / 1024 / 1024:.1f} MB")
+    cache.close()
+
+
+def cmd_usage(args):
+    """詳細な使い方を表示"""
+    print(USAGE_DOC)
+
+
+def estimate_remaining(job: types.BatchJob, running_for: float) -> float | None:
+    """completion_stats の進捗から RUNNING ジョブの残り秒数を推定"""
+    stats = job.completion_stats
+    if not stats:
+        return None
+    done = (stats.successful_count or 0) + (stats.failed_count or 0)
+    total = done + (stats.incomplete_count or 0)
+    if done == 0 or total == 0:
+        return None
+    return running_for * (total - done) / done
+
+
+def next_poll_interval(
+    job: types.BatchJob,
+    polls_in_state: int,
+    state_since: float,
+    base: float,
+    min_interval: float,
+    max_interval: float,
+) -> float:
+    """ジョブの状態に応じて次のポーリングまでの秒数を決める"""
+    state = job.state.name
+    if state in WAITING_STATES:
+        interval = base * 1.5**polls_in_state
+    elif state == "JOB_STATE_RUNNING":
+        if job.start_time:
+            running_for = (datetime.now(timezone.utc) - job.start_time).total_seconds()
+        else:
+            running_for = time.monotonic() - state_since
+        remaining = estimate_remaining(job, running_for)
+        interval = base if remaining is None else remaining / 2
+    else:
+        interval = base
+
+    interval = max(min_interval, min(max_interval, interval))
+    return interval * random.uniform(0.9, 1.1)
+
+
+@dataclass
+class JobTrace:
+    """ポーリングで観測したジョブの状態遷移 (状態, UNIX 秒) とポーリングの所要時間"""
+
+    name: str
+    transitions: list[tuple[str, float]] = field(default_factory=list)
+    polls: int = 0
+    poll_seconds: float = 0.0
+    job: types.BatchJob | None = None
+
+
+async def poll_job(
+    client: genai.Client,
+    job_name: str,
+    semaphore: asyncio.Semaphore,
+    base: float,
+    min_interval: float,
+    max_interval: float,
+    counter: Counter,
+    trace: JobTrace | None = None,
+) -> types.BatchJob:
+    """1 ジョブを終了状態になるまでポーリング
+
+    一時的なエラーは MAX_POLL_RETRIES 回まで待って再試行し、他のジョブの待機は止めない。
+    """
+    state = None
+    polls_in_state = 0
+    state_since = time.monotonic()
+    failures = 0
+
+    while True:
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                job = await client.aio.batches.get(name=job_name)
+            except Exception as e:
+                if failures >= MAX_POLL_RETRIES or not is_retryable(e):
+                    raise
+                job, error = None, e
+            poll_seconds = time.perf_counter() - started
+        if job is None:
+            failures += 1
+            counter["poll_errors"] += 1
+            print(f"  {'(retrying)':25} {job_name}: {error}")
+            await asyncio.sleep(random.uniform(0, min(60, 2**failures)))
+            continue
+        failures = 0
+        counter["polls"] += 1
+        if trace:
+            trace.polls += 1
+            trace.poll_seconds += poll_seconds
+            trace.job = job
+
+        if job.state.name != state:
+            state = job.state.name
+            polls_in_state = 0
+            state_since = time.monotonic()
+            print(f"  {state:25} {job_name}")
+            if trace:
+                trace.transitions.append((state, time.time()))
+        else:
+            polls_in_state += 1
+
+        if state in TERMINAL_STATES:
+            return job
+
+        await asyncio.sleep(
+            next_poll_interval(
+                job, polls_in_state, state_since, base, min_interval, max_interval
+            )
+        )
+
+
+async def wait_for_jobs_async(
+    client: genai.Client,
+    job_names: list[str],
+    poll_interval: float = 30,
+    min_interval: float = 5,
+    max_interval: float = 300,
+    counter: Counter | None = None,
+    traces: list[JobTrace] | None = None,
+) -> list[types.BatchJob]:
+    """複数ジョブを 1 つのイベントループでまとめて待機
+
+    traces を渡すと、ジョブごとの JobTrace を追加する。
+    """
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_POLLS)
+    counter = Counter() if counter is None else counter
+    job_traces = [JobTrace(name) for name in job_names]
+    if traces is not None:
+        traces.extend(job_traces)
+    return await asyncio.gather(
+        *(
+            poll_job(
+                client,
+                name,
+                semaphore,
+                poll_interval,
+                min_interval,
+                max_interval,
+                counter,
+                trace,
+            )
+            for name, trace in zip(job_names, job_traces)
+        )
+    )
+
+
+def wait_for_jobs(
+    client: genai.Client,
+    job_names: list[str],
+    poll_interval: float = 30,
+    min_interval: float = 5,
+    max_interval: float = 300,
+    trace_dir: Path | None = None,
+) -> list[types.BatchJob]:
+    """複数ジョブの完了を待機し、サマリを表示
+
+    状態遷移の時刻とポーリング時間をトレースファイルとして trace_dir
+    (default: キャッシュディレクトリの traces/) に書き出す。
+    """
+    print(f"Waiting for {len(job_names)} job(s)")
+    counter: Counter = Counter()
+    traces: list[JobTrace] = []
+    started = time.monotonic()
+    started_at = time.time()
+    jobs = run_async(
+        wait_for_jobs_async(
+            client,
+            job_names,
+            poll_interval,
+            min_interval,
+            max_interval,
+            counter,
+            traces,
+        )
+    )
+
+    elapsed = int(time.monotonic() - started)
+    poll_seconds = sum(trace.poll_seconds for trace in traces)
+    trace_path = write_trace(
+        traces, started_at, time.time(), trace_dir or cache_dir() / "traces"
+    )
+    print()
+    print(
+        f"All jobs finished in {elapsed}s "
+        f"({counter['polls']} API calls, {poll_seconds:.1f}s polling)"
+    )
+    if counter["poll_errors"]:
+        print(f"Retried {counter['poll_errors']} transient polling errors")
+    print(f"Trace: {trace_path}")
+    for state, count in sorted(Counter(job.state.name for job in jobs).items()):
+        print(f"  {state:25} {count}")
+    for job in jobs:
+        if job.state.name == "JOB_STATE_SUCCEEDED":
+            print(f"Output: {job.dest.gcs_uri}")
+        elif job.error:
+            print(f"Error ({job.name}): {job.error}")
+
+    return jobs
+
+
+def _unix(value: datetime | None) -> float | None:
+    return value.timestamp() if value else None
+
+
+def job_phases(trace: JobTrace) -> list[tuple[str, float, float]]:
+    """ジョブの状態ごとの (状態, 開始, 終了) (UNIX 秒)
+
+    観測時刻はポーリング間隔の精度しかないため、作成・実行開始・終了は
+    API が返す create_time / start_time / end_time を優先する。
+    """
+    job = trace.job
+    starts = {}
+    for state, at in trace.transitions:
+        starts.setdefault(state, at)
+    if not starts or job is None:
+        return []
+
+    terminal_at = _unix(job.end_time) or trace.transitions[-1][1]
+    for state in TERMINAL_STATES:
+        starts.pop(state, None)
+    first_state = min(starts, key=starts.get) if starts else None
+    if first_state and job.create_time:
+        starts[first_state] = min(starts[first_state], _unix(job.create_time))
+    if job.start_time:
+        starts["JOB_STATE_RUNNING"] = _unix(job.start_time)
+
+    # サーバー時刻で補正した結果、PENDING -> QUEUED -> RUNNING の順序が崩れた観測は捨てる
+    order = ["JOB_STATE_PENDING", "JOB_STATE_QUEUED", "JOB_STATE_RUNNING"]
+    phases: list[tuple[str, float]] = []
+    for state, at in sorted(starts.items(), key=itemgetter(1)):
+        rank = order.index(state) if state in order else len(order)
+        if phases and phases[-1][0] in order and rank <= order.index(phases[-1][0]):
+            continue
+        phases.append((state, at))
+
+    return [
+        (state, at, phases[i + 1][1] if i + 1 < len(phases) else terminal_at)
+        for i, (state, at) in enumerate(phases)
+    ]
+
+
+def job_durations(job: types.BatchJob) -> tuple[float | None, float | None]:
+    """(キュー待ち秒数, 実行秒数)。作成から実行開始まで、実行開始から終了まで
+
+    実行開始前に失敗・キャンセルされたジョブは待ち時間が確定しないのでどちらも None
+    """
+    created, started, ended = (
+        _unix(job.create_time),
+        _unix(job.start_time),
+        _unix(job.end_time),
+    )
+    if created is None or started is None:
+        return None, None
+    return started - created, (ended - started if ended else None)
+
+
+def _otlp_attributes(values: dict[str, Any]) -> list[dict]:
+    attributes = []
+    for key, value in values.items():
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            typed = {"boolValue": value}
+        elif isinstance(value, int):
+            typed = {"intValue": str(value)}
+        elif isinstance(value, float):
+            typed = {"doubleValue": value}
+        else:
+            typed = {"stringValue": str(value)}
+        attributes.append({"key": key, "value": typed})
+    return attributes
+
+
+def _otlp_span(
+    trace_id: str,
+    span_id: str,
+    parent_id: str | None,
+    name: str,
+    start: float,
+    end: float,
+    attributes: dict[str, Any],
+) -> dict:
+    span = {
+        "traceId": trace_id,
+        "spanId": span_id,
+        "name": name,
+        "kind": 1,
+        "startTimeUnixNano": str(int(start * 1e9)),
+        "endTimeUnixNano": str(int(end * 1e9)),
+        "attributes": _otlp_attributes(attributes),
+    }
+    if parent_id:
+        span["parentSpanId"] = parent_id
+    return span
+
+
+def write_trace(
+    traces: list[JobTrace], started: float, finished: float, trace_dir: Path
+) -> Path:
+    """待機 1 回分を OTLP/JSON 形式 (ExportTraceServiceRequest) で書き出す
+
+    span は wait (待機全体) > batch_job (作成から終了まで) > 状態ごとの 3 階層。
+    """
+    trace_id = os.urandom(16).hex()
+    root_id = os.urandom(8).hex()
+    spans = [
+        _otlp_span(
+            trace_id,
+            root_id,
+            None,
+            "wait",
+            started,
+            finished,
+            {
+                "wait.jobs": len(traces),
+                "wait.polls": sum(t.polls for t in traces),
+                "wait.poll_seconds": sum(t.poll_seconds for t in traces),
+            },
+        )
+    ]
+    for trace in traces:
+        job = trace.job
+        if job is None:
+            continue
+        phases = job_phases(trace)
+        queue_seconds, run_seconds = job_durations(job)
+        stats = job.completion_stats
+        job_id = os.urandom(8).hex()
+        spans.append(
+            _otlp_span(
+                trace_id,
+                job_id,
+                root_id,
+                "batch_job",
+                _unix(job.create_time) or (phases[0][1] if phases else started),
+                _unix(job.end_time) or (phases[-1][2] if phases else finished),
+                {
+                    "job.name": job.name,
+                    "job.display_name": job.display_name,
+                    "job.model": normalize_model(job.model or ""),
+                    "job.state": job.state.name,
+                    "job.queue_seconds": queue_seconds,
+                    "job.run_seconds": run_seconds,
+                    "job.succeeded_count": stats.successful_count if stats else None,
+                    "job.failed_count": stats.failed_count if stats else None,
+                    "job.polls": trace.polls,
+                    "job.poll_seconds": trace.poll_seconds,
+                },
+            )
+        )
+        for state, start, end in phases:
+            spans.append(
+                _otlp_span(trace_id, os.urandom(8).hex(), job_id, state, start, end, {})
+            )
+
+    document = {
+        "resourceSpans": [
+            {
+                "resource": {
+                    "attributes": _otlp_attributes(
+                        {"service.name": "vertexai-gemini-batch"}
+                    )
+                },
+                "scopeSpans": [{"scope": {"name": "batch.py"}, "spans": spans}],
+            }
+        ]
+    }
+    trace_dir.mkdir(parents=True, exist_ok=True)
+    stamp = datetime.fromtimestamp(started, timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    path = trace_dir / f"trace-{stamp}-{trace_id[:8]}.json"
+    path.write_text(json.dumps(document, ensure_ascii=False))
+    return path
+
+
+def load_trace_jobs(trace_dir: Path) -> list[dict]:
+    """トレースファイルから batch_job span の属性を集める (同じジョブは最新のものを採用)"""
+    jobs: dict[str, dict] = {}
+    for path in sorted(trace_dir.glob("trace-*.json")):
+        document = json.loads(path.read_text())
+        for resource in document.get("resourceSpans", []):
+            for scope in resource.get("scopeSpans", []):
+                for span in scope.get("spans", []):
+                    if span.get("name") != "batch_job":
+                        continue
+                    attributes = {
+                        a["key"]: next(iter(a["value"].values()))
+                        for a in span.get("attributes", [])
+                    }
+                    attributes["start"] = int(span["startTimeUnixNano"]) / 1e9
+                    jobs[attributes.get("job.name", span["spanId"])] = attributes
+    return list(jobs.values())
+
+
+def format_seconds(seconds: float | None) -> str:
+    if seconds is None:
+        return "-"
+    if seconds < 90:
+        return f"{seconds:.0f}s"
+    if seconds < 90 * 60:
+        return f"{seconds / 60:.1f}m"
+    return f"{seconds / 3600:.1f}h"
+
+
+def distribution(values: list[float]) -> dict[str, float] | None:
+    """p50 / p90 / max / mean (nearest-rank)"""
+    if not values:
+        return None
+    values = sorted(values)
+
+    def percentile(q: float) -> float:
+        return values[min(len(values) - 1, max(0, int(q * len(values) + 0.5) - 1))]
+
+    return {
+        "p50": percentile(0.5),
+        "p90": percentile(0.9),
+        "max": values[-1],
+        "mean": sum(values) / len(values),
+    }
+
+
+def cmd_stats(args):
+    """過去に待機したジョブのキュー待ち時間・実行時間の分布を表示"""
+    trace_dir = Path(args.trace_dir) if args.trace_dir else cache_dir() / "traces"
+    jobs = load_trace_jobs(trace_dir) if trace_dir.exists() else []
+
+    since = parse_time(args.since).timestamp() if args.since else None
+    jobs = [
+        job
+        for job in jobs
+        if (since is None or job["start"] >= since)
+        and (
+            not args.display_name_prefix
+            or str(job.get("job.display_name", "")).startswith(args.display_name_prefix)
+        )
+        and (not args.model or job.get("job.model") == normalize_model(args.model))
+    ]
+    if not jobs:
+        print(f"No traced jobs found in {trace_dir}", file=sys.stderr)
+        sys.exit(1)
+
+    def group_of(job: dict) -> str:
+        if args.group_by == "model":
+            return job.get("job.model", "")
+        if args.group_by == "hour":
+            created = datetime.fromtimestamp(job["start"], timezone.utc)
+            return f"{created.hour:02d}:00 UTC"
+        if args.group_by == "size":
+            rows = int(job.get("job.succeeded_count", 0)) + int(
+                job.get("job.failed_count", 0)
+            )
+            return f"<{10 ** len(str(rows)):,} rows"
+        return "all"
+
+    groups: dict[str, list[dict]] = {}
+    for job in jobs:
+        groups.setdefault(group_of(job), []).append(job)
+
+    summary = {
+        group: {
+            "jobs": len(members),
+            "not_started": sum(1 for j in members if "job.queue_seconds" not in j),
+            "queue_seconds": distribution(
+                [
+                    float(j["job.queue_seconds"])
+                    for j in members
+                    if "job.queue_seconds" in j
+                ]
+            ),
+            "run_seconds": distribution(
+                [float(j["job.run_seconds"]) for j in members if "job.run_seconds" in j]
+            ),
+            "poll_seconds": sum(float(j.get("job.poll_seconds", 0)) for j in members),
+        }
+        for group, members in sorted(groups.items())
+    }
+    if args.json:
+        print(json.dumps(summary, indent=2))
+        return
+
+    print(
+        f"{'group':16} {'jobs':>5} {'unrun':>5}  {'queue p50':>9} {'p90':>7} {'max':>7}  "
+        f"{'run p50':>9} {'p90':>7} {'max':>7}"
+    )
+    for group, s in summary.items():
+        cells = []
+        for metric in ("queue_seconds", "run_seconds"):
+            d = s[metric] or {}
+            cells.append(
+                f"{format_seconds(d.get('p50')):>9} {format_seconds(d.get('p90')):>7} "
+                f"{format_seconds(d.get('max')):>7}"
+            )
+        print(
+            f"{group:16} {s['jobs']:>5} {s['not_started']:>5}  {cells[0]}  {cells[1]}"
+        )
+
+
+def wait_for_completion(client: genai.Client, job_name: str, poll_interval: int = 30):
+    """ジョブの完了を待機"""
+    return wait_for_jobs(client, [job_name], poll_interval=poll_interval)[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Vertex AI Batch Prediction CLI",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="Run './batch.py usage' for detailed documentation.",
+    )
+    parser.add_argument("--project", type=str, help="GCP プロジェクト ID")
+    parser.add_argument(
+        "--region", type=str, default="global", help="リージョン (default: global)"
+    )
+    parser.add_argument(
+        "--profile-startup",
+        action="store_true",
+        help="import・Client 作成・最初の API 応答までの時間を表示 (BATCH_PROFILE_STARTUP=1 と同じ)",
+    )
+
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    # create
+    p_create = subparsers.add_parser("create", help="バッチジョブを作成")
+    g_input = p_create.add_mutually_exclusive_group(required=True)
+    g_input.add_argument("--input-uri", type=str, help="入力 JSONL の GCS URI")
+    g_input.add_argument(
+        "--input", type=str, help="ローカルの入力 JSONL (シャード分割してアップロード)"
+    )
+    p_create.add_argument(
+        "--output-uri", type=str, required=True, help="出力先の GCS URI プレフィックス"
+    )
+    p_create.add_argument("--model", type=str, required=True, help="モデル名")
+    p_create.add_argument(
+        "--display-name", type=str, default="batch-job", help="ジョブ表示名"
+    )
+    p_create.add_argument(
+        "--staging-uri",
+        type=str,
+        help="シャードのアップロード先 (default: OUTPUT_URI/_inputs/)",
+    )
+    p_create.add_argument(
+        "--shard-max-lines",
+        type=int,
+        default=DEFAULT_SHARD_MAX_LINES,
+        help=f"1 シャードの最大行数 (default: {DEFAULT_SHARD_MAX_LINES})",
+    )
+    p_create.add_argument(
+        "--shard-max-mb",
+        type=int,
+        default=DEFAULT_SHARD_MAX_MB,
+        help=f"1 シャードの最大サイズ MB (default: {DEFAULT_SHARD_MAX_MB})",
+    )
+    p_create.add_argument(
+        "--upload-workers", type=int, default=8, help="並列アップロード数 (default: 8)"
+    )
+    p_create.add_argument(
+        "--cache",
+        action="store_true",
+        help="キャッシュ済みのリクエストを除外して投入 (--input 時のみ)",
+    )
+    p_create.add_argument(
+        "--cache-max-mb",
+        type=int,
+        default=DEFAULT_CACHE_MAX_MB,
+        help=f"キャッシュの上限サイズ MB (default: {DEFAULT_CACHE_MAX_MB})",
+    )
+    p_create.add_argument(
+        "--validate",
+        action="store_true",
+        help="アップロード前に入力を検証し、問題があれば中止 (--input 時のみ)",
+    )
+    p_create.add_argument(
+        "--manifest",
+        type=str,
+        help="進捗を記録する JSON。既存なら完了済みのアップロード・ジョブ作成を飛ばして再開",
+    )
+    p_create.set_defaults(func=cmd_create)
+
+    # validate
+    p_validate = subparsers.add_parser("validate", help="入力 JSONL を投入前に検証")
+    p_validate.add_argument("--input", type=str, required=True, help="入力 JSONL")
+    p_validate.add_argument(
+        "--workers", type=int, help="並列プロセス数 (default: CPU コア数)"
+    )
+    p_validate.add_argument(
+        "--shard-max-lines",
+        type=int,
+        default=DEFAULT_SHARD_MAX_LINES,
+        help=f"1 シャードの最大行数 (default: {DEFAULT_SHARD_MAX_LINES})",
+    )
+    p_validate.add_argument(
+        "--shard-max-mb",
+        type=int,
+        default=DEFAULT_SHARD_MAX_MB,
+        help=f"1 シャードの最大サイズ MB (default: {DEFAULT_SHARD_MAX_MB})",
+    )
+    p_validate.add_argument(
+        "--input-price",
+        type=float,
+        help="入力 100 万トークンあたりの価格 (USD)。指定するとコストを見積もる",
+    )
+    p_validate.set_defaults(func=cmd_validate)
+
+    # status
+    p_status = subparsers.add_parser("status", help="ジョブの状態を確認")
+    p_status.add_argument("--job-name", type=str, required=True, help="ジョブ名")
+    p_status.set_defaults(func=cmd_status)
+
+    # list
+    p_list = subparsers.add_parser("list", help="ジョブ一覧を取得")
+    p_list.add_argument(
+        "--state",
+        type=str,
+        nargs="+",
+        help="状態で絞り込む (例: RUNNING SUCCEEDED, JOB_STATE_ 省略可)",
+    )
+    p_list.add_argument("--model", type=str, help="モデル名で絞り込む")
+    p_list.add_argument(
+        "--display-name-prefix", type=str, help="表示名のプレフィックスで絞り込む"
+    )
+    p_list.add_argument(
+        "--since",
+        type=str,
+        help="この時刻以降に作成されたジョブ (ISO 形式 または 7d / 12h)",
+    )
+    p_list.add_argument(
+        "--until",
+        type=str,
+        help="この時刻より前に作成されたジョブ (--since と同じ形式)",
+    )
+    p_list.add_argument("--limit", type=int, help="表示する最大件数")
+    p_list.add_argument(
+        "--json", action="store_true", help="1 行 1 ジョブの JSON で出力"
+    )
+    p_list.add_argument(
+        "--no-refresh", action="store_true", help="API を呼ばずにローカル索引だけを検索"
+    )
+    p_list.set_defaults(func=cmd_list)
+
+    # wait
+    p_wait = subparsers.add_parser("wait", help="ジョブの完了を待機")
+    g_wait = p_wait.add_mutually_exclusive_group(required=True)
+    g_wait.add_argument("--job-name", type=str, nargs="+", help="ジョブ名 (複数可)")
+    g_wait.add_argument(
+        "--display-name-prefix",
+        type=str,
+        help="このプレフィックスで始まる表示名のジョブ",
+    )
+    g_wait.add_argument(
+        "--manifest", type=str, help="create --manifest で記録したジョブ"
+    )
+    p_wait.add_argument(
+        "--poll-interval", type=int, default=30, help="基本のポーリング間隔 (秒)"
+    )
+    p_wait.add_argument(
+        "--min-poll-interval", type=int, default=5, help="ポーリング間隔の下限 (秒)"
+    )
+    p_wait.add_argument(
+        "--max-poll-interval", type=int, default=300, help="ポーリング間隔の上限 (秒)"
+    )
+    p_wait.add_argument(
+        "--trace-dir",
+        type=str,
+        help="トレースファイルの出力先 (default: キャッシュディレクトリの traces/)",
+    )
+    p_wait.set_defaults(func=cmd_wait)
+
+    # stats
+    p_stats = subparsers.add_parser(
+        "stats", help="過去のジョブのキュー待ち時間・実行時間の分布を表示"
+    )
+    p_stats.add_argument(
+        "--trace-dir",
+        type=str,
+        help="トレースファイルの場所 (default: キャッシュディレクトリの traces/)",
+    )
+    p_stats.add_argument(
+        "--group-by",
+        choices=["none", "model", "hour", "size"],
+        default="none",
+        help="集計の単位 (hour: 作成時刻の時 (UTC), size: 行数の桁)",
+    )
+    p_stats.add_argument(
+        "--since", type=str, help="この時刻以降に作成されたジョブ (ISO 形式 または 7d)"
+    )
+    p_stats.add_argument("--model", type=str, help="モデル名で絞り込む")
+    p_stats.add_argument(
+        "--display-name-prefix", type=str, help="表示名のプレフィックスで絞り込む"
+    )
+    p_stats.add_argument("--json", action="store_true", help="JSON 形式で出力")
+    p_stats.set_defaults(func=cmd_stats)
+
+    # results
+    p_results = subparsers.add_parser(
+        "results", help="ジョブの出力を key で並べ替えてダウンロード"
+    )
+    p_results.add_argument(
+        "--job-name", type=str, nargs="*", default=[], help="ジョブ名 (複数可)"
+    )
+    p_results.add_argument(
+        "--output", type=str, required=True, help="出力先のローカル JSONL"
+    )
+    p_results.add_argument(
+        "--input", type=str, help="元の入力 JSONL (指定すると入力と同じ順序で出力)"
+    )
+    p_results.add_argument(
+        "--manifest",
+        type=str,
+        help="create --manifest で記録したジョブと入力 (--job-name に追加)",
+    )
+    p_results.add_argument(
+        "--download-workers",
+        type=int,
+        default=8,
+        help="並列ダウンロード数 (default: 8)",
+    )
+    p_results.add_argument(
+        "--spill-mb",
+        type=int,
+        default=DEFAULT_SPILL_MB,
+        help=f"メモリ上に保持する行の上限 MB (default: {DEFAULT_SPILL_MB})",
+    )
+    p_results.add_argument(
+        "--cache",
+        action="store_true",
+        help="出力をキャッシュに登録し、出力のない入力行をキャッシュから補完",
+    )
+    p_results.add_argument(
+        "--model",
+        type=str,
+        help="キャッシュ参照に使うモデル名 (default: ジョブのモデル)",
+    )
+    p_results.add_argument(
+        "--cache-max-mb",
+        type=int,
+        default=DEFAULT_CACHE_MAX_MB,
+        help=f"キャッシュの上限サイズ MB (default: {DEFAULT_CACHE_MAX_MB})",
+    )
+    p_results.set_defaults(func=cmd_results)
+
+    # retry
+    p_retry = subparsers.add_parser(
+        "retry", help="失敗した行を再投入し、全結果を 1 ファイルにまとめる"
+    )
+    p_retry.add_argument(
+        "--job-name", type=str, nargs="+", required=True, help="元のジョブ名 (複数可)"
+    )
+    p_retry.add_argument("--input", type=str, required=True, help="元の入力 JSONL")
+    p_retry.add_argument(
+        "--output", type=str, required=True, help="最終結果のローカル JSONL"
+    )
+    p_retry.add_argument(
+        "--output-uri",
+        type=str,
+        required=True,
+        help="再投入ジョブの出力先プレフィックス",
+    )
+    p_retry.add_argument(
+        "--model", type=str, help="モデル名 (default: 元のジョブのモデル)"
+    )
+    p_retry.add_argument(
+        "--display-name", type=str, default="batch-job", help="ジョブ表示名"
+    )
+    p_retry.add_argument(
+        "--max-attempts", type=int, default=3, help="最大再投入回数 (default: 3)"
+    )
+    p_retry.add_argument(
+        "--shard-max-lines",
+        type=int,
+        default=DEFAULT_SHARD_MAX_LINES,
+        help=f"1 シャードの最大行数 (default: {DEFAULT_SHARD_MAX_LINES})",
+    )
+    p_retry.add_argument(
+        "--shard-max-mb",
+        type=int,
+        default=DEFAULT_SHARD_MAX_MB,
+        help=f"1 シャードの最大サイズ MB (default: {DEFAULT_SHARD_MAX_MB})",
+    )
+    p_retry.add_argument(
+        "--upload-workers", type=int, default=8, help="並列アップロード数 (default: 8)"
+    )
+    p_retry.add_argument(
+        "--download-workers",
+        type=int,
+        default=8,
+        help="並列ダウンロード数 (default: 8)",
+    )
+    p_retry.add_argument(
+        "--spill-mb",
+        type=int,
+        default=DEFAULT_SPILL_MB,
+        help=f"メモリ上に保持する行の上限 MB (default: {DEFAULT_SPILL_MB})",
+    )
+    p_retry.add_argument(
+        "--poll-interval", type=int, default=30, help="基本のポーリング間隔 (秒)"
+    )
+    p_retry.add_argument(
+        "--min-poll-interval", type=int, default=5, help="ポーリング間隔の下限 (秒)"
+    )
+    p_retry.add_argument(
+        "--max-poll-interval", type=int, default=300, help="ポーリング間隔の上限 (秒)"
+    )
+    p_retry.set_defaults(func=cmd_retry)
+
+    # usage-report
+    p_report = subparsers.add_parser(
+        "usage-report", help="ジョブ出力のトークン使用量を集計"
+    )
+    p_report.add_argument(
+        "--job-name", type=str, nargs="+", required=True, help="ジョブ名 (複数可)"
+    )
+    p_report.add_argument(
+        "--key-prefix-sep",
+        type=str,
+        default="-",
+        help="key プレフィックスの区切り文字 (default: -)",
+    )
+    p_report.add_argument(
+        "--key-prefix-depth",
+        type=int,
+        default=1,
+        help="key プレフィックスに使う要素数 (default: 1)",
+    )
+    p_report.add_argument(
+        "--max-groups",
+        type=int,
+        default=DEFAULT_MAX_GROUPS,
+        help="次元ごとのグループ数の上限。超えた分は (other) にまとめる "
+        f"(default: {DEFAULT_MAX_GROUPS})",
+    )
+    p_report.add_argument(
+        "--batch-rows",
+        type=int,
+        default=65536,
+        help="まとめて集計する行数 (default: 65536)",
+    )
+    p_report.add_argument(
+        "--download-workers",
+        type=int,
+        default=8,
+        help="並列ダウンロード数 (default: 8)",
+    )
+    p_report.add_argument("--json", action="store_true", help="JSON 形式で出力")
+    p_report.set_defaults(func=cmd_usage_report)
+
+    # run
+    p_run = subparsers.add_parser(
+        "run",
+        help="件数に応じてオンライン API かバッチで処理し、結果を入力順にまとめる",
+    )
+    p_run.add_argument("--input", type=str, required=True, help="入力 JSONL")
+    p_run.add_argument(
+        "--output", type=str, required=True, help="出力先のローカル JSONL"
+    )
+    p_run.add_argument("--model", type=str, required=True, help="モデル名")
+    p_run.add_argument(
+        "--mode",
+        choices=["auto", "online", "batch"],
+        default="auto",
+        help="処理方法 (default: auto = 件数で判定)",
+    )
+    p_run.add_argument(
+        "--online-threshold",
+        type=int,
+        default=DEFAULT_ONLINE_THRESHOLD,
+        help=f"この件数未満ならオンライン API で処理 (default: {DEFAULT_ONLINE_THRESHOLD})",
+    )
+    p_run.add_argument(
+        "--concurrency", type=int, default=16, help="オンライン時の同時リクエスト数"
+    )
+    p_run.add_argument(
+        "--rpm", type=float, default=600, help="オンライン時の毎分リクエスト数の上限"
+    )
+    p_run.add_argument(
+        "--max-retries", type=int, default=5, help="オンライン時の行ごとの再試行回数"
+    )
+    p_run.add_argument(
+        "--output-uri", type=str, help="バッチ時の出力先 GCS URI プレフィックス"
+    )
+    p_run.add_argument(
+        "--display-name", type=str, default="batch-run", help="バッチ時のジョブ表示名"
+    )
+    p_run.add_argument(
+        "--manifest",
+        type=str,
+        help="バッチ時の進捗を記録する JSON。既存なら中断した箇所から再開",
+    )
+    p_run.add_argument(
+        "--shard-max-lines",
+        type=int,
+        default=DEFAULT_SHARD_MAX_LINES,
+        help=f"1 シャードの最大行数 (default: {DEFAULT_SHARD_MAX_LINES})",
+    )
+    p_run.add_argument(
+        "--shard-max-mb",
+        type=int,
+        default=DEFAULT_SHARD_MAX_MB,
+        help=f"1 シャードの最大サイズ MB (default: {DEFAULT_SHARD_MAX_MB})",
+    )
+    p_run.add_argument(
+        "--upload-workers", type=int, default=8, help="並列アップロード数 (default: 8)"
+    )
+    p_run.add_argument(
+        "--download-workers",
+        type=int,
+        default=8,
+        help="並列ダウンロード数 (default: 8)",
+    )
+    p_run.add_argument(
+        "--spill-mb",
+        type=int,
+        default=DEFAULT_SPILL_MB,
+        help=f"メモリ上に保持する行の上限 MB (default: {DEFAULT_SPILL_MB})",
+    )
+    p_run.add_argument(
+        "--poll-interval", type=int, default=30, help="基本のポーリング間隔 (秒)"
+    )
+    p_run.add_argument(
+        "--min-poll-interval", type=int, default=5, help="ポーリング間隔の下限 (秒)"
+    )
+    p_run.add_argument(
+        "--max-poll-interval", type=int, default=300, help="ポーリング間隔の上限 (秒)"
+    )
+    p_run.set_defaults(func=cmd_run)
+
+    # export
+    p_export = subparsers.add_parser(
+        "export", help="ジョブ出力を Parquet データセットに変換"
+    )
+    p_export.add_argument(
+        "--job-name", type=str, nargs="+", required=True, help="ジョブ名 (複数可)"
+    )
+    p_export.add_argument(
+        "--output-dir", type=str, required=True, help="Parquet の出力先ディレクトリ"
+    )
+    p_export.add_argument(
+        "--row-group-size",
+        type=int,
+        default=DEFAULT_ROW_GROUP_SIZE,
+        help=f"行グループあたりの行数 (default: {DEFAULT_ROW_GROUP_SIZE})",
+    )
+    p_export.add_argument(
+        "--raw", action="store_true", help="元の JSON を raw 列として保持"
+    )
+    p_export.add_argument(
+        "--compression", type=str, default="zstd", help="圧縮方式 (default: zstd)"
+    )
+    p_export.add_argument(
+        "--download-workers",
+        type=int,
+        default=8,
+        help="並列ダウンロード数 (default: 8)",
+    )
+    p_export.set_defaults(func=cmd_export)
+
+    # cache
+    p_cache = subparsers.add_parser("cache", help="レスポンスキャッシュの状態を表示")
+    p_cache.add_argument("--clear", action="store_true", help="キャッシュを削除")
+    p_cache.set_defaults(func=cmd_cache)
 
     # usage
     p_usage = subparsers.add_parser("usage", help="詳細な使い方を表示")
     p_usage.set_defaults(func=cmd_usage)
 
     args = parser.parse_args()
+    PROFILE.enabled = PROFILE.enabled or args.profile_startup
+    PROFILE.mark("parse arguments")
 
-    # usage サブコマンドは --project 不要
-    if args.command != "usage" and not args.project:
+    # usage, cache, validate, stats サブコマンドは --project 不要
+    if args.command not in ("usage", "cache", "validate", "stats") and not args.project:
         parser.error("--project is required for this command")
+    if (
+        args.command == "create"
+        and (args.cache or args.validate or args.manifest)
+        and not args.input
+    ):
+        parser.error("--cache, --validate and --manifest require --input")
+    if args.command == "results":
+        if args.cache and not (args.input or args.manifest):
+            parser.error("--cache requires --input")
+        if not args.job_name and not (args.cache or args.manifest):
+            parser.error("--job-name is required")
 
-    args.func(args)
+    try:
+        args.func(args)
+    finally:
+        PROFILE.mark("command finished")
+        PROFILE.report()
 
 
 if __name__ == "__main__":
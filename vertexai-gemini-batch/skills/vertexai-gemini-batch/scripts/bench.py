@@ -0,0 +1,472 @@
+#!/usr/bin/env -S uv run --script
+# /// script
+# requires-python = ">=3.11"
+# dependencies = [
+#     "google-genai",
+#     "numpy",
+#     "orjson",
+# ]
+# ///
+"""
+batch.py のパイプラインのベンチマーク
+
+実際のジョブを作らずに、batches API と GCS をプロセス内の代替に置き換えて
+シャード分割・アップロード・ジョブ作成・ポーリング・ダウンロード・結合の
+各段階のスループットを計測する。結果は JSON で出力する。
+
+Usage:
+    ./bench.py --sizes 10000 1000000 --output bench.json
+    ./bench.py --sizes 10000000 --work-dir /mnt/scratch
+
+計測する段階:
+    shard     入力 JSONL のシャード分割 (iter_shards 内の時間)
+    upload    シャードのアップロード (スレッドごとの時間の合計)
+    submit    ジョブ作成 API (スレッドごとの時間の合計)
+    create    分割・アップロード・ジョブ作成をまとめた create_sharded_jobs の所要時間
+    poll      全ジョブが終了状態になるまでのポーリング (API 呼び出し回数も記録)
+    download  出力ファイルのダウンロード (スレッドごとの時間の合計)
+    join      ダウンロードしながら入力順に結合する join_results の所要時間
+    end_to_end  create + poll + join
+"""
+
+import argparse
+import asyncio
+import io
+import itertools
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Iterator
+
+import orjson
+from google.genai import types
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import batch  # noqa: E402
+
+DEFAULT_SIZES = [10_000, 1_000_000]
+JOB_STATES = [
+    "JOB_STATE_PENDING",
+    "JOB_STATE_QUEUED",
+    "JOB_STATE_RUNNING",
+    "JOB_STATE_SUCCEEDED",
+]
+
+
+class StageTimer:
+    """段階ごとの所要時間を合計する (複数スレッドから呼ばれる)"""
+
+    def __init__(self):
+        self.seconds: dict[str, float] = defaultdict(float)
+        self.calls: Counter = Counter()
+        self.lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float) -> None:
+        with self.lock:
+            self.seconds[stage] += seconds
+            self.calls[stage] += 1
+
+    def wrap_iter(self, stage: str, iterator: Iterator) -> Iterator:
+        """イテレータの next() にかかった時間だけを計上する"""
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(stage, time.perf_counter() - started)
+                return
+            self.add(stage, time.perf_counter() - started)
+            yield item
+
+
+class TimedStorage(batch.LocalStorage):
+    """アップロード・ダウンロードの時間を計上する LocalStorage"""
+
+    def __init__(self, root: Path, timer: StageTimer):
+        super().__init__(root)
+        self.timer = timer
+
+    def upload(self, local_path: Path, uri: str) -> None:
+        started = time.perf_counter()
+        super().upload(local_path, uri)
+        self.timer.add("upload", time.perf_counter() - started)
+
+    def download(self, uri: str, local_path: Path) -> None:
+        started = time.perf_counter()
+        super().download(uri, local_path)
+        self.timer.add("download", time.perf_counter() - started)
+
+
+class FakeBatches:
+    """client.batches の代替。ジョブは polls_per_state 回ポーリングされるごとに状態が進む"""
+
+    def __init__(
+        self, storage: batch.LocalStorage, timer: StageTimer, polls_per_state: int
+    ):
+        self.storage = storage
+        self.timer = timer
+        self.polls_per_state = polls_per_state
+        self.jobs: dict[str, types.BatchJob] = {}
+        self.polls: Counter = Counter()
+        self.ids = itertools.count()
+        self.lock = threading.Lock()
+
+    def create(
+        self, model: str, src: str, config: types.CreateBatchJobConfig
+    ) -> types.BatchJob:
+        started = time.perf_counter()
+        with self.lock:
+            name = f"projects/0/locations/global/batchPredictionJobs/{next(self.ids)}"
+            job = types.BatchJob(
+                name=name,
+                display_name=config.display_name,
+                state="JOB_STATE_PENDING",
+                model=f"publishers/google/models/{model}",
+                src=types.BatchJobSource(gcs_uri=[src]),
+                dest=types.BatchJobDestination(gcs_uri=str(config.dest).rstrip("/")),
+                create_time=datetime.now(timezone.utc),
+            )
+            self.jobs[name] = job
+        self.timer.add("submit", time.perf_counter() - started)
+        return job
+
+    def get(self, name: str) -> types.BatchJob:
+        return self.jobs[name]
+
+    def list(self, config=None) -> Iterator[types.BatchJob]:
+        return iter(list(self.jobs.values()))
+
+    def advance(self, name: str) -> types.BatchJob:
+        with self.lock:
+            self.polls[name] += 1
+            index = min(self.polls[name] // self.polls_per_state, len(JOB_STATES) - 1)
+            job = self.jobs[name].model_copy(
+                update={"state": types.JobState(JOB_STATES[index])}
+            )
+            self.jobs[name] = job
+        return job
+
+    def complete_all(self) -> None:
+        """全ジョブの出力をバッチ出力と同じ形式で書き出す (計測対象外)"""
+        for job in self.jobs.values():
+            src = self.storage._path(job.src.gcs_uri[0])
+            rows = []
+            for line in batch.iter_jsonl_lines(src):
+                row = orjson.loads(line)
+                text = row["request"]["contents"][0]["parts"][0]["text"]
+                rows.append(
+                    orjson.dumps(
+                        {
+                            "key": row["key"],
+                            "status": "",
+                            "processed_time": "2025-01-01T00:00:00.000Z",
+                            "request": row["request"],
+                            "response": {
+                                "candidates": [
+                                    {
+                                        "content": {
+                                            "role": "model",
+                                            "parts": [{"text": text[::-1]}],
+                                        },
+                                        "finishReason": "STOP",
+                                    }
+                                ],
+                                "usageMetadata": {
+                                    "promptTokenCount": len(text) // 4,
+                                    "candidatesTokenCount": len(text) // 4,
+                                    "totalTokenCount": len(text) // 2,
+                                },
+                                "modelVersion": "gemini-2.5-flash",
+                            },
+                        }
+                    )
+                    + b"\n"
+                )
+            # 実際の出力と同じく、シャード内の行順は入力と一致しない
+            random.shuffle(rows)
+            dest = self.storage._path(
+                batch.join_uri(
+                    job.dest.gcs_uri, "prediction-model-0", "predictions.jsonl"
+                )
+            )
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            with open(dest, "wb") as f:
+                f.writelines(rows)
+
+
+class FakeAioBatches:
+    """client.aio.batches の代替"""
+
+    def __init__(self, batches: FakeBatches):
+        self.batches = batches
+
+    async def get(self, name: str) -> types.BatchJob:
+        return self.batches.advance(name)
+
+
+def write_input(path: Path, rows: int, prompt_chars: int) -> int:
+    """合成した入力 JSONL を書き出し、バイト数を返す"""
+    filler = ("lorem ipsum dolor sit amet " * (prompt_chars // 27 + 1))[:prompt_chars]
+    with open(path, "wb", buffering=1024 * 1024) as f:
+        for i in range(rows):
+            f.write(
+                orjson.dumps(
+                    {
+                        "key": f"req-{i:09d}",
+                        "request": {
+                            "contents": [
+                                {"role": "user", "parts": [{"text": f"{i} {filler}"}]}
+                            ],
+                            "generationConfig": {"temperature": 0.2},
+                        },
+                    }
+                )
+                + b"\n"
+            )
+    return path.stat().st_size
+
+
+def stage_result(seconds: float, rows: int, n_bytes: int, **extra) -> dict:
+    return {
+        "seconds": round(seconds, 4),
+        "rows_per_sec": round(rows / seconds, 1) if seconds > 0 else None,
+        "mb_per_sec": round(n_bytes / seconds / 1024 / 1024, 2)
+        if seconds > 0
+        else None,
+        **extra,
+    }
+
+
+def run_size(rows: int, work_dir: Path, args) -> dict:
+    """rows 行の入力でパイプライン全体を 1 回実行して各段階を計測"""
+    root = work_dir / f"rows-{rows}"
+    root.mkdir(parents=True)
+    input_path = root / "input.jsonl"
+    print(f"[{rows} rows] generating input...", file=sys.stderr)
+    input_bytes = write_input(input_path, rows, args.prompt_chars)
+
+    timer = StageTimer()
+    storage = TimedStorage(root / "gcs", timer)
+    batches = FakeBatches(storage, timer, args.polls_per_state)
+    client = SimpleNamespace(
+        batches=batches, aio=SimpleNamespace(batches=FakeAioBatches(batches))
+    )
+
+    original_iter_shards = batch.iter_shards
+    batch.iter_shards = lambda *a, **kw: timer.wrap_iter(
+        "shard", original_iter_shards(*a, **kw)
+    )
+    quiet = redirect_stdout(io.StringIO())
+    try:
+        print(f"[{rows} rows] create...", file=sys.stderr)
+        started = time.perf_counter()
+        with quiet:
+            jobs = batch.create_sharded_jobs(
+                client,
+                storage,
+                batch.iter_jsonl_lines(input_path),
+                "gs://bench/output",
+                "gemini-2.5-flash",
+                display_name="bench",
+                max_lines=args.shard_max_lines,
+                max_bytes=args.shard_max_mb * 1024 * 1024,
+                workers=args.workers,
+            )
+        create_seconds = time.perf_counter() - started
+    finally:
+        batch.iter_shards = original_iter_shards
+
+    print(f"[{rows} rows] simulating {len(jobs)} jobs...", file=sys.stderr)
+    batches.complete_all()
+
+    print(f"[{rows} rows] poll...", file=sys.stderr)
+    counter: Counter = Counter()
+    started = time.perf_counter()
+    with redirect_stdout(io.StringIO()):
+        asyncio.run(
+            batch.wait_for_jobs_async(
+                client,
+                [job.name for job in jobs],
+                poll_interval=0,
+                min_interval=0,
+                max_interval=0,
+                counter=counter,
+            )
+        )
+    poll_seconds = time.perf_counter() - started
+
+    print(f"[{rows} rows] download + join...", file=sys.stderr)
+    uris = [
+        uri
+        for job in jobs
+        for uri in batch.list_prediction_files(storage, job.dest.gcs_uri)
+    ]
+    output_bytes = sum(storage._path(uri).stat().st_size for uri in uris)
+    join_dir = root / "join"
+    join_dir.mkdir()
+    started = time.perf_counter()
+    with open(root / "results.jsonl", "wb", buffering=1024 * 1024) as out:
+        tagged = batch.iter_output_lines(storage, uris, join_dir, workers=args.workers)
+        stats = batch.join_results(
+            ((0, line) for _, line in tagged),
+            out,
+            join_dir,
+            input_path=input_path,
+            spill_bytes=args.spill_mb * 1024 * 1024,
+        )
+    join_seconds = time.perf_counter() - started
+    if stats.written != rows or stats.missing:
+        raise RuntimeError(f"join wrote {stats.written} rows, {stats.missing} missing")
+
+    return {
+        "rows": rows,
+        "input_bytes": input_bytes,
+        "output_bytes": output_bytes,
+        "jobs": len(jobs),
+        "stages": {
+            "shard": stage_result(timer.seconds["shard"], rows, input_bytes),
+            "upload": stage_result(
+                timer.seconds["upload"], rows, input_bytes, calls=timer.calls["upload"]
+            ),
+            "submit": stage_result(
+                timer.seconds["submit"], rows, input_bytes, calls=timer.calls["submit"]
+            ),
+            "create": stage_result(create_seconds, rows, input_bytes),
+            "poll": stage_result(poll_seconds, rows, 0, api_calls=counter["polls"]),
+            "download": stage_result(
+                timer.seconds["download"],
+                rows,
+                output_bytes,
+                calls=timer.calls["download"],
+            ),
+            "join": stage_result(join_seconds, rows, output_bytes),
+        },
+        "end_to_end": stage_result(
+            create_seconds + poll_seconds + join_seconds, rows, input_bytes
+        ),
+    }
+
+
+def print_summary(results: list[dict]) -> None:
+    print(file=sys.stderr)
+    print(
+        f"{'rows':>10} {'stage':12} {'seconds':>9} {'rows/s':>12} {'MB/s':>9}",
+        file=sys.stderr,
+    )
+    for result in results:
+        stages = {**result["stages"], "end_to_end": result["end_to_end"]}
+        for stage, r in stages.items():
+            rows_per_sec = f"{r['rows_per_sec']:,.0f}" if r["rows_per_sec"] else "-"
+            mb_per_sec = f"{r['mb_per_sec']:.1f}" if r["mb_per_sec"] else "-"
+            print(
+                f"{result['rows']:>10} {stage:12} {r['seconds']:>9.3f} {rows_per_sec:>12} {mb_per_sec:>9}",
+                file=sys.stderr,
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="batch.py パイプラインのベンチマーク (API・GCS はプロセス内の代替を使用)",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=DEFAULT_SIZES,
+        help="計測する入力行数 (default: 10000 1000000, 大規模計測は 10000000)",
+    )
+    parser.add_argument(
+        "--output", type=str, help="結果 JSON の出力先 (default: 標準出力)"
+    )
+    parser.add_argument(
+        "--work-dir",
+        type=str,
+        help="一時ファイルの置き場所 (default: システムの一時ディレクトリ)",
+    )
+    parser.add_argument(
+        "--shard-max-lines",
+        type=int,
+        default=batch.DEFAULT_SHARD_MAX_LINES,
+        help=f"1 シャードの最大行数 (default: {batch.DEFAULT_SHARD_MAX_LINES})",
+    )
+    parser.add_argument(
+        "--shard-max-mb",
+        type=int,
+        default=batch.DEFAULT_SHARD_MAX_MB,
+        help=f"1 シャードの最大サイズ MB (default: {batch.DEFAULT_SHARD_MAX_MB})",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=8,
+        help="並列アップロード・ダウンロード数 (default: 8)",
+    )
+    parser.add_argument(
+        "--spill-mb",
+        type=int,
+        default=batch.DEFAULT_SPILL_MB,
+        help=f"結合時にメモリ上に保持する行の上限 MB (default: {batch.DEFAULT_SPILL_MB})",
+    )
+    parser.add_argument(
+        "--prompt-chars",
+        type=int,
+        default=200,
+        help="1 リクエストのテキスト長 (default: 200)",
+    )
+    parser.add_argument(
+        "--polls-per-state",
+        type=int,
+        default=2,
+        help="ジョブの状態が進むまでのポーリング回数 (default: 2)",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="出力行のシャッフルに使う乱数シード"
+    )
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    results = []
+    with tempfile.TemporaryDirectory(
+        prefix="batch-bench-", dir=args.work_dir
+    ) as work_dir:
+        for rows in args.sizes:
+            results.append(run_size(rows, Path(work_dir), args))
+
+    report = {
+        "benchmark": "vertexai-gemini-batch",
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "params": {
+            "shard_max_lines": args.shard_max_lines,
+            "shard_max_mb": args.shard_max_mb,
+            "workers": args.workers,
+            "spill_mb": args.spill_mb,
+            "prompt_chars": args.prompt_chars,
+            "polls_per_state": args.polls_per_state,
+        },
+        "results": results,
+    }
+    print_summary(results)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + "\n")
+        print(f"\nWrote {args.output}", file=sys.stderr)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()